@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, abort
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
@@ -6,10 +6,28 @@ from flasgger import Swagger, swag_from
 from marshmallow import Schema, fields, ValidationError
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import atexit
 import os
+import sys
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
+from decimal import Decimal
+from functools import wraps
+from sqlalchemy import and_, delete, func, insert, inspect, literal, or_, select, update
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import selectinload
 import uuid
+from product_cache import ProductCache
+from cart_store import create_cart_store
+
+if __name__ == '__main__':
+    # Run as `python app.py`: the blueprint modules do `from app import ...`
+    # and must get this module, not a second copy with its own db and app
+    sys.modules.setdefault('app', sys.modules['__main__'])
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -43,6 +61,50 @@ INVENTARIO_SERVICE_URL = os.getenv(
     'INVENTARIO_SERVICE_URL', 'http://localhost:3001')
 PAGOS_SERVICE_URL = os.getenv('PAGOS_SERVICE_URL', 'http://localhost:3002')
 
+# Overall deadline (seconds) for verifying a cart's inventory at checkout
+INVENTORY_CHECK_TIMEOUT = float(os.getenv('INVENTORY_CHECK_TIMEOUT', 5))
+INVENTORY_CHECK_WORKERS = int(os.getenv('INVENTORY_CHECK_WORKERS', 16))
+
+# Pooled HTTP client for the other services, so calls reuse connections
+http = requests.Session()
+http.mount('http://', HTTPAdapter(pool_connections=4,
+                                  pool_maxsize=INVENTORY_CHECK_WORKERS))
+http.mount('https://', HTTPAdapter(pool_connections=4,
+                                   pool_maxsize=INVENTORY_CHECK_WORKERS))
+
+inventory_check_pool = ThreadPoolExecutor(
+    max_workers=INVENTORY_CHECK_WORKERS, thread_name_prefix='inventory-check')
+
+# Product info cache (seconds fresh, then seconds served stale while refreshing)
+PRODUCT_CACHE_TTL = float(os.getenv('PRODUCT_CACHE_TTL', 30))
+PRODUCT_CACHE_STALE_TTL = float(os.getenv('PRODUCT_CACHE_STALE_TTL', 300))
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv('PRODUCT_CACHE_MAX_ENTRIES', 10000))
+
+# Where active carts live: sql (default), memory or redis. With memory or
+# redis, carts are written to SQL on checkout or after CART_IDLE_TIMEOUT
+# seconds without changes (checked every CART_FLUSH_INTERVAL seconds).
+# memory is for a single serving process only (see gunicorn.conf.py)
+CART_STORE = os.getenv('CART_STORE', 'sql')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+CART_IDLE_TIMEOUT = float(os.getenv('CART_IDLE_TIMEOUT', 1800))
+CART_FLUSH_INTERVAL = float(os.getenv('CART_FLUSH_INTERVAL', 60))
+
+# Serialized cart responses kept for GET /carts/<id> in SQL mode
+CART_SNAPSHOT_CACHE_SIZE = int(os.getenv('CART_SNAPSHOT_CACHE_SIZE', 10000))
+
+# Maximum number of items in one bulk item request
+CART_BULK_MAX_ITEMS = int(os.getenv('CART_BULK_MAX_ITEMS', 100))
+
+# Attempts for a cart edit that keeps losing the race against other edits
+CART_UPDATE_ATTEMPTS = int(os.getenv('CART_UPDATE_ATTEMPTS', 3))
+
+# archive_carts.py moves active carts untouched for CART_ABANDONED_AFTER_DAYS
+# and checked out carts older than CART_ARCHIVE_AFTER_DAYS to the archive
+# tables, CART_ARCHIVE_BATCH_SIZE carts per transaction
+CART_ABANDONED_AFTER_DAYS = float(os.getenv('CART_ABANDONED_AFTER_DAYS', 30))
+CART_ARCHIVE_AFTER_DAYS = float(os.getenv('CART_ARCHIVE_AFTER_DAYS', 90))
+CART_ARCHIVE_BATCH_SIZE = int(os.getenv('CART_ARCHIVE_BATCH_SIZE', 500))
+
 # Models - Use String for UUID when using SQLite
 
 
@@ -61,9 +123,21 @@ class Cart(db.Model):
                            default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, nullable=False,
                            default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Incremented by every change; writes are conditional on it
+    version = db.Column(db.Integer, nullable=False,
+                        default=1, server_default='1')
+    # Incremented when reprice_product changes the price of an item
+    price_version = db.Column(db.Integer, nullable=False,
+                              default=0, server_default='0')
 
     items = db.relationship('CartItem', backref='cart',
-                            lazy=True, cascade='all, delete-orphan')
+                            lazy=True, cascade='all, delete-orphan',
+                            order_by='CartItem.created_at')
+
+    __table_args__ = (
+        # Finds stale carts for archive_stale_carts
+        db.Index('ix_carts_status_updated_at', 'status', 'updated_at'),
+    )
 
 
 class CartItem(db.Model):
@@ -71,8 +145,9 @@ class CartItem(db.Model):
 
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
     cart_id = db.Column(db.String(36), db.ForeignKey(
-        'carts.id'), nullable=False)
-    product_id = db.Column(db.String(100), nullable=False)
+        'carts.id'), nullable=False, index=True)
+    # Indexed for repricing by product
+    product_id = db.Column(db.String(100), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     unit_price = db.Column(db.Numeric(10, 2), nullable=False)
     created_at = db.Column(db.DateTime, nullable=False,
@@ -83,8 +158,8 @@ class Order(db.Model):
     __tablename__ = 'orders'
 
     id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    cart_id = db.Column(db.String(36), db.ForeignKey(
-        'carts.id'), nullable=False)
+    # No foreign key: the cart may have been moved to carts_archive
+    cart_id = db.Column(db.String(36), nullable=False, index=True)
     user_id = db.Column(db.String(100), nullable=False)
     total_amount = db.Column(db.Numeric(10, 2), nullable=False)
     payment_id = db.Column(db.String(100))
@@ -93,6 +168,41 @@ class Order(db.Model):
     created_at = db.Column(db.DateTime, nullable=False,
                            default=datetime.utcnow)
 
+    __table_args__ = (
+        # Order history (GET /users/<user_id>/orders)
+        db.Index('ix_orders_user_id_created_at', 'user_id', 'created_at', 'id'),
+    )
+
+
+class ArchivedCart(db.Model):
+    """Stale cart moved out of carts by archive_stale_carts"""
+    __tablename__ = 'carts_archive'
+
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False)  # abandoned, checked_out
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    price_version = db.Column(db.Integer, nullable=False,
+                              default=0, server_default='0')
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    items = db.relationship('ArchivedCartItem', lazy=True,
+                            order_by='ArchivedCartItem.created_at')
+
+
+class ArchivedCartItem(db.Model):
+    __tablename__ = 'cart_items_archive'
+
+    id = db.Column(db.String(36), primary_key=True)
+    cart_id = db.Column(db.String(36), db.ForeignKey(
+        'carts_archive.id'), nullable=False, index=True)
+    product_id = db.Column(db.String(100), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Numeric(10, 2), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+
 # Schemas
 
 
@@ -125,9 +235,17 @@ class UpdateItemSchema(Schema):
     quantity = fields.Int(required=True, validate=lambda x: x > 0)
 
 
+class BulkItemSchema(Schema):
+    product_id = fields.Str(required=True)
+    # 0 removes the product from the cart
+    quantity = fields.Int(required=True, validate=lambda x: x >= 0)
+
+
 class CheckoutSchema(Schema):
     payment_method = fields.Str(required=True)
     billing_address = fields.Dict(required=True)
+    # The cart's price_version the customer saw; checkout fails if it moved
+    price_version = fields.Int()
 
 
 # Initialize schemas
@@ -136,21 +254,498 @@ carts_schema = CartSchema(many=True)
 order_schema = OrderSchema()
 add_item_schema = AddItemSchema()
 update_item_schema = UpdateItemSchema()
+bulk_item_schema = BulkItemSchema()
 checkout_schema = CheckoutSchema()
 
+# Cart storage
+
+cart_store = create_cart_store(CART_STORE, REDIS_URL)
+
+
+class CartConflict(Exception):
+    """Raised when a cart changed after it was loaded"""
+
+
+def serialize_cart(cart):
+    """
+    Same output as cart_schema.dump, built directly for the hot cart
+    endpoints. Also the document format of the cart store.
+    """
+    return {
+        'id': cart.id,
+        'user_id': cart.user_id,
+        'status': cart.status,
+        'created_at': cart.created_at.isoformat(),
+        'updated_at': cart.updated_at.isoformat(),
+        'version': cart.version,
+        'price_version': cart.price_version,
+        'items': [{
+            'id': item.id,
+            'product_id': item.product_id,
+            'quantity': item.quantity,
+            'unit_price': str(item.unit_price),
+            'created_at': item.created_at.isoformat()
+        } for item in cart.items]
+    }
+
+
+def cart_from_dict(data):
+    """Build a Cart from a stored dict, without attaching it to the session"""
+    return Cart(
+        id=data['id'],
+        user_id=data['user_id'],
+        status=data['status'],
+        created_at=datetime.fromisoformat(data['created_at']),
+        updated_at=datetime.fromisoformat(data['updated_at']),
+        version=data['version'],
+        price_version=data.get('price_version', 0),
+        items=[CartItem(
+            id=item['id'],
+            cart_id=data['id'],
+            product_id=item['product_id'],
+            quantity=item['quantity'],
+            unit_price=Decimal(item['unit_price']),
+            created_at=datetime.fromisoformat(item['created_at'])
+        ) for item in data['items']]
+    )
+
+
+def new_cart(user_id):
+    """A new, not yet saved cart (version 0)"""
+    now = datetime.utcnow()
+    return Cart(id=str(uuid.uuid4()), user_id=user_id, status='active',
+                created_at=now, updated_at=now, version=0, price_version=0,
+                items=[])
+
+
+def new_cart_item(cart, product_id, quantity, unit_price):
+    return CartItem(id=str(uuid.uuid4()), cart_id=cart.id,
+                    product_id=product_id, quantity=quantity,
+                    unit_price=Decimal(str(unit_price)).quantize(Decimal('0.01')),
+                    created_at=datetime.utcnow())
+
+
+def increment_cart_item(item, quantity):
+    """Add to an item's quantity; in SQL as an atomic quantity = quantity + n"""
+    if cart_store is None and inspect(item).persistent:
+        item.quantity = CartItem.quantity + quantity
+    else:
+        item.quantity += quantity
+
+
+def load_cart(cart_id):
+    """
+    Return the cart or None. When a cart store is configured, active carts
+    are served from it; an active cart found only in SQL (flushed after being
+    idle) is moved back into the store.
+    """
+    if cart_store is not None:
+        data = cart_store.get(cart_id)
+        if data:
+            return cart_from_dict(data)
+
+    cart = db.session.get(Cart, cart_id, options=[selectinload(Cart.items)])
+    if cart is None or cart_store is None or cart.status != 'active':
+        return cart
+
+    data = serialize_cart(cart)
+    if not cart_store.add(data):
+        # Another request moved it into the store first
+        data = cart_store.get(cart_id)
+    return cart_from_dict(data)
+
+
+def get_cart_or_404(cart_id):
+    cart = load_cart(cart_id)
+    if cart is None:
+        abort(404)
+    return cart
+
+
+def get_cart_item_or_404(cart, item_id):
+    for item in cart.items:
+        if item.id == item_id:
+            return item
+    abort(404)
+
+
+def save_cart(cart):
+    """
+    Write back a cart after an edit and return it serialized. Raises
+    CartConflict if the cart was changed since it was loaded.
+    """
+    now = datetime.utcnow()
+    expected = cart.version
+
+    if cart_store is not None:
+        cart.version = expected + 1
+        cart.updated_at = now
+        data = serialize_cart(cart)
+        if expected == 0:
+            written = cart_store.add(data)
+        else:
+            written = cart_store.put(data, expected_version=expected)
+        if not written:
+            raise CartConflict()
+        return data
+
+    if expected == 0:
+        cart.version = 1
+        db.session.add(cart)
+    else:
+        # Compare-and-swap on the version read with the cart; the in-session
+        # cart is synchronized with the new version
+        claimed = db.session.execute(
+            update(Cart)
+            .where(Cart.id == cart.id, Cart.version == expected)
+            .values(version=Cart.version + 1, updated_at=now)
+            .execution_options(synchronize_session='fetch')
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            raise CartConflict()
+
+    db.session.flush()
+    # Serialized before the commit expires the loaded attributes
+    data = serialize_cart(cart)
+    db.session.commit()
+    drop_cart_snapshot(cart.id)
+    return data
+
+
+def retry_cart_conflicts(view):
+    """Re-run a cart edit that lost a race, up to CART_UPDATE_ATTEMPTS times"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        for _ in range(CART_UPDATE_ATTEMPTS):
+            try:
+                return view(*args, **kwargs)
+            except CartConflict:
+                db.session.rollback()
+        return jsonify({'error': 'Cart was modified concurrently, please retry'}), 409
+    return wrapper
+
+
+# Serialized carts keyed by cart ID, each tagged with the version it was
+# built from. Every edit bumps the version, so a snapshot is only served while
+# it matches the database, even when another instance changed the cart.
+cart_snapshots = OrderedDict()
+cart_snapshots_lock = threading.Lock()
+
+
+def get_cart_snapshot(cart_id):
+    """Return the cart as a JSON string, or None if it does not exist"""
+    version = db.session.query(Cart.version).filter(
+        Cart.id == cart_id).scalar()
+    if version is None:
+        return None
+
+    with cart_snapshots_lock:
+        snapshot = cart_snapshots.get(cart_id)
+        if snapshot is not None and snapshot[0] == version:
+            cart_snapshots.move_to_end(cart_id)
+            return snapshot[1]
+
+    cart = db.session.get(Cart, cart_id, options=[selectinload(Cart.items)])
+    if cart is None:
+        return None
+    body = app.json.dumps(serialize_cart(cart))
+
+    with cart_snapshots_lock:
+        cart_snapshots[cart_id] = (cart.version, body)
+        cart_snapshots.move_to_end(cart_id)
+        while len(cart_snapshots) > CART_SNAPSHOT_CACHE_SIZE:
+            cart_snapshots.popitem(last=False)
+    return body
+
+
+def drop_cart_snapshot(cart_id):
+    with cart_snapshots_lock:
+        cart_snapshots.pop(cart_id, None)
+
+
+def check_out_cart(cart):
+    """
+    Mark an active cart as checked out and add it to the SQL session
+    (write-behind for stored carts), returning the attached instance. Raises
+    CartConflict if the cart changed or was checked out since it was loaded.
+    The caller commits, then calls release_cart.
+    """
+    now = datetime.utcnow()
+    expected = cart.version
+
+    if cart_store is not None:
+        cart.status = 'checked_out'
+        cart.version = expected + 1
+        cart.updated_at = now
+        if not cart_store.put(serialize_cart(cart), expected_version=expected):
+            raise CartConflict()
+        return db.session.merge(cart)
+
+    claimed = db.session.execute(
+        update(Cart)
+        .where(Cart.id == cart.id, Cart.version == expected,
+               Cart.status == 'active')
+        .values(status='checked_out', version=Cart.version + 1, updated_at=now)
+        .execution_options(synchronize_session='fetch')
+    ).rowcount
+    if not claimed:
+        raise CartConflict()
+    return cart
+
+
+def reopen_cart(cart_id):
+    """Make a checked out cart active again (saga compensation), in SQL"""
+    return db.session.execute(
+        update(Cart)
+        .where(Cart.id == cart_id, Cart.status == 'checked_out')
+        .values(status='active', version=Cart.version + 1,
+                updated_at=datetime.utcnow())
+        .execution_options(synchronize_session='fetch')
+    ).rowcount > 0
+
+
+def reopen_unpaid_cart(cart_id):
+    """Give back a cart claimed by a checkout whose payment did not go through"""
+    db.session.rollback()
+    reopen_cart(cart_id)
+    db.session.commit()
+    # A stored cart is reloaded from SQL, active again, on its next access
+    release_cart(cart_id)
+
+
+def release_cart(cart_id):
+    if cart_store is not None:
+        cart_store.delete(cart_id)
+    drop_cart_snapshot(cart_id)
+
+
+def flush_idle_carts(idle_for=None, limit=100):
+    """Write carts idle for idle_for seconds to SQL and drop them from the store"""
+    if cart_store is None:
+        return 0
+
+    if idle_for is None:
+        idle_for = CART_IDLE_TIMEOUT
+
+    flushed = 0
+    for cart_id in cart_store.idle_cart_ids(idle_for, limit):
+        data = cart_store.get(cart_id)
+        if data is None:
+            continue
+
+        try:
+            db.session.merge(cart_from_dict(data))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error flushing cart {cart_id}: {str(e)}")
+            continue
+
+        # A cart edited while it was being written stays in the store
+        if cart_store.delete_if_unchanged(data):
+            flushed += 1
+    return flushed
+
+
+def start_cart_flusher():
+    """Periodically flush idle carts; with the memory store, flush all on exit"""
+    if cart_store is None:
+        return
+
+    def flush(idle_for=None):
+        with app.app_context():
+            while flush_idle_carts(idle_for) > 0:
+                pass
+
+    def run():
+        while True:
+            time.sleep(CART_FLUSH_INTERVAL)
+            flush()
+
+    threading.Thread(target=run, name='cart-flusher', daemon=True).start()
+    if CART_STORE == 'memory':
+        atexit.register(flush, 0)
+
+
+def archive_stale_carts(status, older_than, batch_size=None, max_batches=None,
+                        progress=None):
+    """
+    Move carts with the given status that have not changed for older_than
+    (a timedelta), and their items, to carts_archive/cart_items_archive.
+    Active carts are archived as 'abandoned'.
+
+    Each batch is two INSERT ... SELECT and two DELETE statements over
+    batch_size carts, committed on its own, so an interrupted run keeps the
+    batches already done and the next run carries on with the carts left.
+    Carts are walked in (updated_at, id) order on ix_carts_status_updated_at.
+    progress(archived, total) is called after every batch. Returns the number
+    of carts archived.
+    """
+    if batch_size is None:
+        batch_size = CART_ARCHIVE_BATCH_SIZE
+
+    cutoff = datetime.utcnow() - older_than
+    archived_status = 'abandoned' if status == 'active' else status
+    stale = (Cart.status == status, Cart.updated_at < cutoff)
+    total = db.session.query(func.count(Cart.id)).filter(*stale).scalar()
+
+    archived = 0
+    batches = 0
+    last = None
+    while max_batches is None or batches < max_batches:
+        query = db.session.query(Cart.id, Cart.updated_at).filter(*stale)
+        if last is not None:
+            query = query.filter(or_(
+                Cart.updated_at > last.updated_at,
+                and_(Cart.updated_at == last.updated_at, Cart.id > last.id)))
+        # Locked rows, so a concurrent edit waits and then finds no cart;
+        # rows locked by another archiver are left to it
+        rows = query.order_by(Cart.updated_at, Cart.id)\
+            .limit(batch_size)\
+            .with_for_update(skip_locked=True)\
+            .all()
+        if not rows:
+            break
+        last = rows[-1]
+
+        cart_ids = [row.id for row in rows]
+        if cart_store is not None:
+            # A cart in the store is newer than its SQL copy
+            cart_ids = [cart_id for cart_id in cart_ids
+                        if cart_store.get(cart_id) is None]
+
+        try:
+            if cart_ids:
+                now = datetime.utcnow()
+                db.session.execute(insert(ArchivedCart).from_select(
+                    ['id', 'user_id', 'status', 'created_at', 'updated_at',
+                     'version', 'price_version', 'archived_at'],
+                    select(Cart.id, Cart.user_id, literal(archived_status),
+                           Cart.created_at, Cart.updated_at, Cart.version,
+                           Cart.price_version, literal(now, db.DateTime))
+                    .where(Cart.id.in_(cart_ids))))
+                db.session.execute(insert(ArchivedCartItem).from_select(
+                    ['id', 'cart_id', 'product_id', 'quantity', 'unit_price',
+                     'created_at'],
+                    select(CartItem.id, CartItem.cart_id, CartItem.product_id,
+                           CartItem.quantity, CartItem.unit_price,
+                           CartItem.created_at)
+                    .where(CartItem.cart_id.in_(cart_ids))))
+                db.session.execute(
+                    delete(CartItem).where(CartItem.cart_id.in_(cart_ids))
+                    .execution_options(synchronize_session=False))
+                db.session.execute(
+                    delete(Cart).where(Cart.id.in_(cart_ids))
+                    .execution_options(synchronize_session=False))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        for cart_id in cart_ids:
+            drop_cart_snapshot(cart_id)
+        archived += len(cart_ids)
+        batches += 1
+        if progress:
+            progress(archived, total)
+    return archived
+
+
+def reprice_product(product_id, price):
+    """
+    Set the unit price of product_id to price in every active cart (on a
+    product.updated event). Carts whose prices change get a new version and
+    price_version, so concurrent edits retry on the new prices and checkouts
+    against the old prices fail. Returns the number of carts repriced.
+    """
+    product_id = str(product_id)
+    price = Decimal(str(price)).quantize(Decimal('0.01'))
+    repriced = 0
+
+    if cart_store is not None:
+        # The store indexes carts by product, so only carts holding it are read
+        for cart_id in cart_store.cart_ids_with_product(product_id):
+            for _ in range(CART_UPDATE_ATTEMPTS):
+                data = cart_store.get(cart_id)
+                if data is None or data['status'] != 'active':
+                    break
+                items = [item for item in data['items']
+                         if item['product_id'] == product_id
+                         and Decimal(item['unit_price']) != price]
+                if not items:
+                    break
+
+                for item in items:
+                    item['unit_price'] = str(price)
+                expected = data['version']
+                data['version'] = expected + 1
+                data['price_version'] = data.get('price_version', 0) + 1
+                if cart_store.put(data, expected_version=expected):
+                    repriced += 1
+                    break
+            else:
+                print(f"Could not reprice cart {cart_id}: too many conflicts")
+
+    # In SQL, two set-based updates: the carts holding the product at another
+    # price, then their items. Cart rows are locked first, as in save_cart
+    outdated = select(CartItem.cart_id).where(
+        CartItem.product_id == product_id, CartItem.unit_price != price)
+    try:
+        repriced += db.session.execute(
+            update(Cart)
+            .where(Cart.status == 'active', Cart.id.in_(outdated))
+            .values(version=Cart.version + 1,
+                    price_version=Cart.price_version + 1,
+                    # Repricing is not cart activity
+                    updated_at=Cart.updated_at)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.execute(
+            update(CartItem)
+            .where(CartItem.product_id == product_id,
+                   CartItem.unit_price != price,
+                   CartItem.cart.has(Cart.status == 'active'))
+            .values(unit_price=price)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return repriced
+
+
+def get_archived_cart(cart_id):
+    return db.session.get(ArchivedCart, cart_id,
+                          options=[selectinload(ArchivedCart.items)])
+
 # External service functions
 
 
+def fetch_product_info(product_id):
+    """Get product information from inventory service (raises if unreachable)"""
+    response = http.get(
+        f"{INVENTARIO_SERVICE_URL}/products/{product_id}")
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+
+product_cache = ProductCache(
+    fetch_product_info,
+    ttl=PRODUCT_CACHE_TTL,
+    stale_ttl=PRODUCT_CACHE_STALE_TTL,
+    max_entries=PRODUCT_CACHE_MAX_ENTRIES
+)
+
+
 def get_product_info(product_id):
-    """Get product information from inventory service"""
+    """Get product information, from the local cache when possible"""
     try:
-        response = requests.get(
-            f"{INVENTARIO_SERVICE_URL}/products/{product_id}")
-        if response.status_code == 200:
-            return response.json()
-        return None
+        return product_cache.get(product_id)
     except requests.exceptions.RequestException:
-        # For demo purposes, return mock data if service is not available
+        # For demo purposes, return mock data if service is not available.
+        # Not cached, so real prices are used as soon as inventario is back
         return {
             'id': product_id,
             'name': f'Product {product_id}',
@@ -159,11 +754,12 @@ def get_product_info(product_id):
         }
 
 
-def check_product_availability(product_id, quantity):
+def check_product_availability(product_id, quantity, timeout=None):
     """Check if product is available in inventory"""
     try:
-        response = requests.get(
-            f"{INVENTARIO_SERVICE_URL}/products/{product_id}/availability")
+        response = http.get(
+            f"{INVENTARIO_SERVICE_URL}/products/{product_id}/availability",
+            timeout=timeout)
         if response.status_code == 200:
             data = response.json()
             return data.get('available_quantity', 0) >= quantity
@@ -173,6 +769,55 @@ def check_product_availability(product_id, quantity):
         return True
 
 
+def check_products_availability(items, timeout=INVENTORY_CHECK_TIMEOUT):
+    """
+    Check a list of (product_id, quantity) pairs and return the product IDs
+    that are not available. Uses inventario's batch endpoint (one round
+    trip) and falls back to concurrent per-product checks. Raises
+    TimeoutError when the checks do not finish within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+
+    # The same product may appear more than once
+    requested = {}
+    for product_id, quantity in items:
+        requested[str(product_id)] = requested.get(
+            str(product_id), 0) + quantity
+
+    try:
+        response = http.post(
+            f"{INVENTARIO_SERVICE_URL}/api/products/availability:batch",
+            json={'items': [{'product_id': product_id, 'quantity': quantity}
+                            for product_id, quantity in requested.items()]},
+            timeout=timeout)
+        if response.status_code == 200:
+            return [str(result['product_id'])
+                    for result in response.json()['items']
+                    if not result['available']]
+    except (requests.exceptions.RequestException, KeyError, ValueError):
+        pass
+
+    futures = {
+        product_id: inventory_check_pool.submit(
+            check_product_availability, product_id, quantity,
+            max(deadline - time.monotonic(), 0.1))
+        for product_id, quantity in requested.items()
+    }
+
+    unavailable = []
+    for product_id, future in futures.items():
+        try:
+            available = future.result(
+                timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            for pending in futures.values():
+                pending.cancel()
+            raise TimeoutError('Inventory check timed out')
+        if not available:
+            unavailable.append(product_id)
+    return unavailable
+
+
 def process_payment(amount, payment_method, billing_address):
     """Process payment through payment gateway"""
     try:
@@ -181,7 +826,7 @@ def process_payment(amount, payment_method, billing_address):
             'payment_method': payment_method,
             'billing_address': billing_address
         }
-        response = requests.post(f"{PAGOS_SERVICE_URL}/payments", json=payload)
+        response = http.post(f"{PAGOS_SERVICE_URL}/payments", json=payload)
         if response.status_code == 200:
             return response.json()
         return None
@@ -246,11 +891,9 @@ def create_cart():
         if not user_id:
             return jsonify({'error': 'user_id is required'}), 400
 
-        cart = Cart(user_id=user_id)
-        db.session.add(cart)
-        db.session.commit()
+        cart = new_cart(user_id)
 
-        return cart_schema.dump(cart), 201
+        return save_cart(cart), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -274,8 +917,24 @@ def create_cart():
     }
 })
 def get_cart(cart_id):
-    cart = Cart.query.get_or_404(cart_id)
-    return cart_schema.dump(cart)
+    if cart_store is not None:
+        # Store documents are already in the response format
+        data = cart_store.get(cart_id)
+        if data:
+            return data
+        cart = load_cart(cart_id)
+        if cart is not None:
+            return serialize_cart(cart)
+    else:
+        snapshot = get_cart_snapshot(cart_id)
+        if snapshot is not None:
+            return app.response_class(snapshot, mimetype='application/json')
+
+    # Archived carts stay readable
+    archived = get_archived_cart(cart_id)
+    if archived is None:
+        abort(404)
+    return serialize_cart(archived)
 
 
 @app.route('/carts/<cart_id>/items', methods=['POST'])
@@ -310,9 +969,10 @@ def get_cart(cart_id):
         404: {'description': 'Cart or product not found'}
     }
 })
+@retry_cart_conflicts
 def add_item_to_cart(cart_id):
     try:
-        cart = Cart.query.get_or_404(cart_id)
+        cart = get_cart_or_404(cart_id)
 
         if cart.status != 'active':
             return jsonify({'error': 'Cannot modify inactive cart'}), 400
@@ -321,40 +981,33 @@ def add_item_to_cart(cart_id):
         product_id = data['product_id']
         quantity = data['quantity']
 
-        # Get product info from inventory service
+        # Get product info (cached copy of the inventory service data)
         product_info = get_product_info(product_id)
         if not product_info:
             return jsonify({'error': 'Product not found'}), 404
 
-        # Check availability
-        if not check_product_availability(product_id, quantity):
-            return jsonify({'error': 'Insufficient inventory'}), 400
-
         # Check if item already exists in cart
-        existing_item = CartItem.query.filter_by(
-            cart_id=cart_id, product_id=product_id).first()
+        existing_item = next(
+            (item for item in cart.items if item.product_id == product_id), None)
 
+        # Check availability once, for the resulting quantity
         if existing_item:
             new_quantity = existing_item.quantity + quantity
             if not check_product_availability(product_id, new_quantity):
                 return jsonify({'error': 'Insufficient inventory for total quantity'}), 400
-            existing_item.quantity = new_quantity
+            increment_cart_item(existing_item, quantity)
+        elif not check_product_availability(product_id, quantity):
+            return jsonify({'error': 'Insufficient inventory'}), 400
         else:
-            cart_item = CartItem(
-                cart_id=cart_id,
-                product_id=product_id,
-                quantity=quantity,
-                unit_price=product_info['price']
-            )
-            db.session.add(cart_item)
+            cart.items.append(new_cart_item(
+                cart, product_id, quantity, product_info['price']))
 
-        cart.updated_at = datetime.utcnow()
-        db.session.commit()
-
-        return cart_schema.dump(cart), 201
+        return save_cart(cart), 201
 
     except ValidationError as e:
         return jsonify({'error': e.messages}), 400
+    except CartConflict:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -397,15 +1050,15 @@ def add_item_to_cart(cart_id):
         404: {'description': 'Cart or item not found'}
     }
 })
+@retry_cart_conflicts
 def update_cart_item(cart_id, item_id):
     try:
-        cart = Cart.query.get_or_404(cart_id)
+        cart = get_cart_or_404(cart_id)
 
         if cart.status != 'active':
             return jsonify({'error': 'Cannot modify inactive cart'}), 400
 
-        cart_item = CartItem.query.filter_by(
-            id=item_id, cart_id=cart_id).first_or_404()
+        cart_item = get_cart_item_or_404(cart, item_id)
 
         data = update_item_schema.load(request.get_json())
         new_quantity = data['quantity']
@@ -415,13 +1068,13 @@ def update_cart_item(cart_id, item_id):
             return jsonify({'error': 'Insufficient inventory'}), 400
 
         cart_item.quantity = new_quantity
-        cart.updated_at = datetime.utcnow()
-        db.session.commit()
 
-        return cart_schema.dump(cart)
+        return save_cart(cart)
 
     except ValidationError as e:
         return jsonify({'error': e.messages}), 400
+    except CartConflict:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -451,22 +1104,161 @@ def update_cart_item(cart_id, item_id):
         404: {'description': 'Cart or item not found'}
     }
 })
+@retry_cart_conflicts
 def remove_cart_item(cart_id, item_id):
     try:
-        cart = Cart.query.get_or_404(cart_id)
+        cart = get_cart_or_404(cart_id)
 
         if cart.status != 'active':
             return jsonify({'error': 'Cannot modify inactive cart'}), 400
 
-        cart_item = CartItem.query.filter_by(
-            id=item_id, cart_id=cart_id).first_or_404()
+        cart_item = get_cart_item_or_404(cart, item_id)
 
-        db.session.delete(cart_item)
-        cart.updated_at = datetime.utcnow()
-        db.session.commit()
+        cart.items.remove(cart_item)
+
+        return save_cart(cart)
+
+    except CartConflict:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/carts/<cart_id>/items:bulk', methods=['PUT'])
+@swag_from({
+    'tags': ['Cart Items'],
+    'summary': 'Set the quantities of several products at once',
+    'description': 'Adds, updates or removes (quantity 0) each product in one request. '
+                   'Availability is checked in one batch and all accepted changes are '
+                   'saved together; rejected items are reported per item.',
+    'parameters': [
+        {
+            'name': 'cart_id',
+            'in': 'path',
+            'type': 'string',
+            'required': True,
+            'description': 'Cart ID'
+        },
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'items': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'product_id': {'type': 'string'},
+                                'quantity': {'type': 'integer', 'minimum': 0}
+                            },
+                            'required': ['product_id', 'quantity']
+                        }
+                    }
+                },
+                'required': ['items']
+            }
+        }
+    ],
+    'responses': {
+        200: {'description': 'Cart and per-item results'},
+        400: {'description': 'Invalid input or inactive cart'},
+        404: {'description': 'Cart not found'},
+        504: {'description': 'Inventory check timed out'}
+    }
+})
+@retry_cart_conflicts
+def bulk_upsert_cart_items(cart_id):
+    try:
+        cart = get_cart_or_404(cart_id)
 
-        return cart_schema.dump(cart)
+        if cart.status != 'active':
+            return jsonify({'error': 'Cannot modify inactive cart'}), 400
+
+        json_data = request.get_json(silent=True) or {}
+        items = json_data.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'items must be a non-empty list'}), 400
+        if len(items) > CART_BULK_MAX_ITEMS:
+            return jsonify({'error': f'At most {CART_BULK_MAX_ITEMS} items per request'}), 400
+
+        results = [None] * len(items)
+        requested = {}  # product_id -> (index, quantity)
+        for index, item in enumerate(items):
+            try:
+                data = bulk_item_schema.load(item)
+            except ValidationError as e:
+                results[index] = {'index': index, 'status': 'invalid',
+                                  'error': e.messages}
+                continue
+            if data['product_id'] in requested:
+                results[index] = {'index': index, 'product_id': data['product_id'],
+                                  'status': 'invalid', 'error': 'Duplicate product_id'}
+                continue
+            requested[data['product_id']] = (index, data['quantity'])
+
+        existing = {item.product_id: item for item in cart.items}
+
+        # Look up the products that are new to the cart concurrently
+        lookups = {
+            product_id: inventory_check_pool.submit(get_product_info, product_id)
+            for product_id, (_, quantity) in requested.items()
+            if quantity > 0 and product_id not in existing
+        }
+        product_infos = {product_id: future.result()
+                         for product_id, future in lookups.items()}
+
+        to_check = []
+        for product_id, (index, quantity) in requested.items():
+            if product_id in product_infos and not product_infos[product_id]:
+                results[index] = {'index': index, 'product_id': product_id,
+                                  'status': 'rejected', 'error': 'Product not found'}
+            elif quantity > 0:
+                to_check.append((product_id, quantity))
+
+        try:
+            unavailable = set(check_products_availability(to_check)) if to_check else set()
+        except TimeoutError:
+            return jsonify({'error': 'Inventory check timed out'}), 504
+
+        for product_id, (index, quantity) in requested.items():
+            if results[index] is not None:
+                continue
+
+            result = {'index': index, 'product_id': product_id}
+            item = existing.get(product_id)
+            if product_id in unavailable:
+                result.update(status='rejected', error='Insufficient inventory')
+            elif quantity == 0:
+                if item is not None:
+                    cart.items.remove(item)
+                result['status'] = 'removed'
+            elif item is not None:
+                item.quantity = quantity
+                result.update(status='updated', quantity=quantity)
+            else:
+                cart.items.append(new_cart_item(
+                    cart, product_id, quantity, product_infos[product_id]['price']))
+                result.update(status='added', quantity=quantity)
+            results[index] = result
+
+        accepted = sum(1 for result in results
+                       if result['status'] in ('added', 'updated', 'removed'))
+
+        # All accepted changes are written together
+        data = save_cart(cart) if accepted else serialize_cart(cart)
+
+        return {
+            'cart': data,
+            'results': results,
+            'accepted_items': accepted,
+            'rejected_items': len(results) - accepted
+        }
 
+    except CartConflict:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -499,6 +1291,10 @@ def remove_cart_item(cart_id, item_id):
                             'country': {'type': 'string'},
                             'postal_code': {'type': 'string'}
                         }
+                    },
+                    'price_version': {
+                        'type': 'integer',
+                        'description': 'price_version of the cart shown to the customer'
                     }
                 },
                 'required': ['payment_method', 'billing_address']
@@ -507,13 +1303,15 @@ def remove_cart_item(cart_id, item_id):
     ],
     'responses': {
         200: {'description': 'Checkout successful'},
-        400: {'description': 'Invalid input or empty cart'},
-        404: {'description': 'Cart not found'}
+        400: {'description': 'Invalid input, empty cart or insufficient inventory'},
+        404: {'description': 'Cart not found'},
+        409: {'description': 'Cart prices changed or cart modified during checkout'},
+        504: {'description': 'Inventory check timed out'}
     }
 })
 def checkout_cart(cart_id):
     try:
-        cart = Cart.query.get_or_404(cart_id)
+        cart = get_cart_or_404(cart_id)
 
         if cart.status != 'active':
             return jsonify({'error': 'Cart is not active'}), 400
@@ -523,23 +1321,47 @@ def checkout_cart(cart_id):
 
         data = checkout_schema.load(request.get_json())
 
+        # Item prices are kept current by reprice_product, so one comparison
+        # tells whether the customer agreed to them
+        if data.get('price_version', cart.price_version) != cart.price_version:
+            return jsonify({'error': 'Cart prices changed',
+                            'cart': serialize_cart(cart)}), 409
+
         # Calculate total amount
         total_amount = sum(
             item.quantity * item.unit_price for item in cart.items)
 
-        # Verify inventory availability for all items
-        for item in cart.items:
-            if not check_product_availability(item.product_id, item.quantity):
-                return jsonify({'error': f'Insufficient inventory for product {item.product_id}'}), 400
+        # Verify inventory availability for all items at once
+        try:
+            unavailable = check_products_availability(
+                [(item.product_id, item.quantity) for item in cart.items])
+        except TimeoutError:
+            return jsonify({'error': 'Inventory check timed out'}), 504
+        if unavailable:
+            return jsonify({'error': f'Insufficient inventory for product {unavailable[0]}'}), 400
+
+        # Claim the cart before charging, so nothing can change or check out
+        # the cart once the customer has paid for it
+        try:
+            cart = check_out_cart(cart)
+            db.session.commit()
+        except CartConflict:
+            db.session.rollback()
+            return jsonify({'error': 'Cart was modified during checkout'}), 409
 
         # Process payment
-        payment_result = process_payment(
-            total_amount,
-            data['payment_method'],
-            data['billing_address']
-        )
+        try:
+            payment_result = process_payment(
+                total_amount,
+                data['payment_method'],
+                data['billing_address']
+            )
+        except Exception:
+            reopen_unpaid_cart(cart_id)
+            raise
 
         if not payment_result:
+            reopen_unpaid_cart(cart_id)
             return jsonify({'error': 'Payment processing failed'}), 400
 
         # Create order
@@ -552,11 +1374,9 @@ def checkout_cart(cart_id):
                 'status') == 'success' else 'failed'
         )
 
-        # Update cart status
-        cart.status = 'checked_out'
-
         db.session.add(order)
         db.session.commit()
+        release_cart(cart_id)
 
         return {
             'order': order_schema.dump(order),
@@ -603,14 +1423,41 @@ def health_check():
 
 # Register saga blueprint
 try:
-    from saga_endpoints import saga_bp
+    from saga_endpoints import (saga_bp, start_checkout_dispatch_relay,
+                                start_saga_event_consumer)
     app.register_blueprint(saga_bp)
     print("Saga endpoints registered successfully")
 except ImportError as e:
+    start_checkout_dispatch_relay = None
+    start_saga_event_consumer = None
     print(f"Warning: Could not import saga endpoints: {e}")
 
+checkout_dispatch_relay = None
+saga_event_consumer = None
+cart_flusher_started = False
+background_workers_lock = threading.Lock()
+
+
+def start_background_workers():
+    """
+    Start the cart flusher, the checkout dispatch relay and the saga event
+    consumer, once per serving process. Threads do not survive a fork, so
+    under gunicorn this runs in every worker (post_worker_init in
+    gunicorn.conf.py); with `python app.py`, below.
+    """
+    global checkout_dispatch_relay, saga_event_consumer, cart_flusher_started
+    with background_workers_lock:
+        if not cart_flusher_started:
+            start_cart_flusher()
+            cart_flusher_started = True
+        if checkout_dispatch_relay is None and start_checkout_dispatch_relay:
+            checkout_dispatch_relay = start_checkout_dispatch_relay(app)
+        if saga_event_consumer is None and start_saga_event_consumer:
+            saga_event_consumer = start_saga_event_consumer(app)
+
 
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+    start_background_workers()
     app.run(debug=True, host='0.0.0.0', port=3000)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Archival job for stale carts
+
+Moves active carts untouched for CART_ABANDONED_AFTER_DAYS (as 'abandoned')
+and checked out carts older than CART_ARCHIVE_AFTER_DAYS, with their items,
+to carts_archive and cart_items_archive. Every batch commits on its own, so
+the job can be stopped at any time and simply run again. Meant to be run
+periodically, e.g. from cron.
+
+Usage:
+    python archive_carts.py
+    python archive_carts.py --abandoned-after 14 --batch-size 1000
+"""
+
+import argparse
+import sys
+from datetime import timedelta
+from app import (app, db, archive_stale_carts, CART_ABANDONED_AFTER_DAYS,
+                 CART_ARCHIVE_AFTER_DAYS, CART_ARCHIVE_BATCH_SIZE)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Move stale carts and their items to the archive tables')
+    parser.add_argument('--abandoned-after', type=float,
+                        default=CART_ABANDONED_AFTER_DAYS,
+                        help='Days without changes before an active cart is archived')
+    parser.add_argument('--checked-out-after', type=float,
+                        default=CART_ARCHIVE_AFTER_DAYS,
+                        help='Days after checkout before a cart is archived')
+    parser.add_argument('--batch-size', type=int,
+                        default=CART_ARCHIVE_BATCH_SIZE,
+                        help='Carts moved per transaction')
+    parser.add_argument('--max-batches', type=int, default=None,
+                        help='Stop after this many batches per status')
+    args = parser.parse_args()
+
+    runs = [
+        ('active', args.abandoned_after),
+        ('checked_out', args.checked_out_after),
+    ]
+
+    with app.app_context():
+        db.create_all()
+
+        for status, days in runs:
+            def report(archived, total, status=status):
+                print(f"{status}: archived {archived}/{total} cart(s)")
+
+            archived = archive_stale_carts(
+                status, timedelta(days=days), args.batch_size,
+                args.max_batches, progress=report)
+            print(f"{status}: {archived} cart(s) older than {days:g} day(s) archived")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
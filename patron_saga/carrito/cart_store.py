@@ -0,0 +1,270 @@
+"""
+Storage for active carts.
+
+By default carts live in the SQL tables. With CART_STORE=memory or
+CART_STORE=redis, active carts are kept in a key-value store instead. Each
+cart is stored as one JSON document with its items, so a cart edit is a
+single read and write with no SQL involved. The SQL tables are written
+behind: on checkout, and when a cart has been idle for CART_IDLE_TIMEOUT
+seconds (see flush_idle_carts in app.py).
+
+Stores only deal with plain dicts, so they do not depend on the models.
+Every cart carries a version; writes pass the version they read and fail
+if the stored cart has moved on (compare-and-swap), so concurrent edits of
+the same cart never overwrite each other.
+
+MemoryCartStore keeps everything in the process: carts do not survive a
+crash and are not shared between instances. RedisCartStore talks to any
+server speaking the Redis protocol and is shared by all instances.
+"""
+
+import abc
+import json
+import threading
+import time
+
+# Writes a cart and keeps the product index in step with its items.
+# ARGV[3] is the expected version, '' to write unconditionally, or 'nx' to
+# write only if no cart with that ID is stored
+WRITE_CART = """
+local current = redis.call('GET', KEYS[1])
+if ARGV[3] == 'nx' then
+    if current then
+        return 0
+    end
+elseif ARGV[3] ~= '' then
+    if not current or cjson.decode(current)['version'] ~= tonumber(ARGV[3]) then
+        return 0
+    end
+end
+local function products(document)
+    local ids = {}
+    if document then
+        for _, item in ipairs(cjson.decode(document)['items'] or {}) do
+            ids[tostring(item['product_id'])] = true
+        end
+    end
+    return ids
+end
+local old, new = products(current), products(ARGV[1])
+for id in pairs(old) do
+    if not new[id] then
+        redis.call('SREM', ARGV[5] .. id, ARGV[2])
+    end
+end
+for id in pairs(new) do
+    redis.call('SADD', ARGV[5] .. id, ARGV[2])
+end
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[2])
+return 1
+"""
+
+# Deletes a cart and its product index entries. With ARGV[1], only if the
+# stored cart is still that document
+DELETE_CART = """
+local current = redis.call('GET', KEYS[1])
+if not current or (ARGV[1] ~= '' and current ~= ARGV[1]) then
+    return 0
+end
+for _, item in ipairs(cjson.decode(current)['items'] or {}) do
+    redis.call('SREM', ARGV[3] .. tostring(item['product_id']), ARGV[2])
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[2])
+return 1
+"""
+
+
+class CartStore(abc.ABC):
+    """Interface for active cart storage"""
+
+    @abc.abstractmethod
+    def get(self, cart_id):
+        """Return the cart dict, or None"""
+
+    @abc.abstractmethod
+    def put(self, cart, expected_version=None):
+        """
+        Store the cart dict (keyed by cart['id']). With expected_version,
+        only if the stored cart still has that version. Returns whether the
+        cart was written.
+        """
+
+    @abc.abstractmethod
+    def add(self, cart):
+        """Store the cart dict unless a cart with that ID is stored already"""
+
+    @abc.abstractmethod
+    def delete(self, cart_id):
+        """Remove the cart, if stored"""
+
+    @abc.abstractmethod
+    def delete_if_unchanged(self, cart):
+        """Delete the cart unless it was modified after cart was read"""
+
+    @abc.abstractmethod
+    def idle_cart_ids(self, idle_for, limit=100):
+        """IDs of carts not written in the last idle_for seconds"""
+
+    @abc.abstractmethod
+    def cart_ids(self):
+        """IDs of all stored carts"""
+
+    @abc.abstractmethod
+    def cart_ids_with_product(self, product_id):
+        """IDs of the stored carts holding product_id"""
+
+
+class MemoryCartStore(CartStore):
+
+    def __init__(self):
+        # cart_id -> (json document, last write time)
+        self._carts = {}
+        # product_id -> IDs of the carts holding it
+        self._carts_by_product = {}
+        self._lock = threading.Lock()
+
+    def get(self, cart_id):
+        with self._lock:
+            entry = self._carts.get(cart_id)
+        return json.loads(entry[0]) if entry else None
+
+    def put(self, cart, expected_version=None):
+        document = json.dumps(cart)
+        with self._lock:
+            if expected_version is not None:
+                entry = self._carts.get(cart['id'])
+                if entry is None or \
+                        json.loads(entry[0])['version'] != expected_version:
+                    return False
+            self._write(cart, document)
+            return True
+
+    def add(self, cart):
+        document = json.dumps(cart)
+        with self._lock:
+            if cart['id'] in self._carts:
+                return False
+            self._write(cart, document)
+            return True
+
+    def delete(self, cart_id):
+        with self._lock:
+            self._remove(cart_id)
+
+    def delete_if_unchanged(self, cart):
+        document = json.dumps(cart)
+        with self._lock:
+            entry = self._carts.get(cart['id'])
+            if entry is None or entry[0] != document:
+                return False
+            self._remove(cart['id'])
+            return True
+
+    def idle_cart_ids(self, idle_for, limit=100):
+        cutoff = time.time() - idle_for
+        with self._lock:
+            idle = [cart_id for cart_id, (_, written_at) in self._carts.items()
+                    if written_at < cutoff]
+        return idle[:limit]
+
+    def cart_ids(self):
+        with self._lock:
+            return list(self._carts)
+
+    def cart_ids_with_product(self, product_id):
+        with self._lock:
+            return list(self._carts_by_product.get(str(product_id), ()))
+
+    def _write(self, cart, document):
+        self._unindex(cart['id'])
+        self._carts[cart['id']] = (document, time.time())
+        for item in cart.get('items', []):
+            self._carts_by_product.setdefault(
+                str(item['product_id']), set()).add(cart['id'])
+
+    def _remove(self, cart_id):
+        self._unindex(cart_id)
+        self._carts.pop(cart_id, None)
+
+    def _unindex(self, cart_id):
+        entry = self._carts.get(cart_id)
+        if entry is None:
+            return
+        for item in json.loads(entry[0]).get('items', []):
+            cart_ids = self._carts_by_product.get(str(item['product_id']))
+            if cart_ids is not None:
+                cart_ids.discard(cart_id)
+                if not cart_ids:
+                    del self._carts_by_product[str(item['product_id'])]
+
+
+class RedisCartStore(CartStore):
+
+    def __init__(self, client, prefix='cart:'):
+        self.client = client
+        self.prefix = prefix
+        # Sorted set of cart IDs scored by last write time
+        self.index_key = f'{prefix}written'
+        # One set of cart IDs per product, kept up to date by the scripts
+        self.product_prefix = f'{prefix}product:'
+
+    def _key(self, cart_id):
+        return f'{self.prefix}{cart_id}'
+
+    def get(self, cart_id):
+        document = self.client.get(self._key(cart_id))
+        return json.loads(document) if document else None
+
+    def put(self, cart, expected_version=None):
+        return self._write(
+            cart, '' if expected_version is None else expected_version)
+
+    def add(self, cart):
+        return self._write(cart, 'nx')
+
+    def delete(self, cart_id):
+        self.client.eval(DELETE_CART, 2, self._key(cart_id), self.index_key,
+                         '', cart_id, self.product_prefix)
+
+    def delete_if_unchanged(self, cart):
+        return bool(self.client.eval(
+            DELETE_CART, 2, self._key(cart['id']), self.index_key,
+            json.dumps(cart), cart['id'], self.product_prefix))
+
+    def _write(self, cart, condition):
+        return bool(self.client.eval(
+            WRITE_CART, 2, self._key(cart['id']), self.index_key,
+            json.dumps(cart), cart['id'], condition, time.time(),
+            self.product_prefix))
+
+    def idle_cart_ids(self, idle_for, limit=100):
+        cart_ids = self.client.zrangebyscore(
+            self.index_key, '-inf', time.time() - idle_for, start=0, num=limit)
+        return [cart_id.decode() if isinstance(cart_id, bytes) else cart_id
+                for cart_id in cart_ids]
+
+    def cart_ids(self):
+        return [cart_id.decode() if isinstance(cart_id, bytes) else cart_id
+                for cart_id in self.client.zrange(self.index_key, 0, -1)]
+
+    def cart_ids_with_product(self, product_id):
+        return [cart_id.decode() if isinstance(cart_id, bytes) else cart_id
+                for cart_id in self.client.smembers(
+                    f'{self.product_prefix}{product_id}')]
+
+
+def create_cart_store(kind, redis_url=None):
+    """Build the store named by CART_STORE, or None for plain SQL"""
+    if not kind or kind == 'sql':
+        return None
+    if kind == 'memory':
+        return MemoryCartStore()
+    if kind == 'redis':
+        try:
+            import redis
+        except ImportError:
+            raise Exception("CART_STORE=redis requires the redis package")
+        return RedisCartStore(redis.Redis.from_url(redis_url))
+    raise Exception(f"Unknown cart store: {kind}")
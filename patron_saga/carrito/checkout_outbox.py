@@ -0,0 +1,227 @@
+"""
+Outbox for dispatching checkout sagas.
+
+saga_checkout stores a CheckoutDispatch row with a saga ID generated here
+and answers 202 right away, instead of calling the orchestrator or the
+coordinator while the client waits. CheckoutDispatchRelay delivers pending
+rows from a background thread:
+
+- orchestrated: POST to the orchestrator's /saga/checkout with the saga ID
+- choreographed: POST to the coordinator's /saga/choreography/checkout, which
+  records the saga state before publishing checkout.initiated, so the
+  coordinator knows the saga when inventory.reserved comes back
+
+Rows are claimed (claim token and time, committed) before the HTTP calls,
+which run outside any transaction; the outcome is recorded afterwards in a
+short transaction of its own. A claim older than a whole batch can take
+belongs to a relay that died mid-batch and is taken over. Both receivers
+ignore a saga ID they already know, so delivery is at least once. A cart has at most one checkout in flight: saga_checkout refuses a
+cart with a pending dispatch, or one dispatched within the saga timeout.
+Connection errors and 5xx responses are retried with exponential backoff
+until max_attempts; 4xx responses fail the dispatch immediately.
+"""
+
+import math
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from app import db
+
+
+class CheckoutDispatch(db.Model):
+    __tablename__ = 'checkout_dispatches'
+
+    saga_id = db.Column(db.String(36), primary_key=True)
+    cart_id = db.Column(db.String(36), nullable=False, index=True)
+    saga_pattern = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+
+    status = db.Column(db.String(20), default='pending',
+                       nullable=False)  # pending, dispatched, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow,
+                                nullable=False)
+    last_error = db.Column(db.Text)
+    # Set by the relay delivering the row, cleared when it records the outcome
+    claim_token = db.Column(db.String(36))
+    claimed_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    dispatched_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_checkout_dispatches_status_next_attempt',
+                 'status', 'next_attempt_at'),
+        # At most one undelivered checkout per cart, even for requests
+        # racing past the check in saga_checkout
+        db.Index('uq_checkout_dispatches_pending_cart', 'cart_id',
+                 unique=True,
+                 postgresql_where=db.text("status = 'pending'"),
+                 sqlite_where=db.text("status = 'pending'")),
+    )
+
+
+def add_checkout_dispatch(saga_id, cart_id, saga_pattern, payload):
+    """Add a checkout dispatch to the outbox in the current transaction"""
+    dispatch = CheckoutDispatch(
+        saga_id=saga_id,
+        cart_id=cart_id,
+        saga_pattern=saga_pattern,
+        payload=payload
+    )
+    db.session.add(dispatch)
+    return dispatch
+
+
+def active_checkout_dispatch(cart_id, saga_timeout):
+    """
+    The checkout of the cart still on its way (pending) or whose saga may
+    still be running (dispatched less than saga_timeout seconds ago), if any
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=saga_timeout)
+    return CheckoutDispatch.query.filter(
+        CheckoutDispatch.cart_id == cart_id,
+        db.or_(CheckoutDispatch.status == 'pending',
+               db.and_(CheckoutDispatch.status == 'dispatched',
+                       CheckoutDispatch.dispatched_at > cutoff))
+    ).first()
+
+
+class DispatchRejected(Exception):
+    """The receiver refused the checkout; retrying will not help"""
+
+
+class CheckoutDispatchRelay:
+
+    def __init__(self, app, session, orchestrator_url, coordinator_url,
+                 num_workers=4, batch_size=50,
+                 poll_interval=0.5, timeout=10, max_attempts=10,
+                 retry_base=1, retry_max=300):
+        self.app = app
+        self.session = session
+        self.orchestrator_url = orchestrator_url
+        self.coordinator_url = coordinator_url
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        # Longest a batch can take, one timeout per round of workers; an older
+        # claim belongs to a relay that died mid-batch
+        self.claim_timeout = 2 * timeout * math.ceil(batch_size / num_workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix='checkout-dispatch')
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='checkout-dispatch-relay', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+
+    def relay_once(self):
+        """Deliver the due dispatches, returning how many were delivered"""
+        with self.app.app_context():
+            try:
+                claim_token, dispatches = self._claim()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error claiming checkout dispatches: {str(e)}")
+                return 0
+
+        # Deliveries run concurrently and outside any transaction; a slow
+        # receiver only delays this batch, never a request thread
+        futures = [(saga_id, self._executor.submit(
+            self._deliver, saga_pattern, payload))
+            for saga_id, saga_pattern, payload in dispatches]
+        outcomes = [(saga_id, future.exception())
+                    for saga_id, future in futures]
+
+        with self.app.app_context():
+            try:
+                delivered = 0
+                for saga_id, error in outcomes:
+                    # Skip a row another relay took over as a stale claim
+                    dispatch = CheckoutDispatch.query.filter_by(
+                        saga_id=saga_id, claim_token=claim_token).first()
+                    if dispatch is None:
+                        continue
+                    self._record_attempt(dispatch, error)
+                    if error is None:
+                        delivered += 1
+
+                db.session.commit()
+                return delivered
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error recording checkout dispatches: {str(e)}")
+                return 0
+
+    def _claim(self):
+        """Mark a batch of due dispatches as ours and return what to send"""
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.claim_timeout)
+        # SKIP LOCKED lets several carrito instances claim from the outbox
+        # without waiting on each other
+        dispatches = CheckoutDispatch.query.filter(
+            CheckoutDispatch.status == 'pending',
+            CheckoutDispatch.next_attempt_at <= now,
+            db.or_(CheckoutDispatch.claim_token.is_(None),
+                   CheckoutDispatch.claimed_at < stale)
+        ).order_by(CheckoutDispatch.created_at)\
+            .limit(self.batch_size)\
+            .with_for_update(skip_locked=True)\
+            .all()
+
+        claim_token = str(uuid.uuid4())
+        for dispatch in dispatches:
+            dispatch.claim_token = claim_token
+            dispatch.claimed_at = now
+        claimed = [(dispatch.saga_id, dispatch.saga_pattern, dispatch.payload)
+                   for dispatch in dispatches]
+        db.session.commit()
+        return claim_token, claimed
+
+    def _deliver(self, saga_pattern, payload):
+        if saga_pattern == 'orchestrated':
+            url = f"{self.orchestrator_url}/saga/checkout"
+        else:
+            url = f"{self.coordinator_url}/saga/choreography/checkout"
+
+        response = self.session.post(url, json=payload, timeout=self.timeout)
+        if 400 <= response.status_code < 500:
+            raise DispatchRejected(
+                f"{response.status_code}: {response.text[:500]}")
+        response.raise_for_status()
+
+    def _record_attempt(self, dispatch, error):
+        now = datetime.utcnow()
+        dispatch.attempts += 1
+        dispatch.claim_token = None
+        if error is None:
+            dispatch.status = 'dispatched'
+            dispatch.dispatched_at = now
+            dispatch.last_error = None
+        elif isinstance(error, DispatchRejected) or \
+                dispatch.attempts >= self.max_attempts:
+            dispatch.status = 'failed'
+            dispatch.last_error = str(error)
+        else:
+            delay = min(self.retry_base * 2 ** (dispatch.attempts - 1),
+                        self.retry_max)
+            dispatch.next_attempt_at = now + timedelta(seconds=delay)
+            dispatch.last_error = str(error)
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.relay_once() < self.batch_size:
+                self._stop.wait(self.poll_interval)
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings for carrito
+
+    gunicorn --config gunicorn.conf.py app:app
+
+Background threads started before the fork would only exist in the master,
+so each worker starts its own once it has loaded the app.
+
+CART_STORE=memory keeps carts inside one process, so it is refused with more
+than one worker: a cart created on one worker would not exist on the others.
+"""
+
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+
+
+def on_starting(server):
+    if os.getenv('CART_STORE', 'sql') == 'memory' and server.cfg.workers > 1:
+        # gunicorn reports RuntimeError and exits
+        raise RuntimeError(
+            'CART_STORE=memory keeps carts in one process; run a single '
+            'worker (GUNICORN_WORKERS=1) or use CART_STORE=redis')
+
+
+def post_worker_init(worker):
+    from app import start_background_workers
+    start_background_workers()
@@ -0,0 +1,121 @@
+"""
+In-process cache of product information from inventario.
+
+Entries are fresh for ttl seconds. After that they are served stale for up to
+stale_ttl more seconds while a background refresh runs, so cart edits rarely
+wait on inventario. Concurrent misses for the same product share a single
+load (single-flight). Entries are dropped early by invalidate(), which the
+saga handler calls when inventario publishes product change events.
+
+Misses (loader returning None) are not cached, so a product created after a
+failed lookup is visible immediately.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class ProductCache:
+
+    def __init__(self, loader, ttl=30, stale_ttl=300, max_entries=10000,
+                 refresh_workers=4):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.refresh_workers = refresh_workers
+
+        # product_id -> (value, fresh_until, stale_until), in LRU order
+        self._entries = OrderedDict()
+        # product_id -> Future of the load in progress
+        self._loading = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def get(self, product_id):
+        """Return the product info for product_id, loading it if needed"""
+        key = str(product_id)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, fresh_until, stale_until = entry
+                if now < fresh_until:
+                    self._entries.move_to_end(key)
+                    return value
+                if now < stale_until:
+                    self._entries.move_to_end(key)
+                    self._start_load(key, background=True)
+                    return value
+
+            future, leader = self._start_load(key)
+
+        if leader:
+            self._load(key, future)
+        return future.result()
+
+    def invalidate(self, product_id):
+        with self._lock:
+            self._entries.pop(str(product_id), None)
+            # Loads started before the invalidation must not store old data
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'loading': len(self._loading),
+                'max_entries': self.max_entries
+            }
+
+    def _start_load(self, key, background=False):
+        """Join the load in progress for key or start one (lock held)"""
+        future = self._loading.get(key)
+        if future is not None:
+            return future, False
+
+        future = Future()
+        self._loading[key] = future
+        if background:
+            self._get_executor().submit(self._load, key, future)
+            return future, False
+        return future, True
+
+    def _load(self, key, future):
+        with self._lock:
+            generation = self._generation
+
+        try:
+            value = self.loader(key)
+        except Exception as e:
+            with self._lock:
+                self._loading.pop(key, None)
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            self._loading.pop(key, None)
+            if value is not None and generation == self._generation:
+                now = time.monotonic()
+                self._entries[key] = (value, now + self.ttl,
+                                      now + self.ttl + self.stale_ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        future.set_result(value)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.refresh_workers,
+                thread_name_prefix='product-refresh')
+        return self._executor
@@ -1,7 +1,16 @@
 from flask import Blueprint, request, jsonify
-from app import db, Order, Cart
+from app import (db, Order, CartConflict, product_cache, load_cart,
+                 check_out_cart, reopen_cart, release_cart, reprice_product,
+                 serialize_cart, http)
+from checkout_outbox import (CheckoutDispatch, CheckoutDispatchRelay,
+                             active_checkout_dispatch, add_checkout_dispatch)
+import base64
+import threading
+import time
 import uuid
 from datetime import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 import sys
 import os
 
@@ -11,7 +20,7 @@ sys.path.append(os.path.join(os.path.dirname(
 
 try:
     from event_bus import (
-        event_bus, SagaEvent,
+        EventBus, SagaEvent,
         publish_order_created, publish_order_create_failed,
         publish_order_cancelled
     )
@@ -22,6 +31,13 @@ except ImportError:
 
 saga_bp = Blueprint('saga', __name__)
 
+ORCHESTRATOR_URL = os.getenv('ORCHESTRATOR_URL', 'http://localhost:3003')
+CHOREOGRAPHY_URL = os.getenv('CHOREOGRAPHY_URL', 'http://localhost:3004')
+SAGA_PATTERNS = ('orchestrated', 'choreographed')
+# A dispatched checkout keeps other checkouts of its cart out for this long
+# (seconds), the time its saga is given to finish
+CHECKOUT_SAGA_TIMEOUT = float(os.getenv('CHECKOUT_SAGA_TIMEOUT', 300))
+
 # Models for Saga support
 
 
@@ -42,6 +58,12 @@ class SagaOrder(db.Model):
     updated_at = db.Column(
         db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # Order history (GET /users/<user_id>/orders)
+        db.Index('ix_saga_orders_user_id_created_at',
+                 'user_id', 'created_at', 'id'),
+    )
+
 # Orchestrated Saga Endpoints
 
 
@@ -58,7 +80,7 @@ def create_saga_order():
         saga_id = data.get('saga_id')
 
         # Check if cart exists
-        cart = Cart.query.get(cart_id)
+        cart = load_cart(cart_id)
         if not cart:
             return jsonify({'error': 'Cart not found'}), 404
 
@@ -76,9 +98,14 @@ def create_saga_order():
         db.session.add(order)
 
         # Update cart status
-        cart.status = 'checked_out'
+        try:
+            check_out_cart(cart)
+        except CartConflict:
+            db.session.rollback()
+            return jsonify({'error': 'Cart is not active or was modified'}), 409
 
         db.session.commit()
+        release_cart(cart_id)
 
         return jsonify({
             'order_id': order.id,
@@ -109,9 +136,7 @@ def cancel_saga_order(order_id):
         order.status = 'cancelled'
 
         # Restore cart status if needed
-        cart = Cart.query.get(order.cart_id)
-        if cart:
-            cart.status = 'active'
+        reopen_cart(order.cart_id)
 
         db.session.commit()
 
@@ -152,27 +177,44 @@ def confirm_saga_order(order_id):
 
 
 class CartSagaHandler:
-    def __init__(self):
-        if CHOREOGRAPHY_ENABLED:
-            self.setup_event_handlers()
+    def __init__(self, event_bus):
+        # The consumer's own connection; pika connections are not thread safe
+        self.event_bus = event_bus
 
     def setup_event_handlers(self):
         """Setup event handlers for choreographed saga"""
 
         # Subscribe to order create request
-        event_bus.subscribe_to_event(
+        self.event_bus.subscribe_to_event(
             SagaEvent.ORDER_CREATE_REQUESTED,
             self.handle_order_create_requested,
             "cart_order_create_requested"
         )
 
         # Subscribe to order cancel request (compensation)
-        event_bus.subscribe_to_event(
+        self.event_bus.subscribe_to_event(
             SagaEvent.ORDER_CANCEL_REQUESTED,
             self.handle_order_cancel_requested,
             "cart_order_cancel_requested"
         )
 
+        # Product changes invalidate the local product cache. Every instance
+        # has its own cache, so each one needs its own queue, which goes away
+        # with the instance
+        self.event_bus.subscribe_to_event(
+            "product.*",
+            self.handle_product_changed,
+            exclusive=True
+        )
+
+        # Repricing writes shared state, so it is done once, from a durable
+        # queue shared by all instances that keeps events while none is up
+        self.event_bus.subscribe_to_event(
+            SagaEvent.PRODUCT_UPDATED,
+            self.handle_product_price_changed,
+            "cart_product_repricing"
+        )
+
     def handle_order_create_requested(self, event):
         """Handle order creation request"""
         data = event['data']
@@ -184,7 +226,7 @@ class CartSagaHandler:
 
         try:
             # Check if cart exists
-            cart = Cart.query.get(cart_id)
+            cart = load_cart(cart_id)
             if not cart:
                 publish_order_create_failed(saga_id, 'Cart not found')
                 return
@@ -202,9 +244,16 @@ class CartSagaHandler:
             db.session.add(order)
 
             # Update cart status
-            cart.status = 'checked_out'
+            try:
+                check_out_cart(cart)
+            except CartConflict:
+                db.session.rollback()
+                publish_order_create_failed(
+                    saga_id, 'Cart is not active or was modified')
+                return
 
             db.session.commit()
+            release_cart(cart_id)
 
             # Publish success event
             publish_order_created(saga_id, order.id)
@@ -233,9 +282,7 @@ class CartSagaHandler:
             order.status = 'cancelled'
 
             # Restore cart status
-            cart = Cart.query.get(order.cart_id)
-            if cart:
-                cart.status = 'active'
+            reopen_cart(order.cart_id)
 
             db.session.commit()
 
@@ -246,6 +293,19 @@ class CartSagaHandler:
             db.session.rollback()
             print(f"Error cancelling order: {str(e)}")
 
+    def handle_product_changed(self, event):
+        """Drop a changed or deleted product from the product cache"""
+        product_cache.invalidate(event['data']['product_id'])
+
+    def handle_product_price_changed(self, event):
+        """Apply a new price to the active carts holding the product"""
+        data = event['data']
+        if data.get('price') is None:
+            return
+        # An error nacks the event: it is redelivered once, then moved to
+        # the dead letter queue
+        reprice_product(data['product_id'], data['price'])
+
 # Status endpoints
 
 
@@ -273,6 +333,90 @@ def get_saga_orders_by_cart(cart_id):
     })
 
 
+def encode_order_cursor(order):
+    """Opaque cursor pointing just past the given order history entry"""
+    raw = f"{order['created_at']}|{order['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_order_cursor(cursor):
+    """Decode an order history cursor into (created_at, order_id)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, order_id = raw.split('|', 1)
+        return datetime.fromisoformat(created_at), order_id
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+
+
+def serialize_user_order(order, order_type):
+    """Common shape for orders and saga orders in the order history"""
+    return {
+        'id': order.id,
+        'type': order_type,
+        'cart_id': order.cart_id,
+        'saga_id': getattr(order, 'saga_id', None),
+        'user_id': order.user_id,
+        'total_amount': str(order.total_amount),
+        'payment_id': order.payment_id,
+        'payment_method': getattr(order, 'payment_method', None),
+        'status': order.status,
+        'created_at': order.created_at.isoformat()
+    }
+
+
+def get_user_orders(user_id, limit, cursor=None):
+    """
+    Orders and saga orders of a user, newest first, at most limit of them.
+
+    Each table is read with the same keyset condition on its
+    (user_id, created_at, id) index, limited to limit rows, and the two
+    sorted runs are merged, so a page costs the same however long the
+    history is.
+    """
+    def newest(model, order_type):
+        query = model.query.filter(model.user_id == user_id)
+        if cursor is not None:
+            created_at, order_id = cursor
+            query = query.filter(or_(
+                model.created_at < created_at,
+                and_(model.created_at == created_at, model.id < order_id)
+            ))
+        return [(order.created_at, order.id,
+                 serialize_user_order(order, order_type))
+                for order in query.order_by(model.created_at.desc(),
+                                            model.id.desc()).limit(limit)]
+
+    merged = sorted(newest(Order, 'order') + newest(SagaOrder, 'saga'),
+                    key=lambda entry: entry[:2], reverse=True)
+    return [entry[2] for entry in merged[:limit]]
+
+
+@saga_bp.route('/users/<user_id>/orders', methods=['GET'])
+def get_user_order_history(user_id):
+    """
+    Order history of a user (orders and saga orders), newest first.
+    Pass cursor (the next_cursor of the previous page) for the next page.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        cursor = request.args.get('cursor')
+        cursor = decode_order_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # One extra entry tells whether another page exists
+    orders = get_user_orders(user_id, limit + 1, cursor)
+    has_more = len(orders) > limit
+    orders = orders[:limit]
+
+    return jsonify({
+        'user_id': user_id,
+        'orders': orders,
+        'next_cursor': encode_order_cursor(orders[-1]) if has_more else None
+    })
+
+
 @saga_bp.route('/orders/saga/<saga_id>/status', methods=['GET'])
 def get_saga_order_by_saga_id(saga_id):
     """Get saga order by saga ID"""
@@ -299,85 +443,137 @@ def get_saga_order_by_saga_id(saga_id):
 
 @saga_bp.route('/checkout/saga', methods=['POST'])
 def saga_checkout():
-    """Enhanced checkout that can work with both saga patterns"""
+    """
+    Start a checkout saga with either pattern. The saga is handed to the
+    checkout dispatch outbox and the response (202) does not wait for the
+    orchestrator or coordinator. A cart whose checkout is still in flight
+    is refused with 409.
+    """
     try:
-        data = request.json
+        data = request.get_json(silent=True) or {}
+        missing = [field for field in
+                   ('cart_id', 'user_id', 'payment_method', 'billing_address')
+                   if not data.get(field)]
+        if missing:
+            return jsonify({'error': f"Missing fields: {', '.join(missing)}"}), 400
+
         cart_id = data['cart_id']
-        user_id = data['user_id']
-        payment_method = data['payment_method']
-        billing_address = data['billing_address']
         # orchestrated or choreographed
         saga_pattern = data.get('saga_pattern', 'orchestrated')
+        if saga_pattern not in SAGA_PATTERNS:
+            return jsonify({'error': 'Invalid saga pattern. Use "orchestrated" or "choreographed"'}), 400
 
         # Check if cart exists and has items
-        cart = Cart.query.get(cart_id)
+        cart = load_cart(cart_id)
         if not cart:
             return jsonify({'error': 'Cart not found'}), 404
 
+        if cart.status != 'active':
+            return jsonify({'error': 'Cart is not active'}), 400
+
         if not cart.items:
             return jsonify({'error': 'Cart is empty'}), 400
 
+        in_flight = active_checkout_dispatch(cart_id, CHECKOUT_SAGA_TIMEOUT)
+        if in_flight:
+            return jsonify({'error': 'Checkout already in progress',
+                            'saga_id': in_flight.saga_id}), 409
+
+        price_version = data.get('price_version', cart.price_version)
+        if price_version != cart.price_version:
+            return jsonify({'error': 'Cart prices changed',
+                            'cart': serialize_cart(cart)}), 409
+
         total_amount = sum(float(item.unit_price) *
                            item.quantity for item in cart.items)
 
-        if saga_pattern == 'orchestrated':
-            # Call orchestrator service
-            import requests
-            orchestrator_url = os.getenv(
-                'ORCHESTRATOR_URL', 'http://localhost:3003')
-
-            response = requests.post(f"{orchestrator_url}/saga/checkout", json={
-                'cart_id': cart_id,
-                'user_id': user_id,
-                'payment_method': payment_method,
-                'billing_address': billing_address
-            })
-
-            if response.status_code == 201:
-                return jsonify({
-                    'checkout_type': 'orchestrated_saga',
-                    'saga_id': response.json()['saga_id'],
-                    'cart_id': cart_id,
-                    'total_amount': total_amount,
-                    'status': 'initiated'
-                }), 201
-            else:
-                return jsonify({'error': 'Failed to initiate orchestrated saga'}), 500
-
-        elif saga_pattern == 'choreographed':
-            # Call choreography coordinator
-            import requests
-            coordinator_url = os.getenv(
-                'CHOREOGRAPHY_URL', 'http://localhost:3004')
-
-            response = requests.post(f"{coordinator_url}/saga/choreography/checkout", json={
-                'cart_id': cart_id,
-                'user_id': user_id,
-                'payment_method': payment_method,
-                'billing_address': billing_address
-            })
-
-            if response.status_code == 201:
-                return jsonify({
-                    'checkout_type': 'choreographed_saga',
-                    'saga_id': response.json()['saga_id'],
-                    'cart_id': cart_id,
-                    'total_amount': total_amount,
-                    'status': 'initiated'
-                }), 201
-            else:
-                return jsonify({'error': 'Failed to initiate choreographed saga'}), 500
-
-        else:
-            return jsonify({'error': 'Invalid saga pattern. Use "orchestrated" or "choreographed"'}), 400
+        saga_id = str(uuid.uuid4())
+        add_checkout_dispatch(saga_id, cart_id, saga_pattern, {
+            'saga_id': saga_id,
+            'cart_id': cart_id,
+            'user_id': data['user_id'],
+            'payment_method': data['payment_method'],
+            'billing_address': data['billing_address'],
+            'total_amount': total_amount
+        })
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another request queued a checkout of this cart meanwhile
+            db.session.rollback()
+            in_flight = active_checkout_dispatch(cart_id, CHECKOUT_SAGA_TIMEOUT)
+            return jsonify({'error': 'Checkout already in progress',
+                            'saga_id': in_flight.saga_id if in_flight else None}), 409
+
+        return jsonify({
+            'checkout_type': f'{saga_pattern}_saga',
+            'saga_id': saga_id,
+            'cart_id': cart_id,
+            'total_amount': total_amount,
+            'status': 'accepted',
+            'status_url': f'/checkout/saga/{saga_id}'
+        }), 202
 
     except Exception as e:
+        db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
-# Initialize saga handler
-if CHOREOGRAPHY_ENABLED:
-    cart_saga_handler = CartSagaHandler()
+@saga_bp.route('/checkout/saga/<saga_id>', methods=['GET'])
+def get_saga_checkout(saga_id):
+    """Dispatch status of a checkout saga started by saga_checkout"""
+    dispatch = db.session.get(CheckoutDispatch, saga_id)
+    if not dispatch:
+        return jsonify({'error': 'Checkout saga not found'}), 404
+
+    return jsonify({
+        'saga_id': dispatch.saga_id,
+        'cart_id': dispatch.cart_id,
+        'saga_pattern': dispatch.saga_pattern,
+        'dispatch_status': dispatch.status,
+        'attempts': dispatch.attempts,
+        'last_error': dispatch.last_error,
+        'created_at': dispatch.created_at.isoformat(),
+        'dispatched_at': dispatch.dispatched_at.isoformat() if dispatch.dispatched_at else None
+    })
+
+
+def start_checkout_dispatch_relay(app):
+    """Start delivering checkout dispatches to the saga services"""
+    relay = CheckoutDispatchRelay(
+        app, http, ORCHESTRATOR_URL, CHOREOGRAPHY_URL)
+    relay.start()
+    return relay
+
+
+def start_saga_event_consumer(app, retry_interval=5):
+    """
+    Consume the saga and product events handled by carrito on a background
+    thread with its own bus connection, reconnecting when it drops
+    """
+    if not CHOREOGRAPHY_ENABLED:
+        return None
+
+    def run():
+        while True:
+            bus = EventBus()
+            try:
+                CartSagaHandler(bus).setup_event_handlers()
+                with app.app_context():
+                    bus.start_consuming()
+            except Exception as e:
+                print(f"Saga event consumer stopped: {str(e)}")
+            finally:
+                try:
+                    bus.close()
+                except Exception:
+                    pass
+            time.sleep(retry_interval)
+
+    thread = threading.Thread(
+        target=run, name='cart-saga-events', daemon=True)
+    thread.start()
+    return thread
 
 # Health check
 
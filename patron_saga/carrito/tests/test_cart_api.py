@@ -147,4 +147,787 @@ def test_create_cart_missing_user_id(client):
 def test_get_nonexistent_cart(client):
     """Test getting a cart that doesn't exist"""
     response = client.get('/carts/nonexistent-id')
-    assert response.status_code == 404 
\ No newline at end of file
+    assert response.status_code == 404 
+def create_cart_with_items(client, product_ids):
+    with patch('app.get_product_info') as mock_product_info:
+        with patch('app.check_product_availability') as mock_availability:
+            mock_availability.return_value = True
+            create_response = client.post('/carts', json={'user_id': 'test_user'})
+            cart_id = json.loads(create_response.data)['id']
+
+            for product_id in product_ids:
+                mock_product_info.return_value = {
+                    'id': product_id,
+                    'name': f'Product {product_id}',
+                    'price': 10.0
+                }
+                client.post(f'/carts/{cart_id}/items',
+                           json={'product_id': product_id, 'quantity': 1})
+    return cart_id
+
+CHECKOUT_DATA = {
+    'payment_method': 'credit_card',
+    'billing_address': {'street': 'Calle 1', 'city': 'Bogota', 'country': 'CO'}
+}
+
+def test_checkout_uses_batch_availability(client):
+    """Test checkout verifies inventory with a single batch request"""
+    cart_id = create_cart_with_items(client, ['1', '2', '3'])
+
+    batch_response = MagicMock(status_code=200)
+    batch_response.json.return_value = {
+        'items': [
+            {'product_id': 1, 'available': True},
+            {'product_id': 2, 'available': False},
+            {'product_id': 3, 'available': True}
+        ],
+        'all_available': False
+    }
+    with patch('app.http.post', return_value=batch_response) as mock_post:
+        with patch('app.check_product_availability') as mock_availability:
+            response = client.post(f'/carts/{cart_id}/checkout', json=CHECKOUT_DATA)
+
+    assert response.status_code == 400
+    assert json.loads(response.data)['error'] == 'Insufficient inventory for product 2'
+    assert mock_post.call_count == 1
+    assert len(mock_post.call_args.kwargs['json']['items']) == 3
+    mock_availability.assert_not_called()
+
+def test_checkout_checks_availability_concurrently(client):
+    """Test the per-product fallback runs the checks in parallel"""
+    import time
+    import requests
+
+    product_ids = [f'prod{i}' for i in range(8)]
+    cart_id = create_cart_with_items(client, product_ids)
+
+    def slow_check(product_id, quantity, timeout=None):
+        time.sleep(0.2)
+        return product_id != 'prod5'
+
+    with patch('app.http.post', side_effect=requests.exceptions.ConnectionError):
+        with patch('app.check_product_availability', side_effect=slow_check):
+            started = time.monotonic()
+            response = client.post(f'/carts/{cart_id}/checkout', json=CHECKOUT_DATA)
+            elapsed = time.monotonic() - started
+
+    assert response.status_code == 400
+    assert json.loads(response.data)['error'] == 'Insufficient inventory for product prod5'
+    assert elapsed < 8 * 0.2
+
+def test_memory_cart_store_writes_behind_on_checkout(client):
+    """Test active carts stay out of SQL until checkout with the memory store"""
+    from app import Cart, Order
+    from cart_store import MemoryCartStore
+
+    store = MemoryCartStore()
+    with patch('app.cart_store', store):
+        cart_id = create_cart_with_items(client, ['1', '2'])
+
+        with app.app_context():
+            assert db.session.get(Cart, cart_id) is None
+        assert len(store.get(cart_id)['items']) == 2
+
+        data = json.loads(client.get(f'/carts/{cart_id}').data)
+        assert len(data['items']) == 2
+
+        with patch('app.check_products_availability', return_value=[]):
+            with patch('app.process_payment') as mock_payment:
+                mock_payment.return_value = {'payment_id': 'pay1', 'status': 'success'}
+                response = client.post(f'/carts/{cart_id}/checkout', json=CHECKOUT_DATA)
+
+        assert response.status_code == 200
+        assert store.get(cart_id) is None
+        with app.app_context():
+            cart = db.session.get(Cart, cart_id)
+            assert cart.status == 'checked_out'
+            assert len(cart.items) == 2
+            assert Order.query.filter_by(cart_id=cart_id).count() == 1
+
+def test_checkout_claims_cart_before_charging(client):
+    """Test a cart edited during checkout is never charged for"""
+    from sqlalchemy import update
+    from app import Cart, Order
+
+    cart_id = create_cart_with_items(client, ['1'])
+
+    def edit_cart(items, *args, **kwargs):
+        # Another request changes the cart while inventory is checked
+        db.session.execute(update(Cart).where(Cart.id == cart_id)
+                           .values(version=Cart.version + 1)
+                           .execution_options(synchronize_session=False))
+        return []
+
+    with patch('app.check_products_availability', side_effect=edit_cart):
+        with patch('app.process_payment') as mock_payment:
+            response = client.post(f'/carts/{cart_id}/checkout', json=CHECKOUT_DATA)
+
+    assert response.status_code == 409
+    mock_payment.assert_not_called()
+
+    def pay(amount, payment_method, billing_address):
+        # The cart is already claimed: edits made now would conflict
+        assert db.session.get(Cart, cart_id).status == 'checked_out'
+        return {'payment_id': 'pay1', 'status': 'success'}
+
+    with patch('app.check_products_availability', return_value=[]):
+        with patch('app.process_payment', side_effect=pay):
+            response = client.post(f'/carts/{cart_id}/checkout', json=CHECKOUT_DATA)
+
+    assert response.status_code == 200
+    with app.app_context():
+        assert Order.query.filter_by(cart_id=cart_id).one().payment_id == 'pay1'
+
+def test_checkout_reopens_cart_when_payment_fails(client):
+    """Test a cart claimed by a checkout is active again if the payment fails"""
+    from app import Cart, Order
+
+    cart_id = create_cart_with_items(client, ['1'])
+    with patch('app.check_products_availability', return_value=[]):
+        with patch('app.process_payment', return_value=None):
+            response = client.post(f'/carts/{cart_id}/checkout', json=CHECKOUT_DATA)
+
+    assert response.status_code == 400
+    with app.app_context():
+        assert db.session.get(Cart, cart_id).status == 'active'
+        assert Order.query.filter_by(cart_id=cart_id).count() == 0
+    assert json.loads(client.get(f'/carts/{cart_id}').data)['status'] == 'active'
+
+def test_memory_cart_store_flushes_idle_carts(client):
+    """Test idle carts are written to SQL and reloaded on the next access"""
+    import app as cart_app
+    from app import Cart
+    from cart_store import MemoryCartStore
+
+    store = MemoryCartStore()
+    with patch('app.cart_store', store):
+        cart_id = create_cart_with_items(client, ['1'])
+
+        with app.app_context():
+            assert cart_app.flush_idle_carts(idle_for=0) == 1
+            assert len(db.session.get(Cart, cart_id).items) == 1
+        assert store.get(cart_id) is None
+
+        item_id = json.loads(client.get(f'/carts/{cart_id}').data)['items'][0]['id']
+        assert store.get(cart_id) is not None
+
+        response = client.delete(f'/carts/{cart_id}/items/{item_id}')
+        assert response.status_code == 200
+
+        with app.app_context():
+            assert cart_app.flush_idle_carts(idle_for=0) == 1
+            assert len(db.session.get(Cart, cart_id).items) == 0
+
+def test_cart_serializer_matches_schema(client):
+    """Test the hand-built cart serializer matches CartSchema"""
+    from app import Cart, cart_schema, serialize_cart
+
+    cart_id = create_cart_with_items(client, ['1', '2'])
+    with app.app_context():
+        cart = db.session.get(Cart, cart_id)
+        expected = json.loads(app.json.dumps(cart_schema.dump(cart)))
+        assert json.loads(app.json.dumps(serialize_cart(cart))) == expected
+
+def test_get_cart_reuses_snapshot_until_cart_changes(client):
+    """Test cart reads are served from the snapshot cache until an edit"""
+    import app as cart_app
+
+    cart_id = create_cart_with_items(client, ['1'])
+    first = json.loads(client.get(f'/carts/{cart_id}').data)
+
+    with patch('app.serialize_cart', wraps=cart_app.serialize_cart) as mock_serialize:
+        assert json.loads(client.get(f'/carts/{cart_id}').data) == first
+        mock_serialize.assert_not_called()
+
+    item_id = first['items'][0]['id']
+    with patch('app.check_product_availability', return_value=True):
+        client.put(f'/carts/{cart_id}/items/{item_id}', json={'quantity': 4})
+
+    data = json.loads(client.get(f'/carts/{cart_id}').data)
+    assert data['items'][0]['quantity'] == 4
+
+def test_bulk_upsert_cart_items(client):
+    """Test setting several item quantities in one request"""
+    cart_id = create_cart_with_items(client, ['1', '2'])
+
+    def product_info(product_id):
+        if product_id == 'missing':
+            return None
+        return {'id': product_id, 'name': f'Product {product_id}', 'price': 5.0}
+
+    with patch('app.get_product_info', side_effect=product_info):
+        with patch('app.check_products_availability', return_value=['4']) as mock_check:
+            response = client.put(f'/carts/{cart_id}/items:bulk', json={'items': [
+                {'product_id': '1', 'quantity': 3},
+                {'product_id': '2', 'quantity': 0},
+                {'product_id': '3', 'quantity': 2},
+                {'product_id': '4', 'quantity': 1},
+                {'product_id': 'missing', 'quantity': 1},
+                {'product_id': '3', 'quantity': 5},
+                {'quantity': 1}
+            ]})
+
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert [r['status'] for r in data['results']] == [
+        'updated', 'removed', 'added', 'rejected', 'rejected', 'invalid', 'invalid']
+    assert data['accepted_items'] == 3
+    assert data['rejected_items'] == 4
+    mock_check.assert_called_once_with([('1', 3), ('3', 2), ('4', 1)])
+
+    quantities = {item['product_id']: item['quantity']
+                  for item in json.loads(client.get(f'/carts/{cart_id}').data)['items']}
+    assert quantities == {'1': 3, '3': 2}
+
+def test_bulk_upsert_requires_items(client):
+    """Test bulk upsert rejects a body without items"""
+    cart_id = json.loads(client.post('/carts', json={'user_id': 'test_user'}).data)['id']
+    response = client.put(f'/carts/{cart_id}/items:bulk', json={'items': []})
+    assert response.status_code == 400
+
+def test_save_cart_detects_concurrent_change(client):
+    """Test a cart write fails if the cart version moved since it was read"""
+    from sqlalchemy import update
+    from app import Cart, CartConflict, load_cart, save_cart
+
+    cart_id = create_cart_with_items(client, ['1'])
+    with app.app_context():
+        cart = load_cart(cart_id)
+        version = cart.version
+        # Another writer, behind the loaded cart's back
+        db.session.execute(
+            update(Cart).where(Cart.id == cart_id).values(version=Cart.version + 1),
+            execution_options={'synchronize_session': False})
+
+        cart.items[0].quantity = 7
+        with pytest.raises(CartConflict):
+            save_cart(cart)
+
+        cart = load_cart(cart_id)
+        assert cart.version == version
+        assert cart.items[0].quantity == 1
+
+def test_add_item_retries_after_concurrent_edit(client):
+    """Test an add that loses a race is retried on the latest cart"""
+    from cart_store import MemoryCartStore
+
+    store = MemoryCartStore()
+    with patch('app.cart_store', store):
+        cart_id = create_cart_with_items(client, ['1'])
+        calls = []
+
+        def concurrent_add(product_id, quantity, timeout=None):
+            if not calls:
+                # Another request adds 5 while this one is in flight
+                data = store.get(cart_id)
+                data['items'][0]['quantity'] += 5
+                data['version'] += 1
+                store.put(data)
+            calls.append(quantity)
+            return True
+
+        with patch('app.get_product_info', return_value={'id': '1', 'price': 10.0}):
+            with patch('app.check_product_availability', side_effect=concurrent_add):
+                response = client.post(f'/carts/{cart_id}/items',
+                                       json={'product_id': '1', 'quantity': 2})
+
+        assert response.status_code == 201
+        assert calls == [3, 8]
+        assert json.loads(response.data)['items'][0]['quantity'] == 8
+        assert store.get(cart_id)['items'][0]['quantity'] == 8
+
+def test_saga_checkout_returns_before_dispatch(client):
+    """Test saga checkout is queued in the outbox and answered with 202"""
+    from checkout_outbox import CheckoutDispatch
+
+    cart_id = create_cart_with_items(client, ['1'])
+    with patch('app.http.post') as mock_post:
+        response = client.post('/checkout/saga', json={
+            'cart_id': cart_id,
+            'user_id': 'test_user',
+            'payment_method': 'credit_card',
+            'billing_address': CHECKOUT_DATA['billing_address']
+        })
+    mock_post.assert_not_called()
+
+    assert response.status_code == 202
+    data = json.loads(response.data)
+    assert data['status'] == 'accepted'
+    with app.app_context():
+        dispatch = db.session.get(CheckoutDispatch, data['saga_id'])
+        assert dispatch.status == 'pending'
+        assert dispatch.payload['total_amount'] == 10.0
+
+    status = json.loads(client.get(data['status_url']).data)
+    assert status['dispatch_status'] == 'pending'
+
+def test_saga_checkout_refuses_cart_already_in_flight(client):
+    """Test a second checkout of a cart is refused while the first is in flight"""
+    from datetime import datetime, timedelta
+    from checkout_outbox import CheckoutDispatch
+
+    cart_id = create_cart_with_items(client, ['1'])
+    checkout = {
+        'cart_id': cart_id,
+        'user_id': 'test_user',
+        'payment_method': 'credit_card',
+        'billing_address': CHECKOUT_DATA['billing_address']
+    }
+    first = client.post('/checkout/saga', json=checkout)
+    assert first.status_code == 202
+    saga_id = json.loads(first.data)['saga_id']
+
+    second = client.post('/checkout/saga', json=checkout)
+    assert second.status_code == 409
+    assert json.loads(second.data)['saga_id'] == saga_id
+
+    with app.app_context():
+        dispatch = db.session.get(CheckoutDispatch, saga_id)
+        dispatch.status = 'dispatched'
+        dispatch.dispatched_at = datetime.utcnow()
+        db.session.commit()
+    assert client.post('/checkout/saga', json=checkout).status_code == 409
+
+    # The saga had time to finish and left the cart active: it failed
+    with app.app_context():
+        dispatch = db.session.get(CheckoutDispatch, saga_id)
+        dispatch.dispatched_at = datetime.utcnow() - timedelta(hours=1)
+        db.session.commit()
+    assert client.post('/checkout/saga', json=checkout).status_code == 202
+
+    with app.app_context():
+        assert CheckoutDispatch.query.filter_by(cart_id=cart_id).count() == 2
+
+    # Two requests that both passed the check: the index keeps one
+    with patch('saga_endpoints.active_checkout_dispatch', return_value=None):
+        racing = client.post('/checkout/saga', json=checkout)
+    assert racing.status_code == 409
+
+
+def test_checkout_dispatch_relay_delivers_and_retries(client):
+    """Test the relay delivers dispatches, retrying server errors only"""
+    from checkout_outbox import CheckoutDispatch, CheckoutDispatchRelay, add_checkout_dispatch
+
+    with app.app_context():
+        CheckoutDispatch.query.delete()
+        for saga_id in ('ok', 'busy', 'bad'):
+            add_checkout_dispatch(saga_id, f'cart-{saga_id}', 'orchestrated', {'saga_id': saga_id})
+        db.session.commit()
+
+    def post(url, json=None, timeout=None):
+        status_code = {'ok': 201, 'busy': 503, 'bad': 400}[json['saga_id']]
+        response = MagicMock(status_code=status_code, text='error')
+        if status_code >= 500:
+            import requests
+            response.raise_for_status.side_effect = requests.exceptions.HTTPError('503')
+        return response
+
+    session = MagicMock()
+    session.post.side_effect = post
+    relay = CheckoutDispatchRelay(app, session, 'http://orchestrator', 'http://coordinator')
+    assert relay.relay_once() == 1
+
+    with app.app_context():
+        statuses = {d.saga_id: (d.status, d.attempts)
+                    for d in CheckoutDispatch.query.all()}
+    assert statuses == {'ok': ('dispatched', 1), 'busy': ('pending', 1), 'bad': ('failed', 1)}
+    assert session.post.call_args_list[0].args[0] == 'http://orchestrator/saga/checkout'
+
+    # The retry is not due yet
+    assert relay.relay_once() == 0
+    assert session.post.call_count == 3
+
+
+def test_checkout_dispatch_relay_claims_before_posting(client):
+    """Test dispatches are claimed and committed before the HTTP calls"""
+    from datetime import datetime, timedelta
+    from checkout_outbox import CheckoutDispatch, CheckoutDispatchRelay, add_checkout_dispatch
+
+    with app.app_context():
+        CheckoutDispatch.query.delete()
+        add_checkout_dispatch('claimed', 'cart-claimed', 'orchestrated', {'saga_id': 'claimed'})
+        db.session.commit()
+
+    seen = []
+
+    def post(url, json=None, timeout=None):
+        # Runs with no relay transaction open: the claim is already visible,
+        # and another relay leaves the row alone
+        with app.app_context():
+            seen.append(db.session.get(CheckoutDispatch, 'claimed').claim_token)
+        seen.append(other.relay_once())
+        return MagicMock(status_code=201)
+
+    session = MagicMock()
+    session.post.side_effect = post
+    relay = CheckoutDispatchRelay(app, session, 'http://orchestrator', 'http://coordinator')
+    other = CheckoutDispatchRelay(app, session, 'http://orchestrator', 'http://coordinator')
+    assert relay.relay_once() == 1
+    assert seen[0] is not None and seen[1] == 0
+
+    with app.app_context():
+        dispatch = db.session.get(CheckoutDispatch, 'claimed')
+        assert (dispatch.status, dispatch.claim_token) == ('dispatched', None)
+
+        # A claim left by a relay that died mid-batch is taken over
+        add_checkout_dispatch('orphan', 'cart-orphan', 'orchestrated', {'saga_id': 'orphan'})
+        db.session.flush()
+        orphan = db.session.get(CheckoutDispatch, 'orphan')
+        orphan.claim_token = 'dead-relay'
+        orphan.claimed_at = datetime.utcnow() - timedelta(
+            seconds=relay.claim_timeout + 1)
+        db.session.commit()
+
+    session.post.side_effect = None
+    session.post.return_value = MagicMock(status_code=201)
+    assert relay.relay_once() == 1
+    with app.app_context():
+        assert db.session.get(CheckoutDispatch, 'orphan').status == 'dispatched'
+
+
+def test_choreographed_dispatch_goes_through_coordinator(client):
+    """Test choreographed checkouts are posted to the coordinator, not the bus"""
+    from checkout_outbox import CheckoutDispatch, CheckoutDispatchRelay, add_checkout_dispatch
+
+    with app.app_context():
+        CheckoutDispatch.query.delete()
+        add_checkout_dispatch('choreo', 'cart-choreo', 'choreographed', {'saga_id': 'choreo'})
+        db.session.commit()
+
+    session = MagicMock()
+    session.post.return_value = MagicMock(status_code=201)
+    relay = CheckoutDispatchRelay(app, session, 'http://orchestrator', 'http://coordinator')
+    assert relay.relay_once() == 1
+    session.post.assert_called_once_with(
+        'http://coordinator/saga/choreography/checkout',
+        json={'saga_id': 'choreo'}, timeout=relay.timeout)
+
+def test_archive_stale_carts_moves_carts_in_batches(client):
+    """Test stale carts and their items move to the archive, batch by batch"""
+    from datetime import datetime, timedelta
+    from sqlalchemy import update
+    from app import Cart, CartItem, ArchivedCart, ArchivedCartItem, archive_stale_carts
+
+    stale_ids = [create_cart_with_items(client, ['1', '2']) for _ in range(3)]
+    fresh_id = create_cart_with_items(client, ['1'])
+    with app.app_context():
+        db.session.execute(
+            update(Cart).where(Cart.id.in_(stale_ids))
+            .values(updated_at=datetime.utcnow() - timedelta(days=40)))
+        db.session.commit()
+
+        progress = []
+        archived = archive_stale_carts(
+            'active', timedelta(days=30), batch_size=2,
+            progress=lambda done, total: progress.append((done, total)))
+
+        assert archived == 3
+        assert progress == [(2, 3), (3, 3)]
+        assert Cart.query.filter(Cart.id.in_(stale_ids)).count() == 0
+        assert CartItem.query.filter(CartItem.cart_id.in_(stale_ids)).count() == 0
+        assert ArchivedCartItem.query.filter(
+            ArchivedCartItem.cart_id.in_(stale_ids)).count() == 6
+        assert db.session.get(ArchivedCart, stale_ids[0]).status == 'abandoned'
+        assert db.session.get(Cart, fresh_id) is not None
+
+        # Nothing left to do on the next run
+        assert archive_stale_carts('active', timedelta(days=30)) == 0
+
+    # Archived carts are still readable
+    response = client.get(f'/carts/{stale_ids[0]}')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['status'] == 'abandoned'
+    assert len(data['items']) == 2
+
+def test_user_order_history_pages_across_order_tables(client):
+    """Test order history merges orders and saga orders, newest first, by cursor"""
+    from datetime import datetime, timedelta
+    from app import Order
+    from saga_endpoints import SagaOrder
+
+    start = datetime(2024, 1, 1)
+    with app.app_context():
+        for i in range(3):
+            db.session.add(Order(id=f'order-{i}', cart_id='c', user_id='history_user',
+                                 total_amount=10, status='paid',
+                                 created_at=start + timedelta(hours=2 * i)))
+            db.session.add(SagaOrder(id=f'saga-{i}', cart_id='c', user_id='history_user',
+                                     total_amount=20, status='confirmed',
+                                     created_at=start + timedelta(hours=2 * i + 1)))
+        db.session.add(Order(id='other-user', cart_id='c', user_id='someone_else',
+                             total_amount=10, status='paid', created_at=start))
+        db.session.commit()
+
+    seen = []
+    cursor = None
+    while True:
+        url = '/users/history_user/orders?limit=4'
+        if cursor:
+            url += f'&cursor={cursor}'
+        data = json.loads(client.get(url).data)
+        seen.append([(order['type'], order['id']) for order in data['orders']])
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+
+    assert seen == [
+        [('saga', 'saga-2'), ('order', 'order-2'), ('saga', 'saga-1'), ('order', 'order-1')],
+        [('saga', 'saga-0'), ('order', 'order-0')]
+    ]
+
+    response = client.get('/users/history_user/orders?cursor=not-a-cursor')
+    assert response.status_code == 400
+
+def test_reprice_product_updates_active_carts(client):
+    """Test a price change reprices active carts and bumps their price_version"""
+    from app import Cart, reprice_product
+
+    cart_id = create_cart_with_items(client, ['reprice-1', 'reprice-2'])
+    other_id = create_cart_with_items(client, ['reprice-2'])
+    before = json.loads(client.get(f'/carts/{cart_id}').data)
+    with app.app_context():
+        db.session.get(Cart, other_id).status = 'checked_out'
+        db.session.commit()
+
+        assert reprice_product('reprice-1', 12.5) == 1
+        # Same price again: nothing to do
+        assert reprice_product('reprice-1', 12.5) == 0
+
+    data = json.loads(client.get(f'/carts/{cart_id}').data)
+    prices = {item['product_id']: item['unit_price'] for item in data['items']}
+    assert prices == {'reprice-1': '12.50', 'reprice-2': '10.00'}
+    assert data['price_version'] == before['price_version'] + 1
+    assert data['version'] == before['version'] + 1
+    assert data['updated_at'] == before['updated_at']
+    other = json.loads(client.get(f'/carts/{other_id}').data)
+    assert other['items'][0]['unit_price'] == '10.00'
+
+    # A checkout against the old prices is refused before any remote call
+    with patch('app.check_products_availability') as mock_availability:
+        response = client.post(f'/carts/{cart_id}/checkout', json=dict(
+            CHECKOUT_DATA, price_version=before['price_version']))
+    assert response.status_code == 409
+    assert json.loads(response.data)['cart']['price_version'] == data['price_version']
+    mock_availability.assert_not_called()
+
+def test_reprice_product_updates_stored_carts(client):
+    """Test repricing also applies to carts held in the cart store"""
+    from cart_store import MemoryCartStore
+    from app import reprice_product
+
+    store = MemoryCartStore()
+    with patch('app.cart_store', store):
+        cart_id = create_cart_with_items(client, ['stored-1'])
+        with app.app_context():
+            assert reprice_product('stored-1', 9) == 1
+
+    data = store.get(cart_id)
+    assert data['items'][0]['unit_price'] == '9.00'
+    assert data['price_version'] == 1
+
+def test_memory_cart_store_indexes_carts_by_product():
+    """Test the store finds carts by product as their items change"""
+    from cart_store import MemoryCartStore
+
+    store = MemoryCartStore()
+    cart = {'id': 'c1', 'version': 1, 'items': [{'product_id': 'p1'}]}
+    store.add(cart)
+    store.add({'id': 'c2', 'version': 1, 'items': [{'product_id': 'p1'}]})
+    assert sorted(store.cart_ids_with_product('p1')) == ['c1', 'c2']
+
+    cart = dict(cart, version=2, items=[{'product_id': 'p2'}])
+    assert store.put(cart, expected_version=1)
+    assert store.cart_ids_with_product('p1') == ['c2']
+    assert store.cart_ids_with_product('p2') == ['c1']
+
+    assert store.delete_if_unchanged(cart)
+    store.delete('c2')
+    assert store.cart_ids_with_product('p1') == []
+    assert store.cart_ids_with_product('p2') == []
+
+def test_gunicorn_worker_starts_checkout_dispatch_relay(client):
+    """Test a gunicorn worker starts the relay that delivers saga checkouts"""
+    import os
+    import runpy
+    import time
+    import app as carrito
+    from checkout_outbox import CheckoutDispatch
+
+    config = runpy.run_path(os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gunicorn.conf.py'))
+    cart_id = create_cart_with_items(client, ['1'])
+
+    with patch.object(carrito.http, 'post', return_value=MagicMock(status_code=201)) as mock_post:
+        config['post_worker_init'](MagicMock())
+        try:
+            response = client.post('/checkout/saga', json={
+                'cart_id': cart_id,
+                'user_id': 'test_user',
+                'payment_method': 'credit_card',
+                'billing_address': CHECKOUT_DATA['billing_address']
+            })
+            saga_id = json.loads(response.data)['saga_id']
+
+            status = None
+            deadline = time.monotonic() + 10
+            while status != 'dispatched' and time.monotonic() < deadline:
+                time.sleep(0.1)
+                with app.app_context():
+                    status = db.session.get(CheckoutDispatch, saga_id).status
+        finally:
+            carrito.checkout_dispatch_relay.stop()
+            carrito.checkout_dispatch_relay = None
+
+    assert status == 'dispatched'
+    assert any(call.kwargs['json']['saga_id'] == saga_id
+               for call in mock_post.call_args_list)
+
+
+RUN_AS_MAIN_AND_CALL_SAGA = """
+import json
+import runpy
+from unittest.mock import patch
+import flask
+
+# Same startup as `python app.py`, without serving
+with patch.object(flask.Flask, 'run'):
+    module = runpy.run_path('app.py', run_name='__main__')
+
+client = module['app'].test_client()
+cart = client.post('/carts', json={'user_id': 'boot_user'}).get_json()
+checkout = client.post('/checkout/saga', json={
+    'cart_id': cart['id'], 'user_id': 'boot_user',
+    'payment_method': 'credit_card', 'billing_address': {'city': 'Bogota'}})
+status = client.get('/checkout/saga/unknown-saga')
+print(json.dumps({'checkout': checkout.status_code,
+                  'checkout_body': checkout.get_json(),
+                  'status': status.status_code}))
+"""
+
+def test_saga_routes_work_when_run_as_script():
+    """Test the saga blueprint shares the app and database of `python app.py`"""
+    import os
+    import subprocess
+    import sys
+
+    result = subprocess.run(
+        [sys.executable, '-c', RUN_AS_MAIN_AND_CALL_SAGA],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=dict(os.environ, DATABASE_URL='sqlite:///:memory:'),
+        capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+    outcome = json.loads(result.stdout.strip().splitlines()[-1])
+    assert outcome['checkout'] == 400, outcome
+    assert outcome['checkout_body']['error'] == 'Cart is empty'
+    assert outcome['status'] == 404, outcome
+
+def test_gunicorn_config_starts_flusher_and_guards_memory_store():
+    """Test workers start the cart flusher, and memory carts need one worker"""
+    import os
+    import runpy
+    import app as carrito
+
+    config = runpy.run_path(os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'gunicorn.conf.py'))
+
+    with patch.object(carrito, 'cart_flusher_started', False), \
+            patch.object(carrito, 'start_checkout_dispatch_relay', None), \
+            patch.object(carrito, 'start_cart_flusher') as mock_flusher:
+        config['post_worker_init'](MagicMock())
+        config['post_worker_init'](MagicMock())
+    mock_flusher.assert_called_once()
+
+    server = MagicMock()
+    server.cfg.workers = 4
+    with patch.dict(os.environ, {'CART_STORE': 'memory'}):
+        with pytest.raises(RuntimeError):
+            config['on_starting'](server)
+        server.cfg.workers = 1
+        config['on_starting'](server)
+    server.cfg.workers = 4
+    with patch.dict(os.environ, {'CART_STORE': 'redis'}):
+        config['on_starting'](server)
+
+def test_product_events_use_private_queue():
+    """Test cache invalidation consumes from an exclusive, server-named queue"""
+    import saga_endpoints
+
+    bus = MagicMock()
+    with patch.object(saga_endpoints, 'SagaEvent', MagicMock(), create=True):
+        saga_endpoints.CartSagaHandler(bus).setup_event_handlers()
+
+    product_calls = [call for call in bus.subscribe_to_event.call_args_list
+                     if call.args[0] == 'product.*']
+    assert len(product_calls) == 1
+    assert product_calls[0].kwargs == {'exclusive': True}
+    assert len(product_calls[0].args) == 2
+
+def test_repricing_consumes_shared_durable_queue():
+    """Test repricing runs once per event, from a named queue shared by instances"""
+    import saga_endpoints
+
+    bus = MagicMock()
+    saga_event = MagicMock(PRODUCT_UPDATED='product.updated')
+    with patch.object(saga_endpoints, 'SagaEvent', saga_event, create=True):
+        handler = saga_endpoints.CartSagaHandler(bus)
+        handler.setup_event_handlers()
+
+    calls = [call for call in bus.subscribe_to_event.call_args_list
+             if call.args[0] == 'product.updated']
+    assert len(calls) == 1
+    assert calls[0].args[2] == 'cart_product_repricing'
+    assert not calls[0].kwargs.get('exclusive')
+
+    event = {'event_type': 'product.updated',
+             'data': {'product_id': '7', 'price': 12.5}}
+    with patch('saga_endpoints.reprice_product') as mock_reprice, \
+            patch('saga_endpoints.product_cache') as mock_cache:
+        handler.handle_product_changed(event)
+        mock_reprice.assert_not_called()
+        mock_cache.invalidate.assert_called_once_with('7')
+
+        handler.handle_product_price_changed(event)
+        mock_reprice.assert_called_once_with('7', 12.5)
+
+def test_background_workers_start_saga_event_consumer():
+    """Test each serving process consumes saga events on its own connection"""
+    import threading
+    import time
+    import app as carrito
+    import saga_endpoints
+
+    # Consumes until the end of the test run
+    bus = MagicMock()
+    bus.start_consuming.side_effect = threading.Event().wait
+    with patch.object(saga_endpoints, 'CHOREOGRAPHY_ENABLED', True), \
+            patch.object(saga_endpoints, 'EventBus', return_value=bus, create=True), \
+            patch.object(saga_endpoints, 'SagaEvent', MagicMock(), create=True), \
+            patch.object(carrito, 'saga_event_consumer', None), \
+            patch.object(carrito, 'start_checkout_dispatch_relay', None):
+        carrito.start_background_workers()
+        consumer = carrito.saga_event_consumer
+        carrito.start_background_workers()
+        assert carrito.saga_event_consumer is consumer
+
+        deadline = time.monotonic() + 10
+        while not bus.start_consuming.called and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    bus.start_consuming.assert_called_once()
+    queues = [call.args[2] for call in bus.subscribe_to_event.call_args_list
+              if len(call.args) > 2]
+    assert 'cart_product_repricing' in queues
+
+def test_product_fallback_is_not_cached(client):
+    """Test demo data served while inventario is down is not cached"""
+    import requests
+    from app import get_product_info, product_cache
+
+    product_cache.invalidate('fallback-1')
+    live = MagicMock(status_code=200)
+    live.json.return_value = {'id': 'fallback-1', 'price': 5.0}
+    with patch('app.http.get', side_effect=[requests.exceptions.ConnectionError('down'), live]):
+        assert get_product_info('fallback-1')['price'] == 29.99
+        assert get_product_info('fallback-1')['price'] == 5.0
@@ -0,0 +1,73 @@
+import threading
+import time
+from product_cache import ProductCache
+
+
+def test_fresh_entries_are_served_from_cache():
+    calls = []
+
+    def loader(product_id):
+        calls.append(product_id)
+        return {'id': product_id, 'price': 10.0}
+
+    cache = ProductCache(loader, ttl=60)
+    assert cache.get('1')['price'] == 10.0
+    assert cache.get(1)['price'] == 10.0
+    assert calls == ['1']
+
+
+def test_concurrent_misses_share_one_load():
+    calls = []
+    release = threading.Event()
+
+    def loader(product_id):
+        calls.append(product_id)
+        release.wait(1)
+        return {'id': product_id, 'price': 10.0}
+
+    cache = ProductCache(loader, ttl=60)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('1')))
+               for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(results) == 10
+
+
+def test_stale_entries_are_served_while_refreshing():
+    calls = []
+    refreshed = threading.Event()
+
+    def loader(product_id):
+        calls.append(product_id)
+        if len(calls) > 1:
+            refreshed.set()
+        return {'id': product_id, 'price': 10.0 * len(calls)}
+
+    cache = ProductCache(loader, ttl=0, stale_ttl=60)
+    assert cache.get('1')['price'] == 10.0
+    # Expired but within the stale window: old value now, refresh behind
+    assert cache.get('1')['price'] == 10.0
+    assert refreshed.wait(1)
+    time.sleep(0.05)
+    assert cache.get('1')['price'] == 20.0
+
+
+def test_invalidate_and_misses_are_not_cached():
+    products = {}
+    cache = ProductCache(lambda product_id: products.get(product_id), ttl=60)
+
+    assert cache.get('1') is None
+    products['1'] = {'id': '1', 'price': 10.0}
+    assert cache.get('1')['price'] == 10.0
+
+    products['1'] = {'id': '1', 'price': 15.0}
+    assert cache.get('1')['price'] == 10.0
+    cache.invalidate(1)
+    assert cache.get('1')['price'] == 15.0
@@ -1,11 +1,15 @@
 from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flasgger import Swagger, swag_from
 from marshmallow import Schema, fields, ValidationError, validate
 from flask_cors import CORS
+from sqlalchemy.orm import load_only
+import io
 import os
 from dotenv import load_dotenv
+from bulk import BULK_CHUNK_SIZE, import_products, parse_csv, parse_ndjson
+from models import db, Product
+from search import SEARCH_MAX_RESULTS, search_product_ids
 
 # Load environment variables
 load_dotenv()
@@ -20,7 +24,7 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 
 # Initialize extensions
-db = SQLAlchemy(app)
+db.init_app(app)
 migrate = Migrate(app, db)
 
 # Swagger configuration
@@ -32,36 +36,6 @@ app.config['SWAGGER'] = {
 }
 swagger = Swagger(app)
 
-# Product Model
-
-
-class Product(db.Model):
-    __tablename__ = 'products'
-
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    description = db.Column(db.Text)
-    price = db.Column(db.Numeric(10, 2), nullable=False)
-    quantity = db.Column(db.Integer, nullable=False, default=0)
-    category = db.Column(db.String(50))
-    sku = db.Column(db.String(50), unique=True, nullable=False)
-    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
-    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(
-    ), onupdate=db.func.current_timestamp())
-
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'price': str(self.price),
-            'quantity': self.quantity,
-            'category': self.category,
-            'sku': self.sku,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
-        }
-
 # Marshmallow Schemas
 
 
@@ -71,6 +45,7 @@ class ProductSchema(Schema):
     description = fields.Str(allow_none=True)
     price = fields.Decimal(required=True, places=2)
     quantity = fields.Int(required=True, validate=validate.Range(min=0))
+    reserved_quantity = fields.Int(dump_only=True)
     category = fields.Str(allow_none=True, validate=validate.Length(max=50))
     sku = fields.Str(required=True, validate=validate.Length(min=1, max=50))
     created_at = fields.DateTime(dump_only=True)
@@ -97,27 +72,48 @@ product_update_schema = ProductUpdateSchema()
 @swag_from({
     'tags': ['Products'],
     'summary': 'Get all products',
-    'description': 'Retrieve a list of all products in the inventory',
+    'description': 'Retrieve a list of all products in the inventory. '
+                   'Pass cursor (the next_cursor of the previous page) for '
+                   'keyset pagination, whose cost does not grow with page depth.',
     'parameters': [
         {
             'name': 'page',
             'in': 'query',
             'type': 'integer',
             'default': 1,
-            'description': 'Page number for pagination'
+            'description': 'Page number for pagination (ignored when cursor is given)'
+        },
+        {
+            'name': 'cursor',
+            'in': 'query',
+            'type': 'integer',
+            'description': 'Return products with an ID greater than this one'
         },
         {
             'name': 'per_page',
             'in': 'query',
             'type': 'integer',
             'default': 10,
-            'description': 'Number of items per page'
+            'description': 'Number of items per page (max 100)'
         },
         {
             'name': 'category',
             'in': 'query',
             'type': 'string',
-            'description': 'Filter by category'
+            'description': 'Filter by category (exact match)'
+        },
+        {
+            'name': 'include_total',
+            'in': 'query',
+            'type': 'boolean',
+            'description': 'Count the matching products (default true, '
+                           'false when cursor is given)'
+        },
+        {
+            'name': 'fields',
+            'in': 'query',
+            'type': 'string',
+            'description': 'Comma separated list of fields to return, e.g. id,name,price'
         }
     ],
     'responses': {
@@ -133,37 +129,81 @@ product_update_schema = ProductUpdateSchema()
                     'total': {'type': 'integer'},
                     'page': {'type': 'integer'},
                     'per_page': {'type': 'integer'},
-                    'pages': {'type': 'integer'}
+                    'pages': {'type': 'integer'},
+                    'next_cursor': {'type': 'integer'}
                 }
             }
+        },
+        400: {
+            'description': 'Unknown field requested'
         }
     }
 })
 def get_products():
     page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 10, type=int)
+    per_page = min(max(request.args.get('per_page', 10, type=int), 1), 100)
+    cursor = request.args.get('cursor', type=int)
     category = request.args.get('category')
+    # Cursor paging exists to avoid work that grows with the table, so it
+    # only counts when asked to
+    include_total = request.args.get(
+        'include_total', 'false' if cursor is not None else 'true'
+    ).lower() not in ('false', '0', 'no')
 
+    schema = products_schema
     query = Product.query
 
+    fields_param = request.args.get('fields')
+    if fields_param:
+        requested = {f.strip() for f in fields_param.split(',') if f.strip()}
+        unknown = requested - set(ProductSchema().fields)
+        if unknown:
+            return jsonify({'error': f'Unknown fields: {", ".join(sorted(unknown))}'}), 400
+        schema = ProductSchema(many=True, only=requested)
+        # Only fetch the requested columns (plus the id used for paging)
+        query = query.options(load_only(
+            *[getattr(Product, f) for f in requested | {'id'}]))
+
     if category:
-        query = query.filter(Product.category.ilike(f'%{category}%'))
+        query = query.filter(Product.category == category)
 
-    pagination = query.paginate(
-        page=page,
-        per_page=per_page,
-        error_out=False
-    )
+    total = query.order_by(None).count() if include_total else None
 
-    products = pagination.items
+    query = query.order_by(Product.id)
 
-    return jsonify({
-        'products': products_schema.dump(products),
-        'total': pagination.total,
+    if cursor is not None:
+        # Keyset pagination: seek past the last seen id, fetch one extra row
+        # to know whether another page exists
+        products = query.filter(Product.id > cursor).limit(per_page + 1).all()
+        has_more = len(products) > per_page
+        products = products[:per_page]
+
+        response = {
+            'products': schema.dump(products),
+            'per_page': per_page,
+            'next_cursor': products[-1].id if has_more else None
+        }
+        if include_total:
+            response['total'] = total
+        return jsonify(response)
+
+    # Same extra row as keyset pagination, so a full last page does not
+    # advertise a next_cursor leading to an empty page
+    page = max(page, 1)
+    products = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    has_more = len(products) > per_page
+    products = products[:per_page]
+
+    response = {
+        'products': schema.dump(products),
         'page': page,
         'per_page': per_page,
-        'pages': pagination.pages
-    })
+        'next_cursor': products[-1].id if has_more else None
+    }
+    if include_total:
+        response['total'] = total
+        response['pages'] = (total + per_page - 1) // per_page
+    return jsonify(response)
 
 
 @app.route('/api/products/<int:product_id>', methods=['GET'])
@@ -248,6 +288,81 @@ def create_product():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/products/bulk', methods=['POST'])
+@swag_from({
+    'tags': ['Products'],
+    'summary': 'Bulk import products',
+    'description': 'Stream products as NDJSON (application/x-ndjson) or CSV '
+                   '(text/csv, header row with the product fields). Rows are '
+                   'validated in chunks and upserted by SKU.',
+    'consumes': ['application/x-ndjson', 'text/csv'],
+    'parameters': [
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': True,
+            'schema': {'type': 'string'}
+        },
+        {
+            'name': 'chunk_size',
+            'in': 'query',
+            'type': 'integer',
+            'default': BULK_CHUNK_SIZE,
+            'description': 'Rows validated and written per transaction'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Import summary with per-row errors',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'received': {'type': 'integer'},
+                    'upserted': {'type': 'integer'},
+                    'failed': {'type': 'integer'},
+                    'errors': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'row': {'type': 'integer'},
+                                'errors': {'type': 'object'}
+                            }
+                        }
+                    }
+                }
+            }
+        },
+        415: {
+            'description': 'Unsupported content type'
+        }
+    }
+})
+def bulk_import_products():
+    content_type = request.mimetype
+    if content_type in ('application/x-ndjson', 'application/jsonl'):
+        parser = parse_ndjson
+    elif content_type == 'text/csv':
+        parser = parse_csv
+    else:
+        return jsonify({'error': 'Use application/x-ndjson or text/csv'}), 415
+
+    chunk_size = min(max(request.args.get(
+        'chunk_size', BULK_CHUNK_SIZE, type=int), 1), 10000)
+
+    # Read the body as a stream instead of buffering the whole catalog
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+
+    def notify_changed(products):
+        for product_id, price in products:
+            notify_product_changed(product_id, price)
+
+    summary = import_products(
+        db.session, Product.__table__, product_schema, parser(lines), chunk_size,
+        on_changed=notify_changed)
+    return jsonify(summary)
+
+
 @app.route('/api/products/<int:product_id>', methods=['PUT'])
 @swag_from({
     'tags': ['Products'],
@@ -304,6 +419,7 @@ def update_product(product_id):
         for key, value in data.items():
             setattr(product, key, value)
 
+        notify_product_changed(product.id, product.price)
         db.session.commit()
 
         return jsonify(product_schema.dump(product))
@@ -342,6 +458,7 @@ def delete_product(product_id):
     try:
         product = Product.query.get_or_404(product_id)
         db.session.delete(product)
+        notify_product_changed(product_id, deleted=True)
         db.session.commit()
         return '', 204
 
@@ -354,7 +471,7 @@ def delete_product(product_id):
 @swag_from({
     'tags': ['Products'],
     'summary': 'Search products',
-    'description': 'Search products by name or SKU',
+    'description': 'Ranked prefix search over product name and SKU',
     'parameters': [
         {
             'name': 'q',
@@ -362,11 +479,25 @@ def delete_product(product_id):
             'type': 'string',
             'required': True,
             'description': 'Search query'
+        },
+        {
+            'name': 'page',
+            'in': 'query',
+            'type': 'integer',
+            'default': 1,
+            'description': 'Page number for pagination'
+        },
+        {
+            'name': 'per_page',
+            'in': 'query',
+            'type': 'integer',
+            'default': 20,
+            'description': 'Number of results per page (max 100)'
         }
     ],
     'responses': {
         200: {
-            'description': 'Search results',
+            'description': 'Search results, best match first',
             'schema': {
                 'type': 'array',
                 'items': {'$ref': '#/definitions/Product'}
@@ -375,16 +506,27 @@ def delete_product(product_id):
     }
 })
 def search_products():
-    query = request.args.get('q', '')
+    query = request.args.get('q', '').strip()
     if not query:
         return jsonify([])
 
-    products = Product.query.filter(
-        db.or_(
-            Product.name.ilike(f'%{query}%'),
-            Product.sku.ilike(f'%{query}%')
-        )
-    ).all()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+    offset = (page - 1) * per_page
+    if offset >= SEARCH_MAX_RESULTS:
+        return jsonify([])
+
+    product_ids = search_product_ids(db.session, query, per_page, offset)
+    if not product_ids:
+        return jsonify([])
+
+    # Load the page by primary key and keep the ranking order
+    products_by_id = {
+        product.id: product
+        for product in Product.query.filter(Product.id.in_(product_ids))
+    }
+    products = [products_by_id[pid]
+                for pid in product_ids if pid in products_by_id]
 
     return jsonify(products_schema.dump(products))
 
@@ -410,6 +552,7 @@ def swagger_definitions():
                     'description': {'type': 'string'},
                     'price': {'type': 'string'},
                     'quantity': {'type': 'integer'},
+                    'reserved_quantity': {'type': 'integer'},
                     'category': {'type': 'string'},
                     'sku': {'type': 'string'},
                     'created_at': {'type': 'string'},
@@ -443,7 +586,23 @@ def swagger_definitions():
     })
 
 
+# Register saga blueprint
+try:
+    from saga_endpoints import (saga_bp, notify_product_changed,
+                                start_product_outbox_relay)
+    app.register_blueprint(saga_bp)
+    print("Saga endpoints registered successfully")
+except ImportError as e:
+    print(f"Warning: Could not import saga endpoints: {e}")
+    start_product_outbox_relay = None
+
+    def notify_product_changed(product_id, price=None, deleted=False):
+        pass
+
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+    if start_product_outbox_relay:
+        start_product_outbox_relay(app)
     app.run(debug=True, host='0.0.0.0', port=3001)
@@ -0,0 +1,177 @@
+"""
+Bulk product import for the Product Inventory API.
+
+Records are streamed from NDJSON or CSV, validated in chunks with the
+product schema and upserted by SKU with a single INSERT ... ON CONFLICT per
+chunk. Invalid rows are reported individually and do not stop the import.
+Existing products a chunk changes are reported within its transaction, so
+their events can be written to the outbox with the change.
+"""
+
+import csv
+import json
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from marshmallow import ValidationError
+
+BULK_CHUNK_SIZE = 1000
+
+# Keep the error report bounded on very large, very broken files
+MAX_REPORTED_ERRORS = 1000
+
+UPSERT_COLUMNS = ['name', 'description', 'price', 'quantity', 'category']
+
+
+def parse_ndjson(lines):
+    """Yield (row_number, record, error) for each non-empty NDJSON line"""
+    for row_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row_number, None, f'Invalid JSON: {str(e)}'
+            continue
+        if not isinstance(record, dict):
+            yield row_number, None, 'Each line must be a JSON object'
+            continue
+        yield row_number, record, None
+
+
+def parse_csv(lines):
+    """Yield (row_number, record, error) for each CSV data row"""
+    reader = csv.DictReader(lines)
+    for row_number, row in enumerate(reader, start=1):
+        # Empty cells mean "no value" for the optional columns
+        record = {key: (value if value != '' else None)
+                  for key, value in row.items() if key}
+        yield row_number, record, None
+
+
+def upsert_products(session, table, rows):
+    """
+    Insert rows, updating existing products that share the same SKU. An
+    existing product only gets the columns the row supplies; rows are
+    grouped by those columns, one INSERT ... ON CONFLICT per group.
+    """
+    if not rows:
+        return 0
+
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        insert = postgresql.insert
+    elif dialect == 'sqlite':
+        insert = sqlite.insert
+    else:
+        raise Exception(f'Bulk upsert is not supported on {dialect}')
+
+    groups = {}
+    for row in rows:
+        supplied = tuple(column for column in UPSERT_COLUMNS if column in row)
+        # Every row of an executemany must bind the same parameters; new
+        # products get the column default for what they leave out
+        full_row = {column: column_default(table, column)
+                    for column in UPSERT_COLUMNS}
+        full_row.update(row)
+        groups.setdefault(supplied, []).append(full_row)
+
+    for supplied, group in groups.items():
+        stmt = insert(table)
+        update_columns = {column: stmt.excluded[column] for column in supplied}
+        update_columns['updated_at'] = func.current_timestamp()
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['sku'], set_=update_columns)
+        session.execute(stmt, group)
+    return len(rows)
+
+
+def column_default(table, column):
+    default = table.c[column].default
+    return default.arg if default is not None and default.is_scalar else None
+
+
+def stored_products(session, table, skus):
+    """Stored id and upsert columns of the products with these SKUs, by SKU"""
+    columns = [table.c.id, table.c.sku] + [table.c[column]
+                                           for column in UPSERT_COLUMNS]
+    rows = session.execute(select(*columns).where(table.c.sku.in_(skus)))
+    return {row.sku: row for row in rows}
+
+
+def changed_products(stored, rows_by_sku):
+    """(id, price) of the stored products that the upserted rows modified"""
+    changed = []
+    for sku, row in rows_by_sku.items():
+        current = stored.get(sku)
+        if current is None:
+            continue
+        if any(column in row and row[column] != getattr(current, column)
+               for column in UPSERT_COLUMNS):
+            changed.append((current.id, row.get('price', current.price)))
+    return changed
+
+
+def import_products(session, table, schema, records, chunk_size=BULK_CHUNK_SIZE,
+                    on_changed=None):
+    """
+    Validate and upsert a stream of parsed records, one transaction per chunk.
+    on_changed, if given, is called in each chunk's transaction, before the
+    commit, with the (id, price) of the existing products the chunk modified.
+    """
+    summary = {'received': 0, 'upserted': 0, 'failed': 0, 'errors': []}
+
+    def report(row_number, errors):
+        summary['failed'] += 1
+        if len(summary['errors']) < MAX_REPORTED_ERRORS:
+            summary['errors'].append({'row': row_number, 'errors': errors})
+
+    def flush(chunk):
+        row_numbers = [row_number for row_number, _ in chunk]
+        try:
+            valid = schema.load([record for _, record in chunk], many=True)
+            invalid = {}
+        except ValidationError as err:
+            valid = err.valid_data
+            invalid = err.messages
+
+        rows_by_sku = {}
+        for index, row_number in enumerate(row_numbers):
+            if index in invalid:
+                report(row_number, invalid[index])
+            else:
+                # The last occurrence of a SKU in a chunk wins
+                rows_by_sku[valid[index]['sku']] = valid[index]
+
+        try:
+            stored = stored_products(session, table, list(rows_by_sku)) \
+                if on_changed and rows_by_sku else {}
+            upserted = upsert_products(
+                session, table, list(rows_by_sku.values()))
+            changed = changed_products(stored, rows_by_sku)
+            if changed:
+                on_changed(changed)
+            session.commit()
+            summary['upserted'] += upserted
+        except Exception as e:
+            session.rollback()
+            for index, row_number in enumerate(row_numbers):
+                if index not in invalid:
+                    report(row_number, str(e))
+
+    chunk = []
+    for row_number, record, error in records:
+        summary['received'] += 1
+        if error:
+            report(row_number, error)
+            continue
+        chunk.append((row_number, record))
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+
+    if chunk:
+        flush(chunk)
+
+    summary['errors'].sort(key=lambda error: error['row'])
+    return summary
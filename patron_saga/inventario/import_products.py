@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Bulk product loader for the Product Inventory API
+
+Usage:
+    python import_products.py catalog.ndjson
+    python import_products.py catalog.csv --chunk-size 5000
+"""
+
+import argparse
+import sys
+from app import app, db, Product, product_schema
+from bulk import BULK_CHUNK_SIZE, import_products, parse_csv, parse_ndjson
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Upsert products by SKU from an NDJSON or CSV file')
+    parser.add_argument('path', help='.ndjson/.jsonl or .csv file')
+    parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE,
+                        help='Rows validated and written per transaction')
+    args = parser.parse_args()
+
+    if args.path.endswith('.csv'):
+        parse = parse_csv
+    elif args.path.endswith(('.ndjson', '.jsonl')):
+        parse = parse_ndjson
+    else:
+        print("File must end in .csv, .ndjson or .jsonl")
+        return 1
+
+    with app.app_context():
+        db.create_all()
+
+        with open(args.path, encoding='utf-8', newline='') as f:
+            summary = import_products(
+                db.session, Product.__table__, product_schema,
+                parse(f), args.chunk_size)
+
+    print(f"Received: {summary['received']}")
+    print(f"Upserted: {summary['upserted']}")
+    print(f"Failed:   {summary['failed']}")
+    for error in summary['errors']:
+        print(f"- row {error['row']}: {error['errors']}")
+
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,8 @@ Database initialization script for Product Inventory API
 """
 
 from app import app, db, Product
+from search import create_search_indexes
+from bulk import upsert_products
 from decimal import Decimal
 
 
@@ -15,6 +17,11 @@ def init_database():
         print("Creating database tables...")
         db.create_all()
 
+        # Databases created before the search indexes existed need them too
+        print("Ensuring search indexes...")
+        with db.engine.begin() as connection:
+            create_search_indexes(connection)
+
         # Check if we already have data
         if Product.query.first() is not None:
             print("Database already contains data. Skipping sample data creation.")
@@ -89,11 +96,8 @@ def init_database():
         ]
 
         print("Creating sample products...")
-        for product_data in sample_products:
-            product = Product(**product_data)
-            db.session.add(product)
-
         try:
+            upsert_products(db.session, Product.__table__, sample_products)
             db.session.commit()
             print(
                 f"Successfully created {len(sample_products)} sample products!")
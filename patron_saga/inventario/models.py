@@ -0,0 +1,66 @@
+from datetime import datetime
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from search import on_products_table_created
+
+db = SQLAlchemy()
+
+# Product Model
+
+
+class Product(db.Model):
+    __tablename__ = 'products'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    description = db.Column(db.Text)
+    price = db.Column(db.Numeric(10, 2), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    # Sum of the quantities in 'reserved' reservations, kept up to date by the
+    # saga endpoints so availability is a single-row read
+    reserved_quantity = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
+    category = db.Column(db.String(50), index=True)
+    sku = db.Column(db.String(50), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(
+    ), onupdate=db.func.current_timestamp())
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'description': self.description,
+            'price': str(self.price),
+            'quantity': self.quantity,
+            'reserved_quantity': self.reserved_quantity,
+            'category': self.category,
+            'sku': self.sku,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class ProductOutboxEvent(db.Model):
+    __tablename__ = 'product_outbox_events'
+
+    # Product change events, written in the same transaction as the change
+    # and published by the product outbox relay
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+
+    status = db.Column(db.String(20), default='pending',
+                       nullable=False)  # pending, published
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    published_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_product_outbox_events_status_id', 'status', 'id'),
+    )
+
+
+# Build the search indexes whenever the products table is created
+event.listen(Product.__table__, 'after_create', on_products_table_created)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Reconciliation job for Product.reserved_quantity
+
+Checks the maintained reserved_quantity of every product against the sum of
+its 'reserved' reservations. Run with --fix to correct any drift.
+"""
+
+import sys
+from app import app
+from saga_endpoints import reconcile_reserved_quantities
+
+
+def main():
+    fix = '--fix' in sys.argv[1:]
+
+    with app.app_context():
+        mismatches = reconcile_reserved_quantities(fix=fix)
+
+    if not mismatches:
+        print("reserved_quantity is consistent with the reservation table")
+        return 0
+
+    print(f"Found {len(mismatches)} product(s) with drift:")
+    for mismatch in mismatches:
+        print(
+            f"- product {mismatch['product_id']}: stored {mismatch['stored']}, expected {mismatch['expected']}")
+
+    if fix:
+        print("Drift corrected.")
+        return 0
+
+    print("Run again with --fix to correct it.")
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,6 @@
 from flask import Blueprint, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from app import db, Product
+from models import db, Product
+from product_outbox import ProductOutboxRelay, add_product_event
 import uuid
 from datetime import datetime, timedelta
 import sys
@@ -12,7 +12,7 @@ sys.path.append(os.path.join(os.path.dirname(
 
 try:
     from event_bus import (
-        event_bus, SagaEvent,
+        event_bus, EventBus, SagaEvent,
         publish_inventory_reserved, publish_inventory_reserve_failed,
         publish_inventory_committed, publish_inventory_commit_failed,
         publish_inventory_unreserved
@@ -45,6 +45,70 @@ class InventoryReservation(db.Model):
 
     product = db.relationship('Product', backref='reservations')
 
+
+def adjust_reserved_quantities(reservations, sign):
+    """Add (sign=1) or remove (sign=-1) reservations from Product.reserved_quantity"""
+    totals = {}
+    for reservation in reservations:
+        totals[reservation.product_id] = totals.get(
+            reservation.product_id, 0) + reservation.quantity
+
+    # Atomic increments in the same transaction as the status change, so
+    # concurrent reservations on the same product cannot lose updates
+    for product_id, quantity in totals.items():
+        Product.query.filter_by(id=product_id).update(
+            {Product.reserved_quantity: Product.reserved_quantity + sign * quantity})
+
+
+def transition_reservations(reservations, from_status, to_status):
+    """
+    Move reservations from from_status to to_status, each with a conditional
+    update, and return the ones this call moved. A duplicate or concurrent
+    request finds them already moved, so their quantities are applied once.
+    """
+    moved = []
+    for reservation in reservations:
+        updated = InventoryReservation.query.filter_by(
+            id=reservation.id, status=from_status
+        ).update({InventoryReservation.status: to_status},
+                 synchronize_session=False)
+        if updated:
+            moved.append(reservation)
+    return moved
+
+
+def reconcile_reserved_quantities(fix=False):
+    """Compare Product.reserved_quantity against the reservation table"""
+    actual = db.session.query(
+        InventoryReservation.product_id,
+        db.func.sum(InventoryReservation.quantity).label('quantity')
+    ).filter(
+        InventoryReservation.status == 'reserved'
+    ).group_by(InventoryReservation.product_id).subquery()
+
+    expected_qty = db.func.coalesce(actual.c.quantity, 0)
+    rows = db.session.query(
+        Product.id, Product.reserved_quantity, expected_qty
+    ).outerjoin(
+        actual, actual.c.product_id == Product.id
+    ).filter(Product.reserved_quantity != expected_qty).all()
+
+    mismatches = [
+        {'product_id': product_id, 'stored': stored, 'expected': int(expected)}
+        for product_id, stored, expected in rows
+    ]
+
+    if fix:
+        for mismatch in mismatches:
+            # Apply the difference rather than overwriting, so reservations
+            # committed while reconciling are not lost
+            delta = mismatch['expected'] - mismatch['stored']
+            Product.query.filter_by(id=mismatch['product_id']).update(
+                {Product.reserved_quantity: Product.reserved_quantity + delta})
+        db.session.commit()
+
+    return mismatches
+
 # Orchestrated Saga Endpoints
 
 
@@ -73,6 +137,7 @@ def reserve_inventory():
                 }), 400
 
         # Reserve all items
+        new_reservations = []
         for item in items:
             product = Product.query.get(item['product_id'])
 
@@ -88,12 +153,14 @@ def reserve_inventory():
             product.quantity -= item['quantity']
 
             db.session.add(reservation)
+            new_reservations.append(reservation)
             reservations.append({
                 'reservation_id': reservation.id,
                 'product_id': product.id,
                 'quantity': item['quantity']
             })
 
+        adjust_reserved_quantities(new_reservations, 1)
         db.session.commit()
 
         return jsonify({
@@ -125,14 +192,16 @@ def unreserve_inventory():
         if saga_id:
             reservations = [r for r in reservations if r.saga_id == saga_id]
 
+        reservations = transition_reservations(
+            reservations, 'reserved', 'cancelled')
+        adjust_reserved_quantities(reservations, -1)
+
         # Restore inventory
         for reservation in reservations:
             product = Product.query.get(reservation.product_id)
             if product:
                 product.quantity += reservation.quantity
 
-            reservation.status = 'cancelled'
-
         db.session.commit()
 
         return jsonify({
@@ -163,13 +232,13 @@ def commit_inventory():
         if saga_id:
             reservations = [r for r in reservations if r.saga_id == saga_id]
 
+        reservations = transition_reservations(
+            reservations, 'reserved', 'committed')
         if not reservations:
+            db.session.rollback()
             return jsonify({'error': 'No reservations found for cart'}), 404
 
-        # Commit reservations
-        for reservation in reservations:
-            reservation.status = 'committed'
-
+        adjust_reserved_quantities(reservations, -1)
         db.session.commit()
 
         return jsonify({
@@ -200,14 +269,15 @@ def restore_inventory():
         if saga_id:
             reservations = [r for r in reservations if r.saga_id == saga_id]
 
+        reservations = transition_reservations(
+            reservations, 'committed', 'cancelled')
+
         # Restore inventory
         for reservation in reservations:
             product = Product.query.get(reservation.product_id)
             if product:
                 product.quantity += reservation.quantity
 
-            reservation.status = 'cancelled'
-
         db.session.commit()
 
         return jsonify({
@@ -307,8 +377,9 @@ class InventorySagaHandler:
 
                 product.quantity -= item['quantity']
                 db.session.add(reservation)
-                reservations.append(reservation.id)
+                reservations.append(reservation)
 
+            adjust_reserved_quantities(reservations, 1)
             db.session.commit()
 
             # Publish success event
@@ -333,15 +404,15 @@ class InventorySagaHandler:
                 status='reserved'
             ).all()
 
+            reservations = transition_reservations(
+                reservations, 'reserved', 'committed')
             if not reservations:
+                db.session.rollback()
                 publish_inventory_commit_failed(
                     saga_id, 'No reservations found')
                 return
 
-            # Commit reservations
-            for reservation in reservations:
-                reservation.status = 'committed'
-
+            adjust_reserved_quantities(reservations, -1)
             db.session.commit()
 
             # Publish success event
@@ -365,14 +436,22 @@ class InventorySagaHandler:
                 saga_id=saga_id
             ).filter(InventoryReservation.status.in_(['reserved', 'committed'])).all()
 
+            reserved = transition_reservations(
+                [r for r in reservations if r.status == 'reserved'],
+                'reserved', 'cancelled')
+            committed = transition_reservations(
+                [r for r in reservations if r.status == 'committed'],
+                'committed', 'cancelled')
+
+            # Committed reservations were already released from reserved_quantity
+            adjust_reserved_quantities(reserved, -1)
+
             # Restore inventory
-            for reservation in reservations:
+            for reservation in reserved + committed:
                 product = Product.query.get(reservation.product_id)
                 if product:
                     product.quantity += reservation.quantity
 
-                reservation.status = 'cancelled'
-
             db.session.commit()
 
             # Publish success event
@@ -411,22 +490,97 @@ def get_product_availability(product_id):
     """Get product availability"""
     product = Product.query.get_or_404(product_id)
 
-    # Calculate reserved quantity
-    reserved_qty = db.session.query(
-        db.func.sum(InventoryReservation.quantity)
-    ).filter_by(
-        product_id=product_id,
-        status='reserved'
-    ).scalar() or 0
-
     return jsonify({
         'product_id': product_id,
         'total_quantity': product.quantity,
-        'reserved_quantity': reserved_qty,
+        'reserved_quantity': product.reserved_quantity,
         'available_quantity': product.quantity
     })
 
 
+@saga_bp.route('/api/products/availability:batch', methods=['POST'])
+def get_products_availability_batch():
+    """Get availability for several products with one primary key lookup"""
+    try:
+        data = request.json or {}
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'items must be a non-empty list'}), 400
+
+        # Requests for the same product are checked against their sum
+        requested = {}
+        for item in items:
+            product_id = int(item['product_id'])
+            requested[product_id] = requested.get(
+                product_id, 0) + int(item.get('quantity', 0))
+
+        rows = db.session.query(
+            Product.id,
+            Product.quantity,
+            Product.reserved_quantity
+        ).filter(Product.id.in_(requested.keys())).all()
+
+        found = {product_id: (quantity, reserved_qty)
+                 for product_id, quantity, reserved_qty in rows}
+
+        results = []
+        for product_id, quantity in requested.items():
+            if product_id not in found:
+                results.append({
+                    'product_id': product_id,
+                    'requested_quantity': quantity,
+                    'found': False,
+                    'available': False
+                })
+                continue
+
+            total_qty, reserved_qty = found[product_id]
+            results.append({
+                'product_id': product_id,
+                'requested_quantity': quantity,
+                'found': True,
+                'total_quantity': total_qty,
+                'reserved_quantity': int(reserved_qty),
+                'available_quantity': total_qty,
+                'available': total_qty >= quantity
+            })
+
+        return jsonify({
+            'items': results,
+            'all_available': all(r['available'] for r in results)
+        })
+
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid item: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def notify_product_changed(product_id, price=None, deleted=False):
+    """
+    Tell other services (carrito's cache and carts) that a product changed.
+    The event goes to the outbox in the current transaction; call this
+    before committing the change.
+    """
+    if not CHOREOGRAPHY_ENABLED:
+        return
+
+    add_product_event(
+        SagaEvent.PRODUCT_DELETED if deleted else SagaEvent.PRODUCT_UPDATED,
+        product_id, price)
+
+
+def start_product_outbox_relay(app):
+    """Start publishing product events from the outbox, if the bus is available"""
+    if not CHOREOGRAPHY_ENABLED:
+        return None
+
+    # The relay gets its own connection, separate from the consumer's
+    relay = ProductOutboxRelay(app, EventBus())
+    relay.start()
+    return relay
+
+
 # Initialize saga handler
 if CHOREOGRAPHY_ENABLED:
     inventory_saga_handler = InventorySagaHandler()
@@ -0,0 +1,128 @@
+"""
+Indexed product search for the Product Inventory API.
+
+PostgreSQL uses a GIN index over a tsvector expression (ranked, prefix
+matching through to_tsquery ':*') plus pg_trgm GIN indexes so that substring
+matches on name/SKU are index-assisted. SQLite uses an FTS5 external content
+table kept in sync with triggers, which is what the tests run against.
+"""
+
+import re
+from sqlalchemy import text
+
+# Upper bound on how deep a client can page into search results
+SEARCH_MAX_RESULTS = 1000
+
+SEARCH_DOCUMENT = "coalesce(name, '') || ' ' || coalesce(sku, '')"
+
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"CREATE INDEX IF NOT EXISTS ix_products_search_tsv ON products "
+    f"USING GIN (to_tsvector('simple', {SEARCH_DOCUMENT}))",
+    "CREATE INDEX IF NOT EXISTS ix_products_name_trgm ON products "
+    "USING GIN (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_products_sku_trgm ON products "
+    "USING GIN (sku gin_trgm_ops)",
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5("
+    "name, sku, content='products', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN "
+    "INSERT INTO products_fts(rowid, name, sku) VALUES (new.id, new.name, new.sku); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN "
+    "INSERT INTO products_fts(products_fts, rowid, name, sku) "
+    "VALUES ('delete', old.id, old.name, old.sku); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE ON products BEGIN "
+    "INSERT INTO products_fts(products_fts, rowid, name, sku) "
+    "VALUES ('delete', old.id, old.name, old.sku); "
+    "INSERT INTO products_fts(rowid, name, sku) VALUES (new.id, new.name, new.sku); "
+    "END",
+    "INSERT INTO products_fts(products_fts) VALUES ('rebuild')",
+]
+
+
+def create_search_indexes(connection):
+    """Create the search indexes for the connected database (idempotent)"""
+    dialect = connection.dialect.name
+
+    if dialect == 'postgresql':
+        statements = POSTGRES_DDL
+    elif dialect == 'sqlite':
+        statements = SQLITE_DDL
+    else:
+        return
+
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def on_products_table_created(target, connection, **kw):
+    """SQLAlchemy after_create hook for the products table"""
+    create_search_indexes(connection)
+
+
+def search_terms(query):
+    """Split a user query into word tokens safe to embed in a match expression"""
+    return re.findall(r'\w+', query.lower())
+
+
+def like_pattern(query):
+    """Substring LIKE pattern for the query, its wildcards escaped with \\"""
+    escaped = (query.replace('\\', '\\\\')
+               .replace('%', '\\%').replace('_', '\\_'))
+    return f"%{escaped}%"
+
+
+def search_product_ids(session, query, limit, offset=0):
+    """Return product IDs matching the query, best match first"""
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    # Never scan past the result cap, whatever page was requested
+    limit = max(0, min(limit, SEARCH_MAX_RESULTS - offset))
+    if limit == 0:
+        return []
+
+    dialect = session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        sql = text(f"""
+            SELECT p.id
+            FROM products p, to_tsquery('simple', :tsquery) AS q
+            WHERE to_tsvector('simple', {SEARCH_DOCUMENT}) @@ q
+               OR p.name ILIKE :pattern ESCAPE '\\'
+               OR p.sku ILIKE :pattern ESCAPE '\\'
+            ORDER BY ts_rank(to_tsvector('simple', {SEARCH_DOCUMENT}), q)
+                     + similarity(p.name, :term) DESC, p.id
+            LIMIT :limit OFFSET :offset
+        """)
+        params = {
+            'tsquery': ' & '.join(f'{term}:*' for term in terms),
+            'pattern': like_pattern(query),
+            'term': query,
+        }
+    elif dialect == 'sqlite':
+        sql = text("""
+            SELECT rowid
+            FROM products_fts
+            WHERE products_fts MATCH :match
+            ORDER BY bm25(products_fts), rowid
+            LIMIT :limit OFFSET :offset
+        """)
+        params = {'match': ' '.join(f'"{term}"*' for term in terms)}
+    else:
+        sql = text("""
+            SELECT id FROM products
+            WHERE lower(name) LIKE :pattern ESCAPE '\\'
+               OR lower(sku) LIKE :pattern ESCAPE '\\'
+            ORDER BY id
+            LIMIT :limit OFFSET :offset
+        """)
+        params = {'pattern': like_pattern(query.lower())}
+
+    params.update({'limit': limit, 'offset': offset})
+    return [row[0] for row in session.execute(sql, params)]
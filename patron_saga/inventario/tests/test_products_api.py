@@ -0,0 +1,402 @@
+import os
+import pytest
+import json
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+# The engine is built when app is imported, so the test database has to be
+# chosen before that; drop_all must never reach the real database
+os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
+
+from app import app, db
+from search import like_pattern, search_product_ids
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+
+    with app.test_client() as client:
+        with app.app_context():
+            db.create_all()
+        yield client
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+def create_product(client, name, sku, quantity=10, price=9.99, category='Electronics'):
+    response = client.post('/api/products', json={
+        'name': name,
+        'price': price,
+        'quantity': quantity,
+        'category': category,
+        'sku': sku
+    })
+    assert response.status_code == 201
+    return json.loads(response.data)
+
+
+def test_search_products_prefix(client):
+    """Test prefix search over name and SKU"""
+    create_product(client, 'Gaming Laptop', 'LAPTOP-001')
+    create_product(client, 'Wireless Mouse', 'MOUSE-001')
+
+    response = client.get('/api/products/search?q=lap')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert [p['sku'] for p in data] == ['LAPTOP-001']
+
+    response = client.get('/api/products/search?q=mouse-0')
+    data = json.loads(response.data)
+    assert [p['sku'] for p in data] == ['MOUSE-001']
+
+
+def test_search_products_pagination(client):
+    """Test search pagination and empty queries"""
+    for i in range(5):
+        create_product(client, f'Desk Lamp {i}', f'LAMP-{i:03d}')
+
+    response = client.get('/api/products/search?q=lamp&per_page=2&page=3')
+    data = json.loads(response.data)
+    assert len(data) == 1
+
+    response = client.get('/api/products/search?q=')
+    assert json.loads(response.data) == []
+
+
+def test_search_like_fallback_escapes_wildcards(client):
+    """Test % and _ in a query match literally in the LIKE fallback"""
+    assert like_pattern('50%_off\\') == '%50\\%\\_off\\\\%'
+
+    create_product(client, 'Promo 50% off', 'PROMO_50')
+    create_product(client, 'Promo 500 off', 'PROMO-500')
+
+    with app.app_context():
+        other = SimpleNamespace(dialect=SimpleNamespace(name='other'))
+        with patch.object(db.session, 'get_bind', return_value=other):
+            assert len(search_product_ids(db.session, '50%', 10)) == 1
+            assert len(search_product_ids(db.session, 'promo_', 10)) == 1
+            assert len(search_product_ids(db.session, 'promo', 10)) == 2
+
+
+def test_search_reflects_updates(client):
+    """Test the search index follows product updates and deletes"""
+    product = create_product(client, 'Office Chair', 'CHAIR-001')
+
+    client.put(f"/api/products/{product['id']}", json={'name': 'Standing Desk'})
+    response = client.get('/api/products/search?q=chair')
+    assert [p['name'] for p in json.loads(response.data)] == ['Standing Desk']
+
+    client.delete(f"/api/products/{product['id']}")
+    response = client.get('/api/products/search?q=desk')
+    assert json.loads(response.data) == []
+
+
+def test_get_products_keyset_pagination(client):
+    """Test cursor pagination without counting"""
+    for i in range(5):
+        create_product(client, f'Cable {i}', f'CABLE-{i:03d}')
+
+    response = client.get('/api/products?cursor=0&per_page=2')
+    data = json.loads(response.data)
+    assert len(data['products']) == 2
+    assert 'total' not in data
+
+    seen = [p['sku'] for p in data['products']]
+    while data['next_cursor'] is not None:
+        response = client.get(
+            f"/api/products?cursor={data['next_cursor']}&per_page=2&include_total=true")
+        data = json.loads(response.data)
+        seen.extend(p['sku'] for p in data['products'])
+
+    assert seen == [f'CABLE-{i:03d}' for i in range(5)]
+    assert data['total'] == 5
+
+
+def test_get_products_page_next_cursor(client):
+    """Test a full last page does not advertise a next cursor"""
+    for i in range(4):
+        create_product(client, f'Plug {i}', f'PLUG-{i:03d}')
+
+    data = json.loads(client.get('/api/products?page=1&per_page=2').data)
+    assert data['next_cursor'] == data['products'][-1]['id']
+    assert data['total'] == 4
+
+    data = json.loads(client.get('/api/products?page=2&per_page=2').data)
+    assert [p['sku'] for p in data['products']] == ['PLUG-002', 'PLUG-003']
+    assert data['next_cursor'] is None
+
+
+def test_get_products_category_and_fields(client):
+    """Test exact category filter and sparse fieldsets"""
+    create_product(client, 'Laptop', 'LAP-001', category='Electronics')
+    create_product(client, 'Chair', 'CHAIR-001', category='Furniture')
+
+    response = client.get('/api/products?category=Furniture&fields=name,sku')
+    data = json.loads(response.data)
+    assert data['total'] == 1
+    assert data['products'] == [{'name': 'Chair', 'sku': 'CHAIR-001'}]
+
+    response = client.get('/api/products?category=Furn')
+    assert json.loads(response.data)['products'] == []
+
+    response = client.get('/api/products?fields=name,secret')
+    assert response.status_code == 400
+
+
+def test_bulk_import_ndjson(client):
+    """Test NDJSON bulk upsert with per-row errors"""
+    create_product(client, 'Old Name', 'BULK-001', quantity=1)
+
+    lines = [
+        {'name': 'New Name', 'price': 10, 'quantity': 5, 'sku': 'BULK-001'},
+        {'name': 'Second', 'price': 20, 'quantity': 3, 'sku': 'BULK-002'},
+        {'name': '', 'price': 5, 'quantity': 1, 'sku': 'BULK-003'},
+    ]
+    body = '\n'.join(json.dumps(line) for line in lines) + '\nnot json\n'
+
+    response = client.post('/api/products/bulk?chunk_size=2', data=body,
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['received'] == 4
+    assert data['upserted'] == 2
+    assert [e['row'] for e in data['errors']] == [3, 4]
+
+    response = client.get('/api/products?fields=sku,name,quantity')
+    products = json.loads(response.data)['products']
+    assert {'sku': 'BULK-001', 'name': 'New Name', 'quantity': 5} in products
+    assert len(products) == 2
+
+
+def test_bulk_import_mixed_row_shapes(client):
+    """Test rows supplying different optional fields upsert in one chunk"""
+    existing = create_product(client, 'Keyboard', 'MIX-001', category='Peripherals')
+    client.put(f"/api/products/{existing['id']}", json={'description': 'Keep me'})
+
+    lines = [
+        {'name': 'Keyboard v2', 'price': 15, 'quantity': 7, 'sku': 'MIX-001'},
+        {'name': 'Monitor', 'price': 120, 'quantity': 2, 'sku': 'MIX-002',
+         'description': '27 inch'},
+        {'name': 'Cable', 'price': 3, 'quantity': 50, 'sku': 'MIX-003',
+         'category': 'Accessories'},
+    ]
+    body = '\n'.join(json.dumps(line) for line in lines) + '\n'
+
+    response = client.post('/api/products/bulk', data=body,
+                           content_type='application/x-ndjson')
+    data = json.loads(response.data)
+    assert data['upserted'] == 3
+    assert data['failed'] == 0
+
+    response = client.get('/api/products?fields=sku,name,description,category')
+    products = {p['sku']: p for p in json.loads(response.data)['products']}
+    # Columns a row leaves out keep their stored values
+    assert products['MIX-001'] == {'sku': 'MIX-001', 'name': 'Keyboard v2',
+                                   'description': 'Keep me', 'category': 'Peripherals'}
+    assert products['MIX-002']['description'] == '27 inch'
+    assert products['MIX-002']['category'] is None
+    assert products['MIX-003']['category'] == 'Accessories'
+
+
+def test_bulk_import_announces_changed_products(client):
+    """Test each existing product a bulk import changes is announced once"""
+    changed = create_product(client, 'Desk', 'NOTIFY-001', price=100)
+    create_product(client, 'Chair', 'NOTIFY-002', price=50)
+
+    lines = [
+        {'name': 'Desk', 'price': 90, 'quantity': 10, 'sku': 'NOTIFY-001'},
+        {'name': 'Chair', 'price': 50, 'quantity': 10, 'sku': 'NOTIFY-002',
+         'category': 'Electronics'},
+        {'name': 'Lamp', 'price': 20, 'quantity': 10, 'sku': 'NOTIFY-003'},
+    ]
+    body = '\n'.join(json.dumps(line) for line in lines) + '\n'
+
+    with patch('app.notify_product_changed') as notify:
+        response = client.post('/api/products/bulk', data=body,
+                               content_type='application/x-ndjson')
+    assert json.loads(response.data)['upserted'] == 3
+    notify.assert_called_once_with(changed['id'], Decimal('90'))
+
+
+def test_product_change_published_through_outbox(client):
+    """Test a product update queues its event, and the relay publishes it"""
+    from models import ProductOutboxEvent
+    from product_outbox import ProductOutboxRelay
+
+    product = create_product(client, 'Monitor', 'OUTBOX-001', price=200)
+    events = MagicMock(PRODUCT_UPDATED='product.updated')
+    with patch('saga_endpoints.CHOREOGRAPHY_ENABLED', True), \
+            patch('saga_endpoints.SagaEvent', events, create=True):
+        response = client.put(f"/api/products/{product['id']}",
+                              json={'price': 150})
+    assert response.status_code == 200
+
+    bus = MagicMock()
+    relay = ProductOutboxRelay(app, bus)
+    assert relay.relay_once() == 1
+    routing_key, body = bus.publish_confirmed.call_args.args
+    assert routing_key == 'product.updated'
+    assert json.loads(body)['data'] == {'product_id': product['id'], 'price': 150.0}
+
+    with app.app_context():
+        assert ProductOutboxEvent.query.one().status == 'published'
+    assert relay.relay_once() == 0
+
+
+def test_bulk_import_csv(client):
+    """Test CSV bulk import"""
+    body = ('name,description,price,quantity,category,sku\n'
+            'Desk,,199.99,4,Furniture,DESK-001\n'
+            'Lamp,Warm light,29.99,12,,LAMP-001\n')
+
+    response = client.post('/api/products/bulk', data=body,
+                           content_type='text/csv')
+    data = json.loads(response.data)
+    assert data['upserted'] == 2
+    assert data['failed'] == 0
+
+    response = client.post('/api/products/bulk', data=body,
+                           content_type='application/json')
+    assert response.status_code == 415
+
+
+def test_availability_batch(client):
+    """Test batch availability for several products"""
+    laptop = create_product(client, 'Laptop', 'LAP-001', quantity=5)
+    mouse = create_product(client, 'Mouse', 'MOUSE-001', quantity=1)
+
+    client.post('/api/products/reserve', json={
+        'cart_id': 'cart-1',
+        'items': [{'product_id': laptop['id'], 'quantity': 2}]
+    })
+
+    response = client.post('/api/products/availability:batch', json={
+        'items': [
+            {'product_id': laptop['id'], 'quantity': 3},
+            {'product_id': mouse['id'], 'quantity': 2},
+            {'product_id': 999, 'quantity': 1}
+        ]
+    })
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    items = {item['product_id']: item for item in data['items']}
+
+    assert items[laptop['id']]['available'] is True
+    assert items[laptop['id']]['reserved_quantity'] == 2
+    assert items[laptop['id']]['available_quantity'] == 3
+    assert items[mouse['id']]['available'] is False
+    assert items[999]['found'] is False
+    assert data['all_available'] is False
+
+
+def test_reserved_quantity_maintained(client):
+    """Test reserved_quantity follows reserve, commit and unreserve"""
+    product = create_product(client, 'Monitor', 'MON-001', quantity=10)
+    items = [{'product_id': product['id'], 'quantity': 3}]
+
+    client.post('/api/products/reserve', json={'cart_id': 'c1', 'items': items})
+    client.post('/api/products/reserve', json={'cart_id': 'c2', 'items': items})
+    response = client.get(f"/api/products/availability/{product['id']}")
+    assert json.loads(response.data)['reserved_quantity'] == 6
+
+    client.post('/api/products/commit', json={'cart_id': 'c1'})
+    client.post('/api/products/unreserve', json={'cart_id': 'c2'})
+    response = client.get(f"/api/products/availability/{product['id']}")
+    data = json.loads(response.data)
+    assert data['reserved_quantity'] == 0
+    assert data['available_quantity'] == 7
+
+
+def test_duplicate_commit_releases_reservation_once(client):
+    """Test a commit racing with another only moves reserved_quantity once"""
+    from saga_endpoints import InventoryReservation, transition_reservations
+
+    product = create_product(client, 'Dock', 'DOCK-001', quantity=10)
+    client.post('/api/products/reserve', json={
+        'cart_id': 'c1', 'items': [{'product_id': product['id'], 'quantity': 3}]})
+    client.post('/api/products/reserve', json={
+        'cart_id': 'c2', 'items': [{'product_id': product['id'], 'quantity': 2}]})
+
+    with app.app_context():
+        # Read as 'reserved' by a request that lost the race to the commit below
+        stale = InventoryReservation.query.filter_by(cart_id='c1').all()
+
+    assert client.post('/api/products/commit',
+                       json={'cart_id': 'c1'}).status_code == 200
+    assert client.post('/api/products/commit',
+                       json={'cart_id': 'c1'}).status_code == 404
+    with app.app_context():
+        assert transition_reservations(stale, 'reserved', 'committed') == []
+        db.session.rollback()
+
+    response = client.post('/api/products/unreserve', json={'cart_id': 'c1'})
+    assert json.loads(response.data)['unreserved_items'] == 0
+    data = json.loads(client.get(
+        f"/api/products/availability/{product['id']}").data)
+    assert data['reserved_quantity'] == 2
+
+
+def test_reconcile_reserved_quantities(client):
+    """Test the reconciliation job detects and fixes drift"""
+    from app import Product
+    from saga_endpoints import reconcile_reserved_quantities
+
+    product = create_product(client, 'Hub', 'HUB-001', quantity=10)
+    client.post('/api/products/reserve', json={
+        'cart_id': 'c1', 'items': [{'product_id': product['id'], 'quantity': 4}]})
+
+    with app.app_context():
+        Product.query.filter_by(id=product['id']).update(
+            {Product.reserved_quantity: 1})
+        db.session.commit()
+
+        mismatches = reconcile_reserved_quantities(fix=True)
+        assert mismatches == [
+            {'product_id': product['id'], 'stored': 1, 'expected': 4}]
+        assert reconcile_reserved_quantities() == []
+
+
+RUN_AS_MAIN_AND_CALL_SAGA = """
+import json
+import runpy
+from unittest.mock import MagicMock, patch
+import flask
+
+# Same startup as `python app.py`, without serving
+with patch.object(flask.Flask, 'run'):
+    module = runpy.run_path('app.py', run_name='__main__')
+
+client = module['app'].test_client()
+product = client.post('/api/products', json={
+    'name': 'Laptop', 'price': 10, 'quantity': 5, 'sku': 'BOOT-001'}).get_json()
+reserve = client.post('/api/products/reserve', json={
+    'cart_id': 'cart-boot',
+    'items': [{'product_id': product['id'], 'quantity': 2}]})
+batch = client.post('/api/products/availability:batch', json={
+    'items': [{'product_id': product['id'], 'quantity': 3}]})
+print(json.dumps({'reserve': reserve.status_code, 'batch': batch.status_code,
+                  'body': batch.get_json()}))
+"""
+
+
+def test_saga_routes_work_when_run_as_script():
+    """Test the blueprint shares the database of `python app.py`"""
+    import os
+    import subprocess
+    import sys
+
+    result = subprocess.run(
+        [sys.executable, '-c', RUN_AS_MAIN_AND_CALL_SAGA],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=dict(os.environ, DATABASE_URL='sqlite:///:memory:'),
+        capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+    outcome = json.loads(result.stdout.strip().splitlines()[-1])
+    assert outcome['reserve'] == 200, outcome
+    assert outcome['batch'] == 200, outcome
+    assert outcome['body']['items'][0]['available_quantity'] == 3
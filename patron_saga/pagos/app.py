@@ -2,16 +2,28 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 from flasgger import Swagger, swag_from
 from marshmallow import ValidationError
-import threading
+from datetime import datetime
 import time
 
 from config import Config
 from models import db, Payment, Transaction, PaymentStatus
 from schemas import (
     PaymentRequestSchema, PaymentResponseSchema, RefundRequestSchema,
-    TransactionSchema, ErrorResponseSchema, SuccessResponseSchema
+    TransactionSchema, ErrorResponseSchema, SuccessResponseSchema,
+    serialize_payment, serialize_transaction
 )
-from services import PaymentService
+from services import PaymentService, IdempotencyService, ReportingService
+from gateway import GatewayRunner, create_gateway
+from workers import PaymentWorkerPool, QueueFullError
+from webhooks import WebhookDispatcher
+
+# Imported before create_all(), since it defines the saga models
+try:
+    from saga_endpoints import saga_bp, start_saga_outbox_relay
+except ImportError as e:
+    saga_bp = None
+    start_saga_outbox_relay = None
+    print(f"Warning: Could not import saga endpoints: {e}")
 
 
 def create_app():
@@ -23,6 +35,11 @@ def create_app():
     CORS(app)
     Swagger(app, config=app.config['SWAGGER'])
 
+    # Register saga blueprint
+    if saga_bp is not None:
+        app.register_blueprint(saga_bp)
+        print("Saga endpoints registered successfully")
+
     # Create tables
     with app.app_context():
         db.create_all()
@@ -32,8 +49,38 @@ def create_app():
 
 app = create_app()
 
+PaymentService.gateway = GatewayRunner(create_gateway(app.config))
+
+# Fixed-size pool that processes payments in the background; its size, not
+# the request rate, bounds the number of threads and DB sessions in use.
+# Authorizations run on the gateway's event loop, so each worker keeps many
+# of them in flight
+payment_workers = PaymentWorkerPool(
+    app,
+    PaymentService.start_payment_processing,
+    complete=PaymentService.finish_payment_processing,
+    num_workers=app.config['PAYMENT_WORKER_COUNT'],
+    max_queue_size=app.config['PAYMENT_QUEUE_SIZE'],
+    max_in_flight=app.config['PAYMENT_MAX_IN_FLIGHT'],
+    recovery_interval=app.config['PAYMENT_RECOVERY_INTERVAL'],
+    stale_after=app.config['PAYMENT_TIMEOUT']
+)
+
+# Delivers merchant webhooks from the outbox written by PaymentService
+webhook_dispatcher = WebhookDispatcher(
+    app,
+    num_workers=app.config['WEBHOOK_WORKERS'],
+    merchant_concurrency=app.config['WEBHOOK_MERCHANT_CONCURRENCY'],
+    batch_size=app.config['WEBHOOK_BATCH_SIZE'],
+    poll_interval=app.config['WEBHOOK_POLL_INTERVAL'],
+    timeout=app.config['WEBHOOK_TIMEOUT'],
+    max_attempts=app.config['WEBHOOK_MAX_ATTEMPTS'],
+    retry_base=app.config['WEBHOOK_RETRY_BASE']
+)
+
 # Schemas
 payment_request_schema = PaymentRequestSchema()
+payment_batch_schema = PaymentRequestSchema(many=True)
 payment_response_schema = PaymentResponseSchema()
 refund_request_schema = RefundRequestSchema()
 transaction_schema = TransactionSchema()
@@ -47,6 +94,13 @@ success_response_schema = SuccessResponseSchema()
     'summary': 'Create a new payment',
     'description': 'Initiates a new payment transaction',
     'parameters': [{
+        'name': 'Idempotency-Key',
+        'in': 'header',
+        'type': 'string',
+        'required': False,
+        'description': ('Unique key for this payment. Retries with the same '
+                        'key and body return the original response')
+    }, {
         'name': 'payment',
         'in': 'body',
         'required': True,
@@ -85,23 +139,70 @@ success_response_schema = SuccessResponseSchema()
         '400': {
             'description': 'Validation error',
             'schema': error_response_schema
+        },
+        '409': {
+            'description': 'A request with this Idempotency-Key is still in progress',
+            'schema': error_response_schema
+        },
+        '422': {
+            'description': 'Idempotency-Key was already used with a different request',
+            'schema': error_response_schema
+        },
+        '429': {
+            'description': 'Payment processing queue is full, retry later',
+            'schema': error_response_schema
         }
     }
 })
 def create_payment():
+    idempotency_record = None
     try:
         # Validate request data
         payment_data = payment_request_schema.load(request.json)
 
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            if len(idempotency_key) > 255:
+                error_response = error_response_schema.dump({
+                    'error': 'Bad Request',
+                    'message': 'Idempotency-Key must be at most 255 characters'
+                })
+                return jsonify(error_response), 400
+
+            record, created = IdempotencyService.begin(
+                idempotency_key,
+                IdempotencyService.request_hash(request.json),
+                app.config['IDEMPOTENCY_KEY_TTL'],
+                app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+            if not created:
+                return replay_idempotent_request(record)
+            idempotency_record = record
+
+        # Apply backpressure before accepting more work
+        if payment_workers.is_saturated():
+            if idempotency_record:
+                IdempotencyService.release(idempotency_record)
+            error_response = error_response_schema.dump({
+                'error': 'Too Many Requests',
+                'message': 'Payment processing queue is full, retry later'
+            })
+            return jsonify(error_response), 429, {'Retry-After': '1'}
+
         # Create payment
-        payment = PaymentService.create_payment(payment_data)
+        payment = PaymentService.create_payment(
+            payment_data, idempotency_key=idempotency_record)
 
-        # Start async processing
-        thread = threading.Thread(
-            target=process_payment_async, args=(payment.id,))
-        thread.start()
+        # Queue for async processing. The payment is already stored as
+        # pending, so if the queue filled up meanwhile the recovery sweep
+        # will pick it up
+        try:
+            payment_workers.submit(payment.id)
+        except QueueFullError:
+            pass
 
         response_data = payment_response_schema.dump(payment)
+        if idempotency_record:
+            IdempotencyService.complete(idempotency_record, 201, response_data)
         return jsonify(response_data), 201
 
     except ValidationError as e:
@@ -113,6 +214,8 @@ def create_payment():
         return jsonify(error_response), 400
 
     except Exception as e:
+        if idempotency_record and not idempotency_record.payment_id:
+            IdempotencyService.release(idempotency_record)
         error_response = error_response_schema.dump({
             'error': 'Internal Server Error',
             'message': str(e)
@@ -120,13 +223,213 @@ def create_payment():
         return jsonify(error_response), 500
 
 
-def process_payment_async(payment_id):
-    """Process payment asynchronously"""
-    with app.app_context():
+def replay_idempotent_request(record):
+    """Answer a retried request from its idempotency key record"""
+    if record.request_hash != IdempotencyService.request_hash(request.json):
+        error_response = error_response_schema.dump({
+            'error': 'Unprocessable Entity',
+            'message': 'Idempotency-Key was already used with a different request'
+        })
+        return jsonify(error_response), 422
+
+    if record.status != 'completed' and record.payment_id:
+        # The payment was created but the response was never stored
+        payment = PaymentService.get_payment(record.payment_id)
+        IdempotencyService.complete(
+            record, 201, payment_response_schema.dump(payment))
+
+    if record.status != 'completed':
+        error_response = error_response_schema.dump({
+            'error': 'Conflict',
+            'message': 'A request with this Idempotency-Key is in progress'
+        })
+        return jsonify(error_response), 409
+
+    return jsonify(record.response_body), record.response_code, {
+        'Idempotent-Replayed': 'true'}
+
+
+@app.route('/api/v1/payments/batch', methods=['POST'])
+@swag_from({
+    'tags': ['Payments'],
+    'summary': 'Create a batch of payments',
+    'description': ('Validates and stores many payments in one request and '
+                    'queues them for processing. Invalid items are rejected '
+                    'individually and reported with their index'),
+    'parameters': [{
+        'name': 'batch',
+        'in': 'body',
+        'required': True,
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'payments': {
+                    'type': 'array',
+                    'items': {'type': 'object'},
+                    'description': 'Payments, with the same fields as POST /api/v1/payments'
+                }
+            },
+            'required': ['payments']
+        }
+    }],
+    'responses': {
+        '201': {'description': 'Batch accepted, see the per-item results'},
+        '400': {
+            'description': 'Invalid batch or no valid payments',
+            'schema': error_response_schema
+        },
+        '429': {
+            'description': 'Payment processing queue is full, retry later',
+            'schema': error_response_schema
+        }
+    }
+})
+def create_payment_batch():
+    try:
+        payload = request.json or {}
+        items = payload.get('payments') if isinstance(payload, dict) else None
+        max_size = app.config['PAYMENT_BATCH_MAX_SIZE']
+
+        if not isinstance(items, list) or not items:
+            error_response = error_response_schema.dump({
+                'error': 'Bad Request',
+                'message': 'payments must be a non-empty list'
+            })
+            return jsonify(error_response), 400
+
+        if len(items) > max_size:
+            error_response = error_response_schema.dump({
+                'error': 'Bad Request',
+                'message': f'A batch can contain at most {max_size} payments'
+            })
+            return jsonify(error_response), 400
+
+        valid, errors = validate_payment_batch(items)
+        if not valid:
+            error_response = error_response_schema.dump({
+                'error': 'Validation Error',
+                'message': 'No valid payments in batch',
+                'details': {str(index): messages for index, messages in errors.items()}
+            })
+            return jsonify(error_response), 400
+
+        if payment_workers.is_saturated():
+            error_response = error_response_schema.dump({
+                'error': 'Too Many Requests',
+                'message': 'Payment processing queue is full, retry later'
+            })
+            return jsonify(error_response), 429, {'Retry-After': '1'}
+
+        batch = PaymentService.create_payment_batch(valid, errors)
+
+        # Payments that do not fit in the queue stay pending for the
+        # recovery sweep
+        for result in batch.results:
+            if 'payment_id' not in result:
+                continue
+            try:
+                payment_workers.submit(result['payment_id'])
+            except QueueFullError:
+                break
+
+        return jsonify(batch_response(batch)), 201
+
+    except Exception as e:
+        error_response = error_response_schema.dump({
+            'error': 'Internal Server Error',
+            'message': str(e)
+        })
+        return jsonify(error_response), 500
+
+
+@app.route('/api/v1/payments/batch/<batch_id>', methods=['GET'])
+@swag_from({
+    'tags': ['Payments'],
+    'summary': 'Get batch status',
+    'description': 'Current status of every payment in a batch',
+    'parameters': [{
+        'name': 'batch_id',
+        'in': 'path',
+        'type': 'string',
+        'required': True,
+        'description': 'Batch ID'
+    }],
+    'responses': {
+        '200': {'description': 'Batch status with per-item results'},
+        '404': {
+            'description': 'Batch not found',
+            'schema': error_response_schema
+        }
+    }
+})
+def get_payment_batch(batch_id):
+    try:
+        batch = PaymentService.get_batch(batch_id)
+        if not batch:
+            error_response = error_response_schema.dump({
+                'error': 'Not Found',
+                'message': 'Batch not found'
+            })
+            return jsonify(error_response), 404
+
+        return jsonify(batch_response(batch)), 200
+
+    except Exception as e:
+        error_response = error_response_schema.dump({
+            'error': 'Internal Server Error',
+            'message': str(e)
+        })
+        return jsonify(error_response), 500
+
+
+def validate_payment_batch(items):
+    """Split batch items into {index: data} and {index: errors}"""
+    try:
+        loaded = payment_batch_schema.load(items)
+        return dict(enumerate(loaded)), {}
+    except ValidationError as e:
+        errors = {index: messages for index, messages in e.messages.items()
+                  if isinstance(index, int)}
+
+    # The cross-field card checks only run on a fully valid batch and raise
+    # without the item index, so validate the remaining items one by one
+    valid = {}
+    for index, item in enumerate(items):
+        if index in errors:
+            continue
         try:
-            PaymentService.process_payment(payment_id)
-        except Exception as e:
-            print(f"Error processing payment {payment_id}: {str(e)}")
+            valid[index] = payment_request_schema.load(item)
+        except ValidationError as e:
+            errors[index] = e.messages
+    return valid, errors
+
+
+def batch_response(batch):
+    statuses = PaymentService.get_batch_statuses(batch.id)
+
+    items = []
+    status_counts = {}
+    for result in batch.results:
+        if 'payment_id' in result:
+            status = statuses[result['payment_id']].value
+        else:
+            status = 'rejected'
+        items.append({**result, 'status': status})
+        status_counts[status] = status_counts.get(status, 0) + 1
+
+    in_progress = status_counts.get(PaymentStatus.PENDING.value, 0) + \
+        status_counts.get(PaymentStatus.PROCESSING.value, 0)
+
+    return {
+        'batch_id': batch.id,
+        'status': 'processing' if in_progress else 'completed',
+        'created_at': batch.created_at.isoformat(),
+        'total_items': batch.total_items,
+        'accepted_items': batch.accepted_items,
+        'rejected_items': batch.rejected_items,
+        'status_counts': status_counts,
+        'items': items
+    }
 
 
 @app.route('/api/v1/payments/<payment_id>', methods=['GET'])
@@ -140,6 +443,12 @@ def process_payment_async(payment_id):
         'type': 'string',
         'required': True,
         'description': 'Payment ID'
+    }, {
+        'name': 'include',
+        'in': 'query',
+        'type': 'string',
+        'enum': ['transactions'],
+        'description': 'Embed the payment transactions in the response'
     }],
     'responses': {
         '200': {
@@ -154,7 +463,11 @@ def process_payment_async(payment_id):
 })
 def get_payment(payment_id):
     try:
-        payment = PaymentService.get_payment(payment_id)
+        include = request.args.get('include', '')
+        include_transactions = 'transactions' in include.split(',')
+
+        payment = PaymentService.get_payment(
+            payment_id, include_transactions=include_transactions)
 
         if not payment:
             error_response = error_response_schema.dump({
@@ -163,7 +476,8 @@ def get_payment(payment_id):
             })
             return jsonify(error_response), 404
 
-        response_data = payment_response_schema.dump(payment)
+        response_data = serialize_payment(
+            payment, include_transactions=include_transactions)
         return jsonify(response_data), 200
 
     except Exception as e:
@@ -193,7 +507,7 @@ def get_payment(payment_id):
             'schema': {
                 'type': 'object',
                 'properties': {
-                    'amount': {'type': 'number', 'description': 'Refund amount (optional, defaults to full amount)'},
+                    'amount': {'type': 'number', 'description': 'Refund amount (optional, defaults to the remaining refundable amount)'},
                     'reason': {'type': 'string', 'description': 'Reason for refund'}
                 }
             }
@@ -218,8 +532,9 @@ def refund_payment(payment_id):
     try:
         # Validate request data if present
         refund_data = {}
-        if request.json:
-            refund_data = refund_request_schema.load(request.json)
+        payload = request.get_json(silent=True)
+        if payload:
+            refund_data = refund_request_schema.load(payload)
 
         # Process refund
         transaction = PaymentService.refund_payment(
@@ -247,11 +562,80 @@ def refund_payment(payment_id):
         return jsonify(error_response), 400
 
 
+@app.route('/api/v1/payments/<payment_id>/refunds', methods=['GET'])
+@swag_from({
+    'tags': ['Payments'],
+    'summary': 'Get refund ledger',
+    'description': 'Refunds issued for a payment and the amount still refundable',
+    'parameters': [{
+        'name': 'payment_id',
+        'in': 'path',
+        'type': 'string',
+        'required': True,
+        'description': 'Payment ID'
+    }],
+    'responses': {
+        '200': {
+            'description': 'Refund ledger',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'payment_id': {'type': 'string'},
+                    'amount': {'type': 'string'},
+                    'refunded_amount': {'type': 'string'},
+                    'refundable_amount': {'type': 'string'},
+                    'refunds': {
+                        'type': 'array',
+                        'items': transaction_schema
+                    }
+                }
+            }
+        },
+        '404': {
+            'description': 'Payment not found',
+            'schema': error_response_schema
+        }
+    }
+})
+def get_payment_refunds(payment_id):
+    try:
+        payment = PaymentService.get_payment(payment_id)
+
+        if not payment:
+            error_response = error_response_schema.dump({
+                'error': 'Not Found',
+                'message': 'Payment not found'
+            })
+            return jsonify(error_response), 404
+
+        refundable = payment.amount - payment.refunded_amount \
+            if payment.status == PaymentStatus.COMPLETED else 0
+
+        return jsonify({
+            'payment_id': payment.id,
+            'status': payment.status.value,
+            'amount': f"{payment.amount:.2f}",
+            'refunded_amount': f"{payment.refunded_amount:.2f}",
+            'refundable_amount': f"{refundable:.2f}",
+            'refunds': [serialize_transaction(transaction) for transaction
+                        in PaymentService.get_refunds(payment_id)]
+        }), 200
+
+    except Exception as e:
+        error_response = error_response_schema.dump({
+            'error': 'Internal Server Error',
+            'message': str(e)
+        })
+        return jsonify(error_response), 500
+
+
 @app.route('/api/v1/payments', methods=['GET'])
 @swag_from({
     'tags': ['Payments'],
     'summary': 'List payments',
-    'description': 'Get a list of payments for a merchant',
+    'description': ('Get a list of payments for a merchant, newest first. '
+                    'Pass cursor (the next_cursor of the previous page) to '
+                    'page through large merchants without offsets'),
     'parameters': [
         {
             'name': 'merchant_id',
@@ -265,14 +649,50 @@ def refund_payment(payment_id):
             'in': 'query',
             'type': 'integer',
             'default': 100,
-            'description': 'Number of results to return'
+            'description': 'Number of results to return (max 1000)'
+        },
+        {
+            'name': 'cursor',
+            'in': 'query',
+            'type': 'string',
+            'description': 'Cursor returned as next_cursor by the previous page'
         },
         {
             'name': 'offset',
             'in': 'query',
             'type': 'integer',
             'default': 0,
-            'description': 'Number of results to skip'
+            'description': 'Number of results to skip (ignored when cursor is given)'
+        },
+        {
+            'name': 'status',
+            'in': 'query',
+            'type': 'string',
+            'description': 'Comma-separated payment statuses to include'
+        },
+        {
+            'name': 'created_from',
+            'in': 'query',
+            'type': 'string',
+            'format': 'date-time',
+            'description': 'Only payments created at or after this ISO 8601 time'
+        },
+        {
+            'name': 'created_to',
+            'in': 'query',
+            'type': 'string',
+            'format': 'date-time',
+            'description': 'Only payments created before this ISO 8601 time'
+        },
+        {
+            'name': 'include_total',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['exact', 'approximate', 'false'],
+            'default': 'exact',
+            'description': ('exact counts the matching payments, approximate '
+                            'reads the merchant counter (exact when filters '
+                            'are given), false skips the total')
         }
     ],
     'responses': {
@@ -285,7 +705,9 @@ def refund_payment(payment_id):
                         'type': 'array',
                         'items': payment_response_schema
                     },
-                    'total': {'type': 'integer'}
+                    'next_cursor': {'type': 'string'},
+                    'total': {'type': 'integer'},
+                    'total_is_approximate': {'type': 'boolean'}
                 }
             }
         },
@@ -305,18 +727,64 @@ def list_payments():
             })
             return jsonify(error_response), 400
 
-        limit = int(request.args.get('limit', 100))
-        offset = int(request.args.get('offset', 0))
+        try:
+            limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+            offset = max(int(request.args.get('offset', 0)), 0)
+
+            cursor = request.args.get('cursor')
+            if cursor:
+                cursor = PaymentService.decode_cursor(cursor)
 
+            status = request.args.get('status')
+            if status:
+                status = [PaymentStatus(s.strip().lower())
+                          for s in status.split(',') if s.strip()]
+
+            created_from = request.args.get('created_from')
+            if created_from:
+                created_from = datetime.fromisoformat(created_from)
+            created_to = request.args.get('created_to')
+            if created_to:
+                created_to = datetime.fromisoformat(created_to)
+
+            include_total = request.args.get('include_total', 'exact').lower()
+            if include_total not in ('exact', 'approximate', 'false'):
+                raise ValueError(
+                    'include_total must be exact, approximate or false')
+        except ValueError as e:
+            error_response = error_response_schema.dump({
+                'error': 'Bad Request',
+                'message': str(e)
+            })
+            return jsonify(error_response), 400
+
+        filters = {
+            'status': status,
+            'created_from': created_from,
+            'created_to': created_to
+        }
+
+        # Fetch one extra row to know whether another page exists
         payments = PaymentService.get_payments_by_merchant(
-            merchant_id, limit, offset)
-        payments_data = payment_response_schema.dump(payments, many=True)
+            merchant_id, limit + 1, offset, cursor=cursor or None, **filters)
+        has_more = len(payments) > limit
+        payments = payments[:limit]
 
         response = {
-            'payments': payments_data,
-            'total': len(payments_data)
+            'payments': [serialize_payment(payment) for payment in payments],
+            'next_cursor': (PaymentService.encode_cursor(payments[-1])
+                            if has_more else None)
         }
 
+        if include_total == 'approximate' and not any(filters.values()):
+            response['total'] = PaymentService.get_merchant_payment_count(
+                merchant_id)
+            response['total_is_approximate'] = True
+        elif include_total != 'false':
+            response['total'] = PaymentService.count_payments_by_merchant(
+                merchant_id, **filters)
+            response['total_is_approximate'] = False
+
         return jsonify(response), 200
 
     except Exception as e:
@@ -355,7 +823,8 @@ def list_payments():
 })
 def get_payment_transactions(payment_id):
     try:
-        payment = PaymentService.get_payment(payment_id)
+        payment = PaymentService.get_payment(
+            payment_id, include_transactions=True)
 
         if not payment:
             error_response = error_response_schema.dump({
@@ -364,8 +833,8 @@ def get_payment_transactions(payment_id):
             })
             return jsonify(error_response), 404
 
-        transactions_data = transaction_schema.dump(
-            payment.transactions, many=True)
+        transactions_data = [serialize_transaction(transaction)
+                             for transaction in payment.transactions]
         return jsonify(transactions_data), 200
 
     except Exception as e:
@@ -376,6 +845,130 @@ def get_payment_transactions(payment_id):
         return jsonify(error_response), 500
 
 
+@app.route('/api/v1/reports/payments', methods=['GET'])
+@swag_from({
+    'tags': ['Reports'],
+    'summary': 'Payment report',
+    'description': ('Payment counts and amounts of a merchant per time bucket, '
+                    'served from pre-aggregated rollups. status is the outcome '
+                    'recorded in the bucket: completed or failed charges and '
+                    'refunds'),
+    'parameters': [
+        {
+            'name': 'merchant_id',
+            'in': 'query',
+            'type': 'string',
+            'required': True,
+            'description': 'Merchant ID'
+        },
+        {
+            'name': 'granularity',
+            'in': 'query',
+            'type': 'string',
+            'enum': ['hour', 'day'],
+            'default': 'day',
+            'description': 'Bucket size'
+        },
+        {
+            'name': 'from',
+            'in': 'query',
+            'type': 'string',
+            'format': 'date-time',
+            'description': 'Only buckets starting at or after this ISO 8601 time'
+        },
+        {
+            'name': 'to',
+            'in': 'query',
+            'type': 'string',
+            'format': 'date-time',
+            'description': 'Only buckets starting before this ISO 8601 time'
+        },
+        {
+            'name': 'group_by',
+            'in': 'query',
+            'type': 'string',
+            'default': 'status',
+            'description': ('Comma-separated dimensions: status, payment_method, '
+                            'card_brand, currency')
+        }
+    ],
+    'responses': {
+        '200': {
+            'description': 'Report buckets',
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'merchant_id': {'type': 'string'},
+                    'granularity': {'type': 'string'},
+                    'buckets': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'bucket_start': {'type': 'string'},
+                                'payment_count': {'type': 'integer'},
+                                'total_amount': {'type': 'string'}
+                            }
+                        }
+                    }
+                }
+            }
+        },
+        '400': {
+            'description': 'Bad request',
+            'schema': error_response_schema
+        }
+    }
+})
+def payment_report():
+    try:
+        merchant_id = request.args.get('merchant_id')
+        granularity = request.args.get('granularity', 'day')
+        group_by = [dimension.strip() for dimension in
+                    request.args.get('group_by', 'status').split(',')
+                    if dimension.strip()]
+
+        try:
+            if not merchant_id:
+                raise ValueError('merchant_id parameter is required')
+            if granularity not in ReportingService.GRANULARITIES:
+                raise ValueError('granularity must be hour or day')
+            unknown = set(group_by) - set(ReportingService.DIMENSIONS)
+            if unknown:
+                raise ValueError(
+                    f"Unknown group_by dimensions: {', '.join(sorted(unknown))}")
+
+            start = request.args.get('from')
+            if start:
+                start = datetime.fromisoformat(start)
+            end = request.args.get('to')
+            if end:
+                end = datetime.fromisoformat(end)
+        except ValueError as e:
+            error_response = error_response_schema.dump({
+                'error': 'Bad Request',
+                'message': str(e)
+            })
+            return jsonify(error_response), 400
+
+        buckets = ReportingService.get_payment_report(
+            merchant_id, granularity, start, end, group_by)
+
+        return jsonify({
+            'merchant_id': merchant_id,
+            'granularity': granularity,
+            'group_by': group_by,
+            'buckets': buckets
+        }), 200
+
+    except Exception as e:
+        error_response = error_response_schema.dump({
+            'error': 'Internal Server Error',
+            'message': str(e)
+        })
+        return jsonify(error_response), 500
+
+
 @app.route('/api/v1/health', methods=['GET'])
 @swag_from({
     'tags': ['Health'],
@@ -397,7 +990,8 @@ def get_payment_transactions(payment_id):
 def health_check():
     return jsonify({
         'status': 'healthy',
-        'timestamp': time.time()
+        'timestamp': time.time(),
+        'payment_workers': payment_workers.stats()
     }), 200
 
 
@@ -420,4 +1014,11 @@ def internal_error(error):
 
 
 if __name__ == '__main__':
+    # Starting the pool recovers payments left pending by a previous run,
+    # without waiting for the first new payment
+    payment_workers.start()
+    if app.config['WEBHOOK_DISPATCHER_ENABLED']:
+        webhook_dispatcher.start()
+    if start_saga_outbox_relay:
+        start_saga_outbox_relay(app)
     app.run(debug=True, host='0.0.0.0', port=3002)
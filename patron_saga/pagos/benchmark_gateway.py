@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Local benchmark for the simulated payment gateway
+
+Fires a batch of concurrent authorizations through a GatewayRunner and
+reports throughput, latency percentiles and the outcome mix.
+
+Usage:
+    python benchmark_gateway.py [requests] [p50_ms] [p99_ms] [max_concurrency]
+"""
+
+import sys
+import time
+from collections import Counter
+from gateway import GatewayRunner, SimulatedGateway
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(int(len(ordered) * fraction), len(ordered) - 1)
+    return ordered[index]
+
+
+def main():
+    args = sys.argv[1:]
+    total = int(args[0]) if len(args) > 0 else 2000
+    p50_ms = float(args[1]) if len(args) > 1 else 200
+    p99_ms = float(args[2]) if len(args) > 2 else 1000
+    max_concurrency = int(args[3]) if len(args) > 3 else 1000
+
+    runner = GatewayRunner(SimulatedGateway(
+        latency_p50_ms=p50_ms,
+        latency_p99_ms=p99_ms,
+        timeout_ms=p99_ms * 2,
+        max_concurrency=max_concurrency
+    ))
+
+    latencies = []
+    outcomes = Counter()
+
+    def record(started):
+        def done(future):
+            latencies.append(time.perf_counter() - started)
+            result = future.result()
+            outcomes['approved' if result['approved']
+                     else result['error_code']] += 1
+        return done
+
+    started_at = time.perf_counter()
+    futures = []
+    for i in range(total):
+        future = runner.authorize({'payment_id': str(i), 'amount': '10.00'})
+        future.add_done_callback(record(time.perf_counter()))
+        futures.append(future)
+
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started_at
+
+    print(f"Authorizations: {total} in {elapsed:.2f}s "
+          f"({total / elapsed:.0f}/s, max concurrency {max_concurrency})")
+    print(f"Latency p50: {percentile(latencies, 0.50) * 1000:.0f} ms, "
+          f"p99: {percentile(latencies, 0.99) * 1000:.0f} ms")
+    for outcome, count in outcomes.most_common():
+        print(f"- {outcome}: {count}")
+
+
+if __name__ == '__main__':
+    main()
@@ -22,6 +22,48 @@ class Config:
     MAX_PAYMENT_AMOUNT = 100000.00  # $100,000
     MIN_PAYMENT_AMOUNT = 0.01  # $0.01
 
+    # Largest number of payments accepted by POST /api/v1/payments/batch
+    PAYMENT_BATCH_MAX_SIZE = int(os.environ.get('PAYMENT_BATCH_MAX_SIZE', 1000))
+
+    # Idempotency-Key snapshots are kept this long (seconds)
+    IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))
+    # A request holding a key longer than this (seconds) without creating
+    # its payment is considered dead and retries may take the key over
+    IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+
+    # Payment processing workers
+    PAYMENT_WORKER_COUNT = int(os.environ.get('PAYMENT_WORKER_COUNT', 8))
+    PAYMENT_QUEUE_SIZE = int(os.environ.get('PAYMENT_QUEUE_SIZE', 1000))
+    PAYMENT_RECOVERY_INTERVAL = 60  # seconds between recovery sweeps
+    # Authorizations outstanding at the gateway across all workers
+    PAYMENT_MAX_IN_FLIGHT = int(os.environ.get('PAYMENT_MAX_IN_FLIGHT', 1000))
+
+    # Merchant webhook delivery
+    WEBHOOK_DISPATCHER_ENABLED = os.environ.get(
+        'WEBHOOK_DISPATCHER_ENABLED', 'true').lower() == 'true'
+    WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+    WEBHOOK_MERCHANT_CONCURRENCY = int(
+        os.environ.get('WEBHOOK_MERCHANT_CONCURRENCY', 1))
+    WEBHOOK_BATCH_SIZE = 50  # events per delivery
+    WEBHOOK_POLL_INTERVAL = 1  # seconds
+    WEBHOOK_TIMEOUT = 5  # seconds
+    WEBHOOK_MAX_ATTEMPTS = 8
+    WEBHOOK_RETRY_BASE = 5  # seconds, doubled after each failed attempt
+
+    # Payment gateway adapter (see gateway.GATEWAYS) and its options
+    PAYMENT_GATEWAY = os.environ.get('PAYMENT_GATEWAY', 'simulated')
+    PAYMENT_GATEWAY_OPTIONS = {
+        'latency_p50_ms': float(os.environ.get('GATEWAY_LATENCY_P50_MS', 1000)),
+        'latency_p99_ms': float(os.environ.get('GATEWAY_LATENCY_P99_MS', 2500)),
+        'timeout_ms': float(os.environ.get('GATEWAY_TIMEOUT_MS', 10000)),
+        'max_concurrency': int(os.environ.get('GATEWAY_MAX_CONCURRENCY', 1000)),
+        'error_mix': {
+            'card_declined': 0.05,
+            'insufficient_funds': 0.03,
+            'expired_card': 0.02
+        }
+    }
+
     # Swagger Configuration
     SWAGGER = {
         'title': 'Payment Gateway API',
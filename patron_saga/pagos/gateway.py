@@ -0,0 +1,158 @@
+"""
+Payment gateway adapters.
+
+A gateway authorizes a payment asynchronously. The SimulatedGateway stands
+in for a real processor with configurable latency (p50/p99 of a lognormal
+distribution), timeouts, error mix, concurrency limit and idempotency keys. GatewayRunner
+drives a gateway on its own asyncio event loop so that synchronous code
+(request handlers, payment workers) can overlap many authorizations.
+"""
+
+import abc
+import asyncio
+import math
+import random
+import threading
+import uuid
+from collections import OrderedDict
+
+# z-score of the 99th percentile of the standard normal distribution
+Z_P99 = 2.3263
+
+
+class PaymentGateway(abc.ABC):
+    """Interface for gateway adapters"""
+
+    @abc.abstractmethod
+    async def authorize(self, request):
+        """
+        Authorize a charge. request holds payment_id, amount, currency,
+        payment_method, card_brand and idempotency_key. Returns a dict with
+        'approved' plus the gateway identifiers or the error code.
+
+        Adapters must send idempotency_key to the processor, so authorizing
+        the same payment again (a retry after its result could not be
+        recorded) returns the original result instead of charging twice.
+        """
+
+
+class SimulatedGateway(PaymentGateway):
+
+    def __init__(self, latency_p50_ms=1000, latency_p99_ms=2500,
+                 timeout_ms=10000, error_mix=None, max_concurrency=1000,
+                 remembered_keys=10000, seed=None):
+        self.timeout = timeout_ms / 1000.0
+        self.error_mix = error_mix if error_mix is not None else {
+            'card_declined': 0.05,
+            'insufficient_funds': 0.03,
+            'expired_card': 0.02
+        }
+        self.max_concurrency = max_concurrency
+        self.remembered_keys = remembered_keys
+        self._random = random.Random(seed)
+        self._semaphore = None
+        # idempotency_key -> authorization, like a processor's key retention
+        self._authorizations = OrderedDict()
+
+        # Lognormal latency with the requested median and 99th percentile
+        self._mu = math.log(latency_p50_ms / 1000.0)
+        self._sigma = max(
+            math.log(latency_p99_ms / float(latency_p50_ms)) / Z_P99, 0.0)
+
+    def sample_latency(self):
+        if self._sigma == 0:
+            return math.exp(self._mu)
+        return self._random.lognormvariate(self._mu, self._sigma)
+
+    def sample_error(self):
+        roll = self._random.random()
+        for error_code, probability in self.error_mix.items():
+            if roll < probability:
+                return error_code
+            roll -= probability
+        return None
+
+    async def authorize(self, request):
+        key = request.get('idempotency_key')
+        if key is None:
+            return await self._authorize()
+
+        # A repeated key gets the outcome of the first authorization, even
+        # while that one is still running
+        if key not in self._authorizations:
+            self._authorizations[key] = asyncio.ensure_future(self._authorize())
+            while len(self._authorizations) > self.remembered_keys:
+                self._authorizations.popitem(last=False)
+        return await asyncio.shield(self._authorizations[key])
+
+    async def _authorize(self):
+        # Created lazily so it belongs to the loop running the gateway
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            latency = self.sample_latency()
+            if latency > self.timeout:
+                await asyncio.sleep(self.timeout)
+                return {
+                    'approved': False,
+                    'error_code': 'gateway_timeout',
+                    'processor_response': 'Timeout'
+                }
+
+            await asyncio.sleep(latency)
+
+        error_code = self.sample_error()
+        if error_code:
+            return {
+                'approved': False,
+                'error_code': error_code,
+                'processor_response': 'Declined'
+            }
+
+        return {
+            'approved': True,
+            'gateway_transaction_id': f"txn_{uuid.uuid4().hex[:12]}",
+            'authorization_code': f"auth_{uuid.uuid4().hex[:8]}",
+            'processor_response': 'Approved'
+        }
+
+
+GATEWAYS = {
+    'simulated': SimulatedGateway
+}
+
+
+def create_gateway(config):
+    """Build the gateway adapter named by PAYMENT_GATEWAY"""
+    name = config.get('PAYMENT_GATEWAY', 'simulated')
+    if name not in GATEWAYS:
+        raise Exception(f"Unknown payment gateway: {name}")
+    return GATEWAYS[name](**config.get('PAYMENT_GATEWAY_OPTIONS', {}))
+
+
+class GatewayRunner:
+    """Runs a gateway on a background event loop"""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=self._loop.run_forever, name='payment-gateway',
+                    daemon=True)
+                thread.start()
+        return self._loop
+
+    def authorize(self, request):
+        """Start an authorization, returning a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(
+            self.gateway.authorize(request), self._ensure_loop())
+
+    def authorize_sync(self, request):
+        return self.authorize(request).result()
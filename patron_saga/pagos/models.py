@@ -30,6 +30,9 @@ class Payment(db.Model):
     merchant_id = db.Column(db.String(100), nullable=False)
     order_id = db.Column(db.String(100), nullable=False)
     amount = db.Column(db.Numeric(10, 2), nullable=False)
+    # Sum of the refunds issued so far, maintained by refund_payment
+    refunded_amount = db.Column(db.Numeric(10, 2), default=0,
+                                server_default='0', nullable=False)
     currency = db.Column(db.String(3), default='USD', nullable=False)
     status = db.Column(db.Enum(PaymentStatus),
                        default=PaymentStatus.PENDING, nullable=False)
@@ -53,8 +56,33 @@ class Payment(db.Model):
     description = db.Column(db.Text)
     payment_metadata = db.Column(db.JSON)
 
+    # Set for payments submitted through the batch endpoint
+    batch_id = db.Column(db.String(36), db.ForeignKey('payment_batches.id'),
+                         index=True)
+
     # Relationships
-    transactions = db.relationship('Transaction', backref='payment', lazy=True)
+    transactions = db.relationship('Transaction', backref='payment', lazy=True,
+                                   order_by='Transaction.created_at')
+
+    __table_args__ = (
+        # Serves the merchant listing, newest first, keyset-paginated on
+        # (created_at, id)
+        db.Index('ix_payments_merchant_created_id',
+                 'merchant_id', 'created_at', 'id'),
+    )
+
+
+class PaymentBatch(db.Model):
+    __tablename__ = 'payment_batches'
+
+    id = db.Column(db.String(36), primary_key=True,
+                   default=lambda: str(uuid.uuid4()))
+    total_items = db.Column(db.Integer, nullable=False)
+    accepted_items = db.Column(db.Integer, nullable=False)
+    rejected_items = db.Column(db.Integer, nullable=False)
+    # One entry per submitted item, in order: its payment_id or its errors
+    results = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 class Transaction(db.Model):
@@ -72,6 +100,11 @@ class Transaction(db.Model):
     gateway_response = db.Column(db.JSON)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_transactions_payment_type',
+                 'payment_id', 'transaction_type'),
+    )
+
 
 class Merchant(db.Model):
     __tablename__ = 'merchants'
@@ -89,3 +122,109 @@ class Merchant(db.Model):
     webhook_url = db.Column(db.String(500))
     allowed_currencies = db.Column(db.JSON, default=['USD'])
     max_transaction_amount = db.Column(db.Numeric(10, 2), default=10000.00)
+
+
+class MerchantPaymentCounter(db.Model):
+    __tablename__ = 'merchant_payment_counters'
+
+    # Maintained on payment creation, so listing a merchant's payments can
+    # report an approximate total without counting its rows
+    merchant_id = db.Column(db.String(100), primary_key=True)
+    payment_count = db.Column(db.BigInteger, default=0, nullable=False)
+    updated_at = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    id = db.Column(db.String(36), primary_key=True,
+                   default=lambda: str(uuid.uuid4()))
+    key = db.Column(db.String(255), unique=True, nullable=False)
+    # SHA-256 of the request body, to reject a key reused for another request
+    request_hash = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.String(20), default='in_progress',
+                       nullable=False)  # in_progress, completed
+    payment_id = db.Column(db.String(36))
+    # Lease of the request processing the key; once it lapses without a
+    # payment_id a retry may take the key over
+    locked_until = db.Column(db.DateTime)
+
+    # Snapshot of the original response, replayed on retries
+    response_code = db.Column(db.Integer)
+    response_body = db.Column(db.JSON)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class PaymentRollup(db.Model):
+    __tablename__ = 'payment_rollups'
+
+    # Pre-aggregated payment outcomes per merchant and time bucket, updated
+    # in the transaction that records each outcome. status is the outcome
+    # of the event: completed or failed charges, and refunds
+    merchant_id = db.Column(db.String(100), primary_key=True)
+    granularity = db.Column(db.String(10), primary_key=True)  # hour, day
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    payment_method = db.Column(db.String(50), primary_key=True)
+    card_brand = db.Column(db.String(50), primary_key=True, default='')
+    currency = db.Column(db.String(3), primary_key=True)
+
+    payment_count = db.Column(db.BigInteger, default=0, nullable=False)
+    total_amount = db.Column(db.Numeric(16, 2), default=0, nullable=False)
+
+
+class WebhookEvent(db.Model):
+    __tablename__ = 'webhook_events'
+
+    # Outbox of merchant notifications, written in the same transaction as
+    # the payment change and delivered by the webhook dispatcher
+    id = db.Column(db.String(36), primary_key=True,
+                   default=lambda: str(uuid.uuid4()))
+    merchant_id = db.Column(db.String(100), nullable=False)
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+
+    # pending, delivering, delivered, failed
+    status = db.Column(db.String(20), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow,
+                                nullable=False)
+    claim_token = db.Column(db.String(36))
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    delivered_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_webhook_events_status_next_attempt',
+                 'status', 'next_attempt_at'),
+        db.Index('ix_webhook_events_claim_token', 'claim_token'),
+    )
+
+
+class SagaOutboxEvent(db.Model):
+    __tablename__ = 'saga_outbox_events'
+
+    # Choreographed saga events, written in the same transaction as the
+    # state change they announce and published by the outbox relay
+    id = db.Column(db.String(36), primary_key=True,
+                   default=lambda: str(uuid.uuid4()))
+    event_type = db.Column(db.String(100), nullable=False)
+    routing_key = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.JSON, nullable=False)
+
+    status = db.Column(db.String(20), default='pending',
+                       nullable=False)  # pending, published
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    published_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_saga_outbox_events_status_created',
+                 'status', 'created_at'),
+    )
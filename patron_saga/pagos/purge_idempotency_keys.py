@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+"""
+Cleanup job for expired Idempotency-Key records
+
+Deletes the stored response snapshots whose TTL (IDEMPOTENCY_KEY_TTL) has
+passed. Meant to be run periodically, e.g. from cron.
+"""
+
+from app import app
+from services import IdempotencyService
+
+
+def main():
+    with app.app_context():
+        deleted = IdempotencyService.purge_expired()
+    print(f"Deleted {deleted} expired idempotency key(s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify
 from models import db, Payment, PaymentStatus
 from services import PaymentService
+from saga_outbox import add_saga_event, SagaOutboxRelay
 import uuid
 from datetime import datetime
 import sys
@@ -11,11 +12,7 @@ sys.path.append(os.path.join(os.path.dirname(
     __file__), '..', 'saga_choreography'))
 
 try:
-    from event_bus import (
-        event_bus, SagaEvent,
-        publish_payment_processed, publish_payment_failed,
-        publish_payment_refunded
-    )
+    from event_bus import event_bus, EventBus, SagaEvent
     CHOREOGRAPHY_ENABLED = True
 except ImportError:
     CHOREOGRAPHY_ENABLED = False
@@ -103,7 +100,9 @@ def create_saga_payment():
                     'cart_id': cart_id,
                     'amount': str(amount),
                     'status': 'processed',
-                    'transaction_id': payment.reference_number
+                    'transaction_id': next(
+                        (t.gateway_transaction_id for t in payment.transactions
+                         if t.transaction_type == 'charge'), None)
                 }), 200
             else:
                 saga_payment.status = 'failed'
@@ -145,9 +144,16 @@ def refund_saga_payment(payment_id):
         if not saga_payment:
             return jsonify({'error': 'Saga payment not found'}), 404
 
+        # Compensation may be retried, or arrive from both saga styles
+        if saga_payment.status == 'refunded':
+            return jsonify({
+                'payment_id': payment_id,
+                'status': 'refunded',
+                'reason': reason
+            }), 200
+
         # Process refund using existing service
-        refund_data = {'reason': reason}
-        refund = PaymentService.refund_payment(payment_id, refund_data)
+        refund = PaymentService.refund_payment(payment_id, reason=reason)
 
         if refund:
             saga_payment.status = 'refunded'
@@ -234,23 +240,30 @@ class PaymentSagaHandler:
             PaymentService.process_payment(payment.id)
             payment = PaymentService.get_payment(payment.id)
 
+            # The event is stored with the status change and published by
+            # the outbox relay
             if payment.status == PaymentStatus.COMPLETED:
                 saga_payment.status = 'processed'
-                db.session.commit()
-
-                # Publish success event
-                publish_payment_processed(saga_id, payment.id, float(amount))
+                add_saga_event(SagaEvent.PAYMENT_PROCESSED, {
+                    'saga_id': saga_id,
+                    'payment_id': payment.id,
+                    'amount': float(amount)
+                })
             else:
                 saga_payment.status = 'failed'
-                db.session.commit()
-
-                # Publish failure event
-                publish_payment_failed(saga_id, 'Payment processing failed')
+                add_saga_event(SagaEvent.PAYMENT_FAILED, {
+                    'saga_id': saga_id,
+                    'reason': 'Payment processing failed'
+                })
+            db.session.commit()
 
         except Exception as e:
             db.session.rollback()
-            # Publish failure event
-            publish_payment_failed(saga_id, str(e))
+            add_saga_event(SagaEvent.PAYMENT_FAILED, {
+                'saga_id': saga_id,
+                'reason': str(e)
+            })
+            db.session.commit()
 
     def handle_payment_refund_requested(self, event):
         """Handle payment refund request for compensation"""
@@ -271,17 +284,20 @@ class PaymentSagaHandler:
                     f"Saga payment {payment_id} not found for saga {saga_id}")
                 return
 
+            if saga_payment.status == 'refunded':
+                return
+
             # Process refund using existing service
-            refund_data = {'reason': reason}
-            refund = PaymentService.refund_payment(payment_id, refund_data)
+            refund = PaymentService.refund_payment(payment_id, reason=reason)
 
             if refund:
                 saga_payment.status = 'refunded'
+                add_saga_event(SagaEvent.PAYMENT_REFUNDED, {
+                    'saga_id': saga_id,
+                    'payment_id': payment_id,
+                    'amount': str(refund.amount)
+                })
                 db.session.commit()
-
-                # Publish success event
-                publish_payment_refunded(
-                    saga_id, payment_id, str(refund.amount))
             else:
                 print(f"Failed to refund payment {payment_id}")
 
@@ -387,6 +403,17 @@ def process_saga_payment():
 if CHOREOGRAPHY_ENABLED:
     payment_saga_handler = PaymentSagaHandler()
 
+
+def start_saga_outbox_relay(app):
+    """Start publishing outbox events to the event bus, if it is available"""
+    if not CHOREOGRAPHY_ENABLED:
+        return None
+
+    # The relay gets its own connection, separate from the consumer's
+    relay = SagaOutboxRelay(app, EventBus())
+    relay.start()
+    return relay
+
 # Health check
 
 
@@ -0,0 +1,100 @@
+"""
+Transactional outbox for choreographed saga events.
+
+Saga handlers add their events with add_saga_event in the same transaction
+as the state change, instead of publishing to RabbitMQ after committing.
+SagaOutboxRelay publishes pending rows in order, in batches, waiting for
+publisher confirms, and marks them published. Delivery is at least once:
+a crash between the broker confirm and the commit republishes the batch.
+"""
+
+import json
+import threading
+from datetime import datetime
+from models import db, SagaOutboxEvent
+
+
+def add_saga_event(event_type, data, routing_key=None):
+    """Add a saga event to the outbox in the current transaction"""
+    event = SagaOutboxEvent(
+        event_type=event_type,
+        routing_key=routing_key or event_type,
+        payload={
+            'event_type': event_type,
+            'timestamp': datetime.utcnow().isoformat(),
+            'data': data
+        }
+    )
+    db.session.add(event)
+    return event
+
+
+class SagaOutboxRelay:
+
+    def __init__(self, app, event_bus, batch_size=100, poll_interval=0.5):
+        self.app = app
+        # Owned by the relay: pika connections must not be shared with the
+        # consumer thread
+        self.event_bus = event_bus
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='saga-outbox-relay', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def relay_once(self):
+        """Publish the oldest pending events, returning how many were published"""
+        with self.app.app_context():
+            try:
+                # SKIP LOCKED lets several relays share the outbox without
+                # publishing the same rows
+                events = SagaOutboxEvent.query.filter_by(status='pending')\
+                    .order_by(SagaOutboxEvent.created_at)\
+                    .limit(self.batch_size)\
+                    .with_for_update(skip_locked=True)\
+                    .all()
+
+                published = 0
+                failed = False
+                for event in events:
+                    try:
+                        self.event_bus.publish_confirmed(
+                            event.routing_key, json.dumps(event.payload))
+                    except Exception as e:
+                        # Stop at the first failure to keep events in order
+                        event.attempts += 1
+                        event.last_error = str(e)
+                        failed = True
+                        break
+                    event.status = 'published'
+                    event.published_at = datetime.utcnow()
+                    published += 1
+
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error relaying saga events: {str(e)}")
+                return 0
+
+        if failed:
+            # Reconnect on the next attempt
+            try:
+                self.event_bus.close()
+            except Exception:
+                pass
+        return published
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.relay_once() < self.batch_size:
+                self._stop.wait(self.poll_interval)
@@ -1,5 +1,6 @@
 from marshmallow import Schema, fields, validate, ValidationError, post_load
 from models import PaymentStatus, PaymentMethod
+from decimal import Decimal
 import re
 
 
@@ -55,9 +56,10 @@ class PaymentResponseSchema(Schema):
     merchant_id = fields.Str()
     order_id = fields.Str()
     amount = fields.Decimal(places=2)
+    refunded_amount = fields.Decimal(places=2)
     currency = fields.Str()
-    status = fields.Str()
-    payment_method = fields.Str()
+    status = fields.Enum(PaymentStatus, by_value=True)
+    payment_method = fields.Enum(PaymentMethod, by_value=True)
     customer_email = fields.Email()
     customer_name = fields.Str()
     card_last_four = fields.Str()
@@ -66,7 +68,7 @@ class PaymentResponseSchema(Schema):
     updated_at = fields.DateTime()
     processed_at = fields.DateTime()
     description = fields.Str()
-    metadata = fields.Dict()
+    metadata = fields.Dict(attribute='payment_metadata')
 
 
 class RefundRequestSchema(Schema):
@@ -84,6 +86,60 @@ class TransactionSchema(Schema):
     created_at = fields.DateTime()
 
 
+# Hand-written equivalents of PaymentResponseSchema and TransactionSchema
+# dumps for the read endpoints, which skip marshmallow's per-field dispatch.
+# They must produce the same output as the schemas.
+
+TWO_PLACES = Decimal('0.01')
+
+
+def _decimal(value):
+    return value.quantize(TWO_PLACES) if value is not None else None
+
+
+def _datetime(value):
+    return value.isoformat() if value is not None else None
+
+
+def serialize_transaction(transaction):
+    return {
+        'id': transaction.id,
+        'payment_id': transaction.payment_id,
+        'transaction_type': transaction.transaction_type,
+        'amount': _decimal(transaction.amount),
+        'status': transaction.status,
+        'gateway_transaction_id': transaction.gateway_transaction_id,
+        'created_at': _datetime(transaction.created_at)
+    }
+
+
+def serialize_payment(payment, include_transactions=False):
+    data = {
+        'id': payment.id,
+        'merchant_id': payment.merchant_id,
+        'order_id': payment.order_id,
+        'amount': _decimal(payment.amount),
+        'refunded_amount': _decimal(payment.refunded_amount),
+        'currency': payment.currency,
+        'status': payment.status.value if payment.status else None,
+        'payment_method': (payment.payment_method.value
+                           if payment.payment_method else None),
+        'customer_email': payment.customer_email,
+        'customer_name': payment.customer_name,
+        'card_last_four': payment.card_last_four,
+        'card_brand': payment.card_brand,
+        'created_at': _datetime(payment.created_at),
+        'updated_at': _datetime(payment.updated_at),
+        'processed_at': _datetime(payment.processed_at),
+        'description': payment.description,
+        'metadata': payment.payment_metadata
+    }
+    if include_transactions:
+        data['transactions'] = [serialize_transaction(transaction)
+                                for transaction in payment.transactions]
+    return data
+
+
 class ErrorResponseSchema(Schema):
     error = fields.Str(required=True)
     message = fields.Str(required=True)
@@ -1,42 +1,72 @@
-import random
-import time
 from datetime import datetime, timedelta
-from models import db, Payment, Transaction, PaymentStatus, PaymentMethod
-from sqlalchemy.exc import SQLAlchemyError
+from models import (
+    db, Payment, Transaction, PaymentStatus, PaymentMethod,
+    MerchantPaymentCounter, IdempotencyKey, PaymentBatch, PaymentRollup,
+    Merchant, WebhookEvent
+)
+from gateway import GatewayRunner, SimulatedGateway
+from sqlalchemy import and_, case, func, insert, literal, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import selectinload
+import base64
+import hashlib
+import hmac
+import json
+import time
 import uuid
 
 
+def increment(model, key, increments, **values):
+    """
+    Add increments to the counters of the row of model identified by key
+    (its primary key columns), creating the row if needed, within the
+    current transaction.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(model)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(model)
+    else:
+        row = model.query.get(tuple(key.values()))
+        if row is None:
+            db.session.add(model(**key, **increments, **values))
+        else:
+            for column, delta in increments.items():
+                setattr(row, column, getattr(model, column) + delta)
+            for column, value in values.items():
+                setattr(row, column, value)
+        return
+
+    stmt = stmt.values(**key, **increments, **values)
+    updates = {column: getattr(model, column) + delta
+               for column, delta in increments.items()}
+    updates.update(values)
+    stmt = stmt.on_conflict_do_update(index_elements=list(key), set_=updates)
+    db.session.execute(stmt)
+
+
 class PaymentService:
 
+    # Runner for the configured payment gateway, set up by the app
+    gateway = None
+
     @staticmethod
-    def create_payment(payment_data):
+    def create_payment(payment_data, idempotency_key=None):
         """Create a new payment record"""
         try:
-            # Extract card information if present
-            card_last_four = None
-            card_brand = None
-
-            if payment_data.get('card_number'):
-                card_number = payment_data['card_number'].replace(
-                    ' ', '').replace('-', '')
-                card_last_four = card_number[-4:]
-                card_brand = PaymentService._detect_card_brand(card_number)
-
-            payment = Payment(
-                merchant_id=payment_data['merchant_id'],
-                order_id=payment_data['order_id'],
-                amount=payment_data['amount'],
-                currency=payment_data.get('currency', 'USD'),
-                payment_method=PaymentMethod(payment_data['payment_method']),
-                customer_email=payment_data['customer_email'],
-                customer_name=payment_data['customer_name'],
-                card_last_four=card_last_four,
-                card_brand=card_brand,
-                description=payment_data.get('description'),
-                metadata=payment_data.get('metadata')
-            )
+            payment = Payment(**PaymentService._payment_fields(payment_data))
 
             db.session.add(payment)
+            PaymentService._increment_merchant_counter(payment.merchant_id)
+
+            # Link the key in the same transaction, so a retry after a crash
+            # finds the payment instead of creating another one
+            if idempotency_key is not None:
+                db.session.flush()
+                idempotency_key.payment_id = payment.id
+
             db.session.commit()
 
             return payment
@@ -46,8 +76,108 @@ class PaymentService:
             raise Exception(f"Database error: {str(e)}")
 
     @staticmethod
-    def process_payment(payment_id):
-        """Process a payment (simulate payment gateway processing)"""
+    def create_payment_batch(items, errors):
+        """
+        Bulk-insert the valid payments of a batch. items maps the position of
+        each valid item to its loaded data, errors maps the rejected ones to
+        their validation messages.
+        """
+        try:
+            batch = PaymentBatch(
+                total_items=len(items) + len(errors),
+                accepted_items=len(items),
+                rejected_items=len(errors),
+                results=[]
+            )
+            db.session.add(batch)
+            db.session.flush()
+
+            now = datetime.utcnow()
+            rows = []
+            results = {}
+            for index, payment_data in items.items():
+                row = PaymentService._payment_fields(payment_data)
+                row.update({
+                    'id': str(uuid.uuid4()),
+                    'status': PaymentStatus.PENDING,
+                    'batch_id': batch.id,
+                    'created_at': now,
+                    'updated_at': now
+                })
+                rows.append(row)
+                results[index] = {'index': index, 'payment_id': row['id']}
+
+            for index, messages in errors.items():
+                results[index] = {'index': index, 'errors': messages}
+
+            if rows:
+                db.session.execute(insert(Payment), rows)
+
+            merchant_counts = {}
+            for row in rows:
+                merchant_counts[row['merchant_id']] = merchant_counts.get(
+                    row['merchant_id'], 0) + 1
+            for merchant_id, count in merchant_counts.items():
+                PaymentService._increment_merchant_counter(merchant_id, count)
+
+            batch.results = [results[index] for index in sorted(results)]
+            db.session.commit()
+
+            return batch
+
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            raise Exception(f"Database error: {str(e)}")
+
+    @staticmethod
+    def get_batch(batch_id):
+        """Retrieve a payment batch by ID"""
+        return PaymentBatch.query.get(batch_id)
+
+    @staticmethod
+    def get_batch_statuses(batch_id):
+        """Current status of every payment of a batch, by payment ID"""
+        rows = db.session.query(Payment.id, Payment.status)\
+            .filter(Payment.batch_id == batch_id)
+        return {payment_id: status for payment_id, status in rows}
+
+    @staticmethod
+    def _payment_fields(payment_data):
+        """Column values for a new payment from validated request data"""
+        # Extract card information if present
+        card_last_four = None
+        card_brand = None
+
+        if payment_data.get('card_number'):
+            card_number = payment_data['card_number'].replace(
+                ' ', '').replace('-', '')
+            card_last_four = card_number[-4:]
+            card_brand = PaymentService._detect_card_brand(card_number)
+
+        return {
+            'merchant_id': payment_data['merchant_id'],
+            'order_id': payment_data['order_id'],
+            'amount': payment_data['amount'],
+            'currency': payment_data.get('currency', 'USD'),
+            'payment_method': PaymentMethod(payment_data['payment_method']),
+            'customer_email': payment_data['customer_email'],
+            'customer_name': payment_data['customer_name'],
+            'card_last_four': card_last_four,
+            'card_brand': card_brand,
+            'description': payment_data.get('description'),
+            'payment_metadata': payment_data.get('metadata')
+        }
+
+    @staticmethod
+    def get_gateway():
+        """Runner for the configured payment gateway"""
+        if PaymentService.gateway is None:
+            PaymentService.gateway = GatewayRunner(SimulatedGateway())
+        return PaymentService.gateway
+
+    @staticmethod
+    def begin_processing(payment_id):
+        """Claim a pending payment and build its gateway authorization request"""
         try:
             payment = Payment.query.get(payment_id)
             if not payment:
@@ -57,37 +187,78 @@ class PaymentService:
                 raise Exception(
                     f"Payment cannot be processed. Current status: {payment.status.value}")
 
-            # Update status to processing
-            payment.status = PaymentStatus.PROCESSING
-            payment.updated_at = datetime.utcnow()
+            # Claim the payment with a conditional update, so a payment handed
+            # to two workers is only processed once
+            claimed = Payment.query.filter_by(
+                id=payment_id, status=PaymentStatus.PENDING
+            ).update({
+                Payment.status: PaymentStatus.PROCESSING,
+                Payment.updated_at: datetime.utcnow()
+            }, synchronize_session=False)
             db.session.commit()
 
-            # Simulate processing time
-            time.sleep(1)
+            if not claimed:
+                raise Exception(
+                    "Payment cannot be processed. It is already being processed")
+
+            return {
+                'payment_id': payment.id,
+                'amount': str(payment.amount),
+                'currency': payment.currency,
+                'payment_method': payment.payment_method.value,
+                'card_brand': payment.card_brand,
+                # Stable across retries, so the gateway never charges twice
+                'idempotency_key': payment.id
+            }
 
-            # Simulate payment processing result (90% success rate)
-            success = random.random() > 0.1
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            raise Exception(f"Database error: {str(e)}")
 
-            if success:
-                payment.status = PaymentStatus.COMPLETED
-                payment.processed_at = datetime.utcnow()
+    @staticmethod
+    def complete_processing(payment_id, result):
+        """Record the gateway result for a payment in processing"""
+        try:
+            payment = Payment.query.get(payment_id)
+            if not payment:
+                raise Exception("Payment not found")
 
+            # Only a payment still in processing takes the result: a late or
+            # duplicate completion must not record a second charge, rollup or
+            # webhook for a payment that already has its outcome
+            approved = bool(result.get('approved'))
+            now = datetime.utcnow()
+            values = {
+                Payment.status: PaymentStatus.COMPLETED if approved
+                else PaymentStatus.FAILED,
+                Payment.updated_at: now
+            }
+            if approved:
+                values[Payment.processed_at] = now
+            updated = Payment.query.filter_by(
+                id=payment_id, status=PaymentStatus.PROCESSING
+            ).update(values, synchronize_session=False)
+
+            if not updated:
+                db.session.rollback()
+                return payment
+
+            db.session.refresh(payment)
+            if approved:
                 # Create successful transaction record
                 transaction = Transaction(
                     payment_id=payment.id,
                     transaction_type='charge',
                     amount=payment.amount,
                     status='completed',
-                    gateway_transaction_id=f"txn_{uuid.uuid4().hex[:12]}",
+                    gateway_transaction_id=result.get('gateway_transaction_id'),
                     gateway_response={
                         'status': 'success',
-                        'authorization_code': f"auth_{uuid.uuid4().hex[:8]}",
-                        'processor_response': 'Approved'
+                        'authorization_code': result.get('authorization_code'),
+                        'processor_response': result.get('processor_response')
                     }
                 )
             else:
-                payment.status = PaymentStatus.FAILED
-
                 # Create failed transaction record
                 transaction = Transaction(
                     payment_id=payment.id,
@@ -96,13 +267,16 @@ class PaymentService:
                     status='failed',
                     gateway_response={
                         'status': 'failed',
-                        'error_code': random.choice(['insufficient_funds', 'card_declined', 'expired_card']),
-                        'processor_response': 'Declined'
+                        'error_code': result.get('error_code'),
+                        'processor_response': result.get('processor_response')
                     }
                 )
 
-            payment.updated_at = datetime.utcnow()
             db.session.add(transaction)
+            ReportingService.record_outcome(
+                payment, payment.status.value, payment.amount, payment.updated_at)
+            WebhookService.enqueue_payment_event(
+                payment, WebhookService.EVENT_TYPES[payment.status])
             db.session.commit()
 
             return payment
@@ -112,19 +286,109 @@ class PaymentService:
             raise Exception(f"Database error: {str(e)}")
 
     @staticmethod
-    def get_payment(payment_id):
-        """Retrieve payment by ID"""
-        return Payment.query.get(payment_id)
+    def process_payment(payment_id):
+        """Process a payment through the gateway, waiting for the result"""
+        request = PaymentService.begin_processing(payment_id)
+        result = PaymentService.get_gateway().authorize_sync(request)
+        return PaymentService.complete_processing(payment_id, result)
 
     @staticmethod
-    def get_payments_by_merchant(merchant_id, limit=100, offset=0):
-        """Get payments for a specific merchant"""
-        return Payment.query.filter_by(merchant_id=merchant_id)\
-            .order_by(Payment.created_at.desc())\
+    def start_payment_processing(payment_id):
+        """Claim a payment and start its authorization without waiting for it"""
+        request = PaymentService.begin_processing(payment_id)
+        return PaymentService.get_gateway().authorize(request)
+
+    @staticmethod
+    def finish_payment_processing(payment_id, future):
+        """Record the outcome of an authorization started in the background"""
+        try:
+            result = future.result()
+        except Exception as e:
+            result = {
+                'approved': False,
+                'error_code': 'gateway_error',
+                'processor_response': str(e)
+            }
+        return PaymentService.complete_processing(payment_id, result)
+
+    @staticmethod
+    def get_payment(payment_id, include_transactions=False):
+        """Retrieve payment by ID, optionally with its transactions"""
+        if not include_transactions:
+            return Payment.query.get(payment_id)
+        return Payment.query.options(selectinload(Payment.transactions))\
+            .filter_by(id=payment_id)\
+            .first()
+
+    @staticmethod
+    def get_payments_by_merchant(merchant_id, limit=100, offset=0, cursor=None,
+                                 status=None, created_from=None, created_to=None):
+        """Get payments for a specific merchant, newest first"""
+        query = PaymentService._merchant_payments_query(
+            merchant_id, status, created_from, created_to)
+
+        if cursor is not None:
+            # Keyset pagination: seek past the last (created_at, id) seen,
+            # served by the (merchant_id, created_at, id) index
+            created_at, payment_id = cursor
+            query = query.filter(or_(
+                Payment.created_at < created_at,
+                and_(Payment.created_at == created_at, Payment.id < payment_id)
+            ))
+        elif offset:
+            query = query.offset(offset)
+
+        return query.order_by(Payment.created_at.desc(), Payment.id.desc())\
             .limit(limit)\
-            .offset(offset)\
             .all()
 
+    @staticmethod
+    def count_payments_by_merchant(merchant_id, status=None, created_from=None,
+                                   created_to=None):
+        """Exact number of payments matching the merchant listing filters"""
+        return PaymentService._merchant_payments_query(
+            merchant_id, status, created_from, created_to).count()
+
+    @staticmethod
+    def get_merchant_payment_count(merchant_id):
+        """Approximate number of payments of a merchant, from its counter"""
+        counter = MerchantPaymentCounter.query.get(merchant_id)
+        return counter.payment_count if counter else 0
+
+    @staticmethod
+    def encode_cursor(payment):
+        """Opaque cursor pointing just past the given payment"""
+        raw = f"{payment.created_at.isoformat()}|{payment.id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Decode a listing cursor into (created_at, payment_id)"""
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+            created_at, payment_id = raw.split('|', 1)
+            return datetime.fromisoformat(created_at), payment_id
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError('Invalid cursor')
+
+    @staticmethod
+    def _merchant_payments_query(merchant_id, status=None, created_from=None,
+                                 created_to=None):
+        query = Payment.query.filter(Payment.merchant_id == merchant_id)
+        if status:
+            query = query.filter(Payment.status.in_(status))
+        if created_from:
+            query = query.filter(Payment.created_at >= created_from)
+        if created_to:
+            query = query.filter(Payment.created_at < created_to)
+        return query
+
+    @staticmethod
+    def _increment_merchant_counter(merchant_id, count=1):
+        """Bump the merchant's payment counter in the current transaction"""
+        increment(MerchantPaymentCounter, {'merchant_id': merchant_id},
+                  {'payment_count': count}, updated_at=datetime.utcnow())
+
     @staticmethod
     def refund_payment(payment_id, refund_amount=None, reason=None):
         """Process a refund for a payment"""
@@ -137,17 +401,36 @@ class PaymentService:
                 raise Exception(
                     f"Cannot refund payment with status: {payment.status.value}")
 
-            # If no amount specified, refund the full amount
+            # If no amount specified, refund what is left of the payment
             if refund_amount is None:
-                refund_amount = payment.amount
-
-            if refund_amount > payment.amount:
+                refund_amount = payment.amount - payment.refunded_amount
+
+            if refund_amount <= 0:
+                raise Exception("Refund amount must be greater than zero")
+
+            # Add the refund with a conditional update, so concurrent refunds
+            # (e.g. compensations from both saga styles) can never exceed the
+            # payment amount. A full refund also moves it to REFUNDED
+            new_refunded = Payment.refunded_amount + refund_amount
+            refunded = Payment.query.filter(
+                Payment.id == payment_id,
+                Payment.status == PaymentStatus.COMPLETED,
+                new_refunded <= Payment.amount
+            ).update({
+                Payment.refunded_amount: new_refunded,
+                Payment.status: case(
+                    (new_refunded >= Payment.amount,
+                     literal(PaymentStatus.REFUNDED, Payment.status.type)),
+                    else_=Payment.status),
+                Payment.updated_at: datetime.utcnow()
+            }, synchronize_session=False)
+
+            if not refunded:
+                db.session.rollback()
                 raise Exception(
-                    "Refund amount cannot exceed original payment amount")
+                    "Refund amount cannot exceed the remaining refundable amount")
 
-            # Check if this is a full refund
-            if refund_amount == payment.amount:
-                payment.status = PaymentStatus.REFUNDED
+            db.session.refresh(payment)
 
             # Create refund transaction
             transaction = Transaction(
@@ -163,8 +446,12 @@ class PaymentService:
                 }
             )
 
-            payment.updated_at = datetime.utcnow()
             db.session.add(transaction)
+            ReportingService.record_outcome(
+                payment, PaymentStatus.REFUNDED.value, refund_amount,
+                payment.updated_at)
+            WebhookService.enqueue_payment_event(
+                payment, 'payment.refunded', refund_amount=str(refund_amount))
             db.session.commit()
 
             return transaction
@@ -173,6 +460,13 @@ class PaymentService:
             db.session.rollback()
             raise Exception(f"Database error: {str(e)}")
 
+    @staticmethod
+    def get_refunds(payment_id):
+        """Refund transactions of a payment, oldest first"""
+        return Transaction.query.filter_by(
+            payment_id=payment_id, transaction_type='refund'
+        ).order_by(Transaction.created_at).all()
+
     @staticmethod
     def _detect_card_brand(card_number):
         """Simple card brand detection"""
@@ -188,11 +482,225 @@ class PaymentService:
             return 'Unknown'
 
 
+class IdempotencyService:
+
+    @staticmethod
+    def request_hash(payload):
+        """Fingerprint of a request body, independent of key order"""
+        canonical = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    @staticmethod
+    def begin(key, request_hash, ttl, lock_timeout):
+        """
+        Look up an idempotency key, reserving it if it is new or expired, or
+        taking it over if the request holding it stopped before creating a
+        payment and its lock lapsed. Returns (record, created).
+        """
+        try:
+            now = datetime.utcnow()
+            record = IdempotencyKey.query.filter_by(key=key).first()
+            if record and record.expires_at <= now:
+                db.session.delete(record)
+                db.session.commit()
+                record = None
+
+            if record:
+                if IdempotencyService._take_over(record, request_hash,
+                                                 lock_timeout):
+                    return record, True
+                return record, False
+
+            record = IdempotencyKey(
+                key=key,
+                request_hash=request_hash,
+                locked_until=now + timedelta(seconds=lock_timeout),
+                expires_at=now + timedelta(seconds=ttl)
+            )
+            db.session.add(record)
+            db.session.commit()
+            return record, True
+
+        except IntegrityError:
+            # A concurrent request reserved the same key first
+            db.session.rollback()
+            return IdempotencyKey.query.filter_by(key=key).first(), False
+
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            raise Exception(f"Database error: {str(e)}")
+
+    @staticmethod
+    def _take_over(record, request_hash, lock_timeout):
+        """Claim a stale in_progress record, unless another request did first"""
+        if (record.status != 'in_progress' or record.payment_id
+                or record.request_hash != request_hash):
+            return False
+
+        now = datetime.utcnow()
+        claimed = IdempotencyKey.query.filter(
+            IdempotencyKey.id == record.id,
+            IdempotencyKey.status == 'in_progress',
+            IdempotencyKey.payment_id.is_(None),
+            or_(IdempotencyKey.locked_until.is_(None),
+                IdempotencyKey.locked_until <= now)
+        ).update({'locked_until': now + timedelta(seconds=lock_timeout)},
+                 synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            db.session.refresh(record)
+        return bool(claimed)
+
+    @staticmethod
+    def complete(record, response_code, response_body):
+        """Store the response to replay for retries of this key"""
+        try:
+            record.status = 'completed'
+            record.response_code = response_code
+            # Decimals and datetimes are stored as the strings sent to clients
+            record.response_body = json.loads(
+                json.dumps(response_body, default=str))
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            raise Exception(f"Database error: {str(e)}")
+
+    @staticmethod
+    def release(record):
+        """Forget a key whose request did not complete, so it can be retried"""
+        try:
+            db.session.delete(record)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+
+    @staticmethod
+    def purge_expired():
+        """Delete expired keys, returning how many were removed"""
+        try:
+            deleted = IdempotencyKey.query.filter(
+                IdempotencyKey.expires_at <= datetime.utcnow()
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            return deleted
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            raise Exception(f"Database error: {str(e)}")
+
+
+class ReportingService:
+
+    GRANULARITIES = ('hour', 'day')
+    DIMENSIONS = ('status', 'payment_method', 'card_brand', 'currency')
+
+    @staticmethod
+    def bucket_start(at, granularity):
+        if granularity == 'hour':
+            return at.replace(minute=0, second=0, microsecond=0)
+        return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def record_outcome(payment, status, amount, at):
+        """Add a charge or refund outcome to the payment rollups"""
+        for granularity in ReportingService.GRANULARITIES:
+            increment(PaymentRollup, {
+                'merchant_id': payment.merchant_id,
+                'granularity': granularity,
+                'bucket_start': ReportingService.bucket_start(at, granularity),
+                'status': status,
+                'payment_method': payment.payment_method.value,
+                'card_brand': payment.card_brand or '',
+                'currency': payment.currency
+            }, {'payment_count': 1, 'total_amount': amount})
+
+    @staticmethod
+    def get_payment_report(merchant_id, granularity='day', start=None,
+                           end=None, group_by=('status',)):
+        """Sum the merchant's rollups per bucket and the requested dimensions"""
+        group_columns = [getattr(PaymentRollup, dimension)
+                         for dimension in group_by]
+
+        query = db.session.query(
+            PaymentRollup.bucket_start,
+            *group_columns,
+            func.sum(PaymentRollup.payment_count).label('payment_count'),
+            func.sum(PaymentRollup.total_amount).label('total_amount')
+        ).filter(
+            PaymentRollup.merchant_id == merchant_id,
+            PaymentRollup.granularity == granularity
+        )
+        if start:
+            query = query.filter(PaymentRollup.bucket_start >= start)
+        if end:
+            query = query.filter(PaymentRollup.bucket_start < end)
+
+        rows = query.group_by(PaymentRollup.bucket_start, *group_columns)\
+            .order_by(PaymentRollup.bucket_start, *group_columns)\
+            .all()
+
+        return [{
+            'bucket_start': row.bucket_start.isoformat(),
+            **{dimension: getattr(row, dimension) for dimension in group_by},
+            'payment_count': int(row.payment_count),
+            'total_amount': f"{row.total_amount:.2f}"
+        } for row in rows]
+
+
 class WebhookService:
 
+    EVENT_TYPES = {
+        PaymentStatus.COMPLETED: 'payment.completed',
+        PaymentStatus.FAILED: 'payment.failed',
+        PaymentStatus.REFUNDED: 'payment.refunded'
+    }
+
+    @staticmethod
+    def enqueue_payment_event(payment, event_type, **data):
+        """Add a notification for the payment's merchant to the webhook outbox"""
+        merchant = Merchant.query.filter_by(
+            merchant_id=payment.merchant_id).first()
+        if not merchant or not merchant.is_active or not merchant.webhook_url:
+            return None
+
+        event_id = str(uuid.uuid4())
+        event = WebhookEvent(
+            id=event_id,
+            merchant_id=payment.merchant_id,
+            event_type=event_type,
+            payload={
+                'id': event_id,
+                'type': event_type,
+                'created_at': datetime.utcnow().isoformat(),
+                'data': {
+                    'payment_id': payment.id,
+                    'order_id': payment.order_id,
+                    'status': payment.status.value,
+                    'amount': str(payment.amount),
+                    'currency': payment.currency,
+                    **data
+                }
+            }
+        )
+        db.session.add(event)
+        return event
+
+    @staticmethod
+    def sign(secret, timestamp, body):
+        """HMAC-SHA256 signature of a delivery, sent as X-Webhook-Signature"""
+        message = f"{timestamp}.{body}".encode()
+        return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
     @staticmethod
-    def send_webhook(merchant_webhook_url, payment_data):
-        """Send webhook notification (simplified implementation)"""
-        # In a real implementation, this would send HTTP POST request
-        # to the merchant's webhook URL with payment status updates
-        pass
+    def send_webhook(session, merchant_webhook_url, secret, events, timeout=5):
+        """POST a batch of events to a merchant, raising if it is not accepted"""
+        body = json.dumps({'events': events}, separators=(',', ':'))
+        timestamp = str(int(time.time()))
+        response = session.post(merchant_webhook_url, data=body, timeout=timeout,
+                                headers={
+                                    'Content-Type': 'application/json',
+                                    'X-Webhook-Timestamp': timestamp,
+                                    'X-Webhook-Signature': 'sha256=' + WebhookService.sign(
+                                        secret, timestamp, body)
+                                })
+        response.raise_for_status()
+        return response
@@ -1,19 +1,29 @@
 import pytest
 import json
-from app import create_app
-from models import db
+from unittest.mock import Mock, patch
+import threading
+import requests
+import app as payments_app
+from models import db, Merchant, WebhookEvent, SagaOutboxEvent
+from workers import PaymentWorkerPool, QueueFullError
+from gateway import GatewayRunner, SimulatedGateway
+from services import PaymentService, WebhookService
+from webhooks import WebhookDispatcher
+from saga_outbox import add_saga_event, SagaOutboxRelay
 
 
 @pytest.fixture
 def app():
-    app = create_app()
+    app = payments_app.app
     app.config['TESTING'] = True
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
 
-    with app.app_context():
-        db.create_all()
-        yield app
-        db.drop_all()
+    # Keep background processing out of the API tests
+    with patch.object(payments_app.payment_workers, 'submit'):
+        with app.app_context():
+            db.create_all()
+            yield app
+            db.session.remove()
+            db.drop_all()
 
 
 @pytest.fixture
@@ -113,3 +123,680 @@ def test_payment_not_found(client):
 
     data = json.loads(response.data)
     assert data['error'] == 'Not Found'
+
+
+def test_create_payment_queue_full(client):
+    """Test backpressure when the payment workers are saturated"""
+    payment_data = {
+        "merchant_id": "test_merchant",
+        "order_id": "test_order_789",
+        "amount": 10.00,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    }
+
+    with patch.object(payments_app.payment_workers, 'is_saturated', return_value=True):
+        response = client.post('/api/v1/payments',
+                               data=json.dumps(payment_data),
+                               content_type='application/json')
+
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_worker_pool_bounded_queue(app):
+    """Test the worker pool rejects work when full and drains on shutdown"""
+    processed = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def process(payment_id):
+        started.set()
+        release.wait(5)
+        processed.append(payment_id)
+
+    pool = PaymentWorkerPool(app, process, num_workers=1, max_queue_size=1,
+                             recovery_interval=3600)
+    pool.submit('payment-1')
+    assert started.wait(5)
+
+    pool.submit('payment-2')
+    assert pool.is_saturated()
+    with pytest.raises(QueueFullError):
+        pool.submit('payment-3')
+
+    release.set()
+    pool.shutdown(timeout=5)
+    assert processed == ['payment-1', 'payment-2']
+
+    with pytest.raises(QueueFullError):
+        pool.submit('payment-4')
+
+
+def test_worker_pool_start_recovers_pending_payments(app, client):
+    """Test starting the pool processes pending payments with no new submit"""
+    response = client.post('/api/v1/payments', json={
+        "merchant_id": "test_merchant",
+        "order_id": "test_order_recover",
+        "amount": 10.00,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    })
+    payment_id = json.loads(response.data)['id']
+
+    processed = threading.Event()
+    pool = PaymentWorkerPool(app, lambda pid: processed.set(), num_workers=1,
+                             recovery_interval=3600)
+    with patch.object(pool, 'submit', wraps=pool.submit) as submit:
+        pool.start()
+        assert processed.wait(5)
+    pool.shutdown(timeout=5)
+    submit.assert_called_once_with(payment_id)
+
+
+BOOT_AS_MAIN = """
+import json
+import runpy
+from unittest.mock import patch
+import flask
+from workers import PaymentWorkerPool
+
+with patch.object(flask.Flask, 'run'), \\
+        patch.object(PaymentWorkerPool, 'start', autospec=True) as start:
+    runpy.run_path('app.py', run_name='__main__')
+print(json.dumps({'worker_pool_starts': start.call_count}))
+"""
+
+
+def test_app_main_starts_payment_workers():
+    """Test `python app.py` starts the worker pool, and with it recovery"""
+    import os
+    import subprocess
+    import sys
+
+    result = subprocess.run(
+        [sys.executable, '-c', BOOT_AS_MAIN],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, DATABASE_URL='sqlite:///:memory:',
+                 WEBHOOK_DISPATCHER_ENABLED='false'),
+        capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    outcome = json.loads(result.stdout.strip().splitlines()[-1])
+    assert outcome['worker_pool_starts'] == 1
+
+
+def test_simulated_gateway_outcomes():
+    """Test the simulated gateway error mix and timeouts"""
+    runner = GatewayRunner(SimulatedGateway(
+        latency_p50_ms=1, latency_p99_ms=1, error_mix={'card_declined': 1.0}))
+    result = runner.authorize_sync({'payment_id': 'p1', 'amount': '10.00'})
+    assert result['approved'] is False
+    assert result['error_code'] == 'card_declined'
+
+    runner = GatewayRunner(SimulatedGateway(
+        latency_p50_ms=200, latency_p99_ms=200, timeout_ms=5, error_mix={}))
+    result = runner.authorize_sync({'payment_id': 'p2', 'amount': '10.00'})
+    assert result['error_code'] == 'gateway_timeout'
+
+
+def test_process_payment_through_gateway(client):
+    """Test a payment is completed with the gateway result"""
+    payment_data = {
+        "merchant_id": "test_merchant",
+        "order_id": "test_order_321",
+        "amount": 25.00,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    }
+    response = client.post('/api/v1/payments',
+                           data=json.dumps(payment_data),
+                           content_type='application/json')
+    payment_id = json.loads(response.data)['id']
+
+    gateway = GatewayRunner(SimulatedGateway(
+        latency_p50_ms=1, latency_p99_ms=1, error_mix={}))
+    with patch.object(PaymentService, 'gateway', gateway):
+        PaymentService.process_payment(payment_id)
+
+    response = client.get(f'/api/v1/payments/{payment_id}')
+    assert json.loads(response.data)['status'] == 'completed'
+
+    response = client.get(f'/api/v1/payments/{payment_id}/transactions')
+    transactions = json.loads(response.data)
+    assert len(transactions) == 1
+    assert transactions[0]['gateway_transaction_id'].startswith('txn_')
+
+
+def test_payment_retry_after_failed_completion_is_not_charged_twice(client):
+    """Test re-processing a payment reuses its gateway authorization"""
+    from models import Payment, PaymentStatus
+
+    payment_data = {
+        "merchant_id": "test_merchant",
+        "order_id": "test_order_retry",
+        "amount": 25.00,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    }
+    response = client.post('/api/v1/payments',
+                           data=json.dumps(payment_data),
+                           content_type='application/json')
+    payment_id = json.loads(response.data)['id']
+
+    gateway = SimulatedGateway(latency_p50_ms=1, latency_p99_ms=1, error_mix={})
+    runner = GatewayRunner(gateway)
+    with patch.object(PaymentService, 'gateway', runner):
+        with patch.object(PaymentService, 'complete_processing',
+                          side_effect=Exception('Database error: gone')):
+            with pytest.raises(Exception):
+                PaymentService.process_payment(payment_id)
+
+        # What recover() does once the payment has been PROCESSING too long
+        Payment.query.filter_by(id=payment_id).update(
+            {Payment.status: PaymentStatus.PENDING})
+        db.session.commit()
+
+        with patch.object(gateway, '_authorize', wraps=gateway._authorize) as charge:
+            PaymentService.process_payment(payment_id)
+        charge.assert_not_called()
+
+    first = gateway._authorizations[payment_id].result()
+    transactions = json.loads(client.get(
+        f'/api/v1/payments/{payment_id}/transactions').data)
+    assert [t['gateway_transaction_id'] for t in transactions] == [
+        first['gateway_transaction_id']]
+
+def test_complete_processing_ignores_payment_not_processing(client):
+    """Test a duplicate gateway result records nothing for a finished payment"""
+    from models import Payment, PaymentStatus, Transaction
+
+    response = client.post('/api/v1/payments', json={
+        "merchant_id": "test_merchant",
+        "order_id": "test_order_duplicate_result",
+        "amount": 25.00,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    })
+    payment_id = json.loads(response.data)['id']
+    PaymentService.begin_processing(payment_id)
+    PaymentService.complete_processing(payment_id, {'approved': True})
+
+    with patch('services.ReportingService.record_outcome') as record, \
+            patch.object(WebhookService, 'enqueue_payment_event') as enqueue:
+        payment = PaymentService.complete_processing(
+            payment_id, {'approved': False, 'error_code': 'card_declined'})
+    record.assert_not_called()
+    enqueue.assert_not_called()
+
+    assert payment.status == PaymentStatus.COMPLETED
+    assert db.session.get(Payment, payment_id).status == PaymentStatus.COMPLETED
+    assert Transaction.query.filter_by(payment_id=payment_id).count() == 1
+
+
+def test_list_payments_keyset_pagination(client):
+    """Test paging through a merchant's payments with cursors and filters"""
+    for i in range(5):
+        client.post('/api/v1/payments',
+                    data=json.dumps({
+                        "merchant_id": "list_merchant",
+                        "order_id": f"list_order_{i}",
+                        "amount": 10.00 + i,
+                        "payment_method": "paypal",
+                        "customer_email": "test@example.com",
+                        "customer_name": "Test Customer"
+                    }),
+                    content_type='application/json')
+
+    seen = []
+    cursor = None
+    while True:
+        url = '/api/v1/payments?merchant_id=list_merchant&limit=2'
+        if cursor:
+            url += f'&cursor={cursor}'
+        data = json.loads(client.get(url).data)
+        assert data['total'] == 5
+        assert data['total_is_approximate'] is False
+        seen.extend(payment['id'] for payment in data['payments'])
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+    assert len(seen) == len(set(seen)) == 5
+
+    response = client.get(
+        '/api/v1/payments?merchant_id=list_merchant&include_total=approximate')
+    data = json.loads(response.data)
+    assert data['total'] == 5
+    assert data['total_is_approximate'] is True
+
+    response = client.get(
+        '/api/v1/payments?merchant_id=list_merchant&status=completed')
+    data = json.loads(response.data)
+    assert data['payments'] == []
+    assert data['total'] == 0
+
+    response = client.get(
+        '/api/v1/payments?merchant_id=list_merchant&cursor=not-a-cursor')
+    assert response.status_code == 400
+
+
+def test_create_payment_idempotency_key(client):
+    """Test retries with the same Idempotency-Key return the original payment"""
+    payment_data = {
+        "merchant_id": "test_merchant",
+        "order_id": "test_order_idem",
+        "amount": 15.00,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    }
+    headers = {'Idempotency-Key': 'order-idem-attempt'}
+
+    first = client.post('/api/v1/payments', data=json.dumps(payment_data),
+                        content_type='application/json', headers=headers)
+    assert first.status_code == 201
+
+    retry = client.post('/api/v1/payments', data=json.dumps(payment_data),
+                        content_type='application/json', headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert json.loads(retry.data)['id'] == json.loads(first.data)['id']
+
+    listing = json.loads(client.get(
+        '/api/v1/payments?merchant_id=test_merchant').data)
+    assert listing['total'] == 1
+
+    payment_data['amount'] = 20.00
+    conflict = client.post('/api/v1/payments', data=json.dumps(payment_data),
+                           content_type='application/json', headers=headers)
+    assert conflict.status_code == 422
+
+
+
+def test_idempotency_key_taken_over_after_lock_lapses(app, client):
+    """Test a key left in progress by a dead request can be retried"""
+    from datetime import datetime, timedelta
+    from models import IdempotencyKey
+    from services import IdempotencyService
+
+    payment_data = {
+        "merchant_id": "test_merchant",
+        "order_id": "test_order_stale_idem",
+        "amount": 15.00,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    }
+    headers = {'Idempotency-Key': 'order-stale-attempt'}
+
+    # The first request reserved the key and died before its payment
+    IdempotencyService.begin(
+        'order-stale-attempt', IdempotencyService.request_hash(payment_data),
+        app.config['IDEMPOTENCY_KEY_TTL'],
+        app.config['IDEMPOTENCY_LOCK_TIMEOUT'])
+
+    busy = client.post('/api/v1/payments', data=json.dumps(payment_data),
+                       content_type='application/json', headers=headers)
+    assert busy.status_code == 409
+
+    record = IdempotencyKey.query.filter_by(key='order-stale-attempt').one()
+    record.locked_until = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+
+    retry = client.post('/api/v1/payments', data=json.dumps(payment_data),
+                        content_type='application/json', headers=headers)
+    assert retry.status_code == 201
+
+    replay = client.post('/api/v1/payments', data=json.dumps(payment_data),
+                         content_type='application/json', headers=headers)
+    assert replay.status_code == 201
+    assert replay.headers['Idempotent-Replayed'] == 'true'
+    assert json.loads(replay.data)['id'] == json.loads(retry.data)['id']
+
+def test_create_payment_batch(client):
+    """Test batch creation with per-item results and batch status"""
+    payment = {
+        "merchant_id": "batch_merchant",
+        "order_id": "batch_order",
+        "amount": 12.50,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    }
+    batch = {"payments": [
+        payment,
+        dict(payment, order_id="batch_order_2"),
+        dict(payment, amount="invalid"),
+        dict(payment, payment_method="credit_card")
+    ]}
+
+    response = client.post('/api/v1/payments/batch',
+                           data=json.dumps(batch),
+                           content_type='application/json')
+    assert response.status_code == 201
+    data = json.loads(response.data)
+    assert data['accepted_items'] == 2
+    assert data['rejected_items'] == 2
+    assert [item['status'] for item in data['items']] == [
+        'pending', 'pending', 'rejected', 'rejected']
+    assert 'amount' in data['items'][2]['errors']
+    assert payments_app.payment_workers.submit.call_count == 2
+
+    response = client.get(f"/api/v1/payments/batch/{data['batch_id']}")
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['status'] == 'processing'
+    assert data['status_counts'] == {'pending': 2, 'rejected': 2}
+
+    listing = json.loads(client.get(
+        '/api/v1/payments?merchant_id=batch_merchant&include_total=approximate').data)
+    assert listing['total'] == 2
+
+
+def test_payment_report_rollups(client):
+    """Test the report is built from rollups updated on processing and refund"""
+    payment_ids = []
+    for amount in (30.00, 20.00):
+        response = client.post('/api/v1/payments',
+                               data=json.dumps({
+                                   "merchant_id": "report_merchant",
+                                   "order_id": f"report_order_{amount}",
+                                   "amount": amount,
+                                   "payment_method": "paypal",
+                                   "customer_email": "test@example.com",
+                                   "customer_name": "Test Customer"
+                               }),
+                               content_type='application/json')
+        payment_ids.append(json.loads(response.data)['id'])
+
+    PaymentService.begin_processing(payment_ids[0])
+    PaymentService.complete_processing(payment_ids[0], {'approved': True})
+    PaymentService.begin_processing(payment_ids[1])
+    PaymentService.complete_processing(
+        payment_ids[1], {'approved': False, 'error_code': 'card_declined'})
+    client.post(f'/api/v1/payments/{payment_ids[0]}/refund',
+                data=json.dumps({"amount": 5.00}),
+                content_type='application/json')
+
+    response = client.get('/api/v1/reports/payments?merchant_id=report_merchant')
+    assert response.status_code == 200
+    buckets = {bucket['status']: bucket
+               for bucket in json.loads(response.data)['buckets']}
+    assert buckets['completed']['total_amount'] == '30.00'
+    assert buckets['failed']['payment_count'] == 1
+    assert buckets['refunded']['total_amount'] == '5.00'
+
+    response = client.get(
+        '/api/v1/reports/payments?merchant_id=report_merchant&group_by=weekday')
+    assert response.status_code == 400
+
+
+def test_get_payment_include_transactions(client):
+    """Test embedding transactions and the fast serializers match the schemas"""
+    response = client.post('/api/v1/payments',
+                           data=json.dumps({
+                               "merchant_id": "test_merchant",
+                               "order_id": "test_order_include",
+                               "amount": 42.10,
+                               "payment_method": "credit_card",
+                               "customer_email": "test@example.com",
+                               "customer_name": "Test Customer",
+                               "card_number": "4111111111111111",
+                               "card_expiry_month": 12,
+                               "card_expiry_year": 2030,
+                               "card_cvv": "123",
+                               "metadata": {"channel": "web"}
+                           }),
+                           content_type='application/json')
+    payment_id = json.loads(response.data)['id']
+    PaymentService.begin_processing(payment_id)
+    PaymentService.complete_processing(payment_id, {
+        'approved': True, 'gateway_transaction_id': 'txn_test'})
+
+    response = client.get(f'/api/v1/payments/{payment_id}?include=transactions')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['status'] == 'completed'
+    assert [t['gateway_transaction_id'] for t in data['transactions']] == ['txn_test']
+
+    payment = PaymentService.get_payment(payment_id, include_transactions=True)
+    expected = payments_app.payment_response_schema.dump(payment)
+    expected['transactions'] = payments_app.transaction_schema.dump(
+        payment.transactions, many=True)
+    assert json.loads(payments_app.app.json.dumps(expected)) == data
+
+    response = client.get(f'/api/v1/payments/{payment_id}')
+    assert 'transactions' not in json.loads(response.data)
+
+
+def test_webhook_outbox_delivery(app, client):
+    """Test payment events are batched, signed and retried per merchant"""
+    db.session.add(Merchant(merchant_id='hook_merchant', name='Hook Merchant',
+                            email='hook@example.com', api_key='secret',
+                            webhook_url='http://merchant.test/webhooks'))
+    db.session.commit()
+
+    for i in range(2):
+        response = client.post('/api/v1/payments',
+                               data=json.dumps({
+                                   "merchant_id": "hook_merchant",
+                                   "order_id": f"hook_order_{i}",
+                                   "amount": 10.00,
+                                   "payment_method": "paypal",
+                                   "customer_email": "test@example.com",
+                                   "customer_name": "Test Customer"
+                               }),
+                               content_type='application/json')
+        payment_id = json.loads(response.data)['id']
+        PaymentService.begin_processing(payment_id)
+        PaymentService.complete_processing(payment_id, {'approved': True})
+
+    session = Mock()
+    session.post.return_value.raise_for_status.side_effect = \
+        requests.ConnectionError('refused')
+    dispatcher = WebhookDispatcher(app, session=session, retry_base=60)
+
+    dispatcher.dispatch_due(wait=True)
+    events = WebhookEvent.query.all()
+    assert [event.status for event in events] == ['pending', 'pending']
+    assert all(event.attempts == 1 for event in events)
+
+    for event in events:
+        event.next_attempt_at = event.created_at
+    db.session.commit()
+    session.post.return_value.raise_for_status.side_effect = None
+    dispatcher.dispatch_due(wait=True)
+
+    db.session.expire_all()
+    assert {event.status for event in WebhookEvent.query.all()} == {'delivered'}
+    args, kwargs = session.post.call_args
+    assert args[0] == 'http://merchant.test/webhooks'
+    body = json.loads(kwargs['data'])
+    assert [e['type'] for e in body['events']] == ['payment.completed'] * 2
+    assert kwargs['headers']['X-Webhook-Signature'] == 'sha256=' + WebhookService.sign(
+        'secret', kwargs['headers']['X-Webhook-Timestamp'], kwargs['data'])
+
+
+def test_webhook_unexpected_error_records_attempt(app, client):
+    """Test an unexpected delivery error still records the attempt and frees the claim"""
+    db.session.add(Merchant(merchant_id='broken_merchant', name='Broken Merchant',
+                            email='broken@example.com', api_key='secret',
+                            webhook_url='http://merchant.test/webhooks'))
+    db.session.commit()
+
+    response = client.post('/api/v1/payments',
+                           data=json.dumps({
+                               "merchant_id": "broken_merchant",
+                               "order_id": "broken_order",
+                               "amount": 10.00,
+                               "payment_method": "paypal",
+                               "customer_email": "test@example.com",
+                               "customer_name": "Test Customer"
+                           }),
+                           content_type='application/json')
+    payment_id = json.loads(response.data)['id']
+    PaymentService.begin_processing(payment_id)
+    PaymentService.complete_processing(payment_id, {'approved': True})
+
+    dispatcher = WebhookDispatcher(app, session=Mock(), retry_base=60)
+    with patch.object(WebhookService, 'send_webhook', side_effect=ValueError('bad payload')):
+        dispatcher.dispatch_due(wait=True)
+
+    db.session.expire_all()
+    event = WebhookEvent.query.filter_by(merchant_id='broken_merchant').one()
+    assert (event.status, event.attempts, event.claim_token) == ('pending', 1, None)
+    assert event.last_error == 'bad payload'
+    # Merchants without deliveries in flight are not tracked
+    assert dispatcher._in_flight == {}
+
+
+def test_webhook_claims_limited_and_refreshed(app, client):
+    """Test only idle workers get claims, and a released claim is not delivered"""
+    db.session.add(Merchant(merchant_id='slow_merchant', name='Slow Merchant',
+                            email='slow@example.com', api_key='secret',
+                            webhook_url='http://merchant.test/webhooks'))
+    db.session.commit()
+
+    response = client.post('/api/v1/payments', json={
+        "merchant_id": "slow_merchant",
+        "order_id": "slow_order",
+        "amount": 10.00,
+        "payment_method": "paypal",
+        "customer_email": "test@example.com",
+        "customer_name": "Test Customer"
+    })
+    payment_id = json.loads(response.data)['id']
+    PaymentService.begin_processing(payment_id)
+    PaymentService.complete_processing(payment_id, {'approved': True})
+
+    session = Mock()
+    dispatcher = WebhookDispatcher(app, num_workers=1, session=session)
+    # The only worker is busy, so nothing is claimed to wait behind it
+    dispatcher._acquire_merchant('other_merchant')
+    assert dispatcher.dispatch_due(wait=True) == []
+    assert WebhookEvent.query.one().status == 'pending'
+    dispatcher._release_merchant('other_merchant')
+
+    # Claimed, then released by the stale claim sweep before delivery started
+    claim_token = dispatcher._claim('slow_merchant')
+    WebhookEvent.query.update({WebhookEvent.status: 'pending',
+                               WebhookEvent.claim_token: None})
+    db.session.commit()
+    dispatcher._acquire_merchant('slow_merchant')
+    dispatcher._deliver('slow_merchant', claim_token)
+    session.post.assert_not_called()
+
+    dispatcher.dispatch_due(wait=True)
+    session.post.assert_called_once()
+    db.session.expire_all()
+    assert WebhookEvent.query.one().status == 'delivered'
+
+
+def test_partial_refunds_ledger(client):
+    """Test partial refunds accumulate and cannot exceed the payment amount"""
+    response = client.post('/api/v1/payments',
+                           data=json.dumps({
+                               "merchant_id": "test_merchant",
+                               "order_id": "test_order_refunds",
+                               "amount": 50.00,
+                               "payment_method": "paypal",
+                               "customer_email": "test@example.com",
+                               "customer_name": "Test Customer"
+                           }),
+                           content_type='application/json')
+    payment_id = json.loads(response.data)['id']
+    PaymentService.begin_processing(payment_id)
+    PaymentService.complete_processing(payment_id, {'approved': True})
+
+    for amount in (20.00, 20.00):
+        response = client.post(f'/api/v1/payments/{payment_id}/refund',
+                               data=json.dumps({"amount": amount}),
+                               content_type='application/json')
+        assert response.status_code == 200
+
+    response = client.post(f'/api/v1/payments/{payment_id}/refund',
+                           data=json.dumps({"amount": 20.00}),
+                           content_type='application/json')
+    assert response.status_code == 400
+
+    ledger = json.loads(client.get(f'/api/v1/payments/{payment_id}/refunds').data)
+    assert ledger['refunded_amount'] == '40.00'
+    assert ledger['refundable_amount'] == '10.00'
+    assert len(ledger['refunds']) == 2
+
+    # Without an amount, the remainder is refunded
+    response = client.post(f'/api/v1/payments/{payment_id}/refund')
+    assert json.loads(response.data)['amount'] == '10.00'
+    payment = json.loads(client.get(f'/api/v1/payments/{payment_id}').data)
+    assert payment['status'] == 'refunded'
+    assert payment['refunded_amount'] == '50.00'
+
+
+def test_saga_outbox_relay(app):
+    """Test outbox events are published in order and kept on broker errors"""
+    for i in range(3):
+        add_saga_event('payment.processed', {'saga_id': f'saga-{i}'})
+    db.session.commit()
+
+    bus = Mock()
+    bus.publish_confirmed.side_effect = [None, Exception('channel closed')]
+    relay = SagaOutboxRelay(app, bus)
+    assert relay.relay_once() == 1
+    bus.close.assert_called_once()
+
+    bus.publish_confirmed.side_effect = None
+    assert relay.relay_once() == 2
+
+    db.session.expire_all()
+    events = SagaOutboxEvent.query.order_by(SagaOutboxEvent.created_at).all()
+    assert {event.status for event in events} == {'published'}
+    assert [event.attempts for event in events] == [0, 1, 0]
+    published = [json.loads(call.args[1])['data']['saga_id']
+                 for call in bus.publish_confirmed.call_args_list]
+    assert published == ['saga-0', 'saga-1', 'saga-1', 'saga-2']
+
+
+BOOT_AND_CALL_SAGA = """
+import json
+from unittest.mock import patch
+from app import app
+from gateway import GatewayRunner, SimulatedGateway
+from services import PaymentService
+
+client = app.test_client()
+gateway = GatewayRunner(SimulatedGateway(
+    latency_p50_ms=1, latency_p99_ms=1, error_mix={}))
+with patch.object(PaymentService, 'gateway', gateway):
+    response = client.post('/api/v1/payments/saga', json={
+        'saga_id': 'saga-boot',
+        'cart_id': 'cart-boot',
+        'amount': 15.00,
+        'payment_method': 'credit_card',
+        'customer_email': 'test@example.com'
+    })
+print(json.dumps({'status_code': response.status_code,
+                  'body': response.get_json()}))
+"""
+
+
+def test_app_startup_creates_saga_tables():
+    """Test the app as booted by `python app.py` serves the saga payment route"""
+    import os
+    import subprocess
+    import sys
+
+    # A fresh interpreter, so only the startup path imports the saga models
+    result = subprocess.run(
+        [sys.executable, '-c', BOOT_AND_CALL_SAGA],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, DATABASE_URL='sqlite:///:memory:'),
+        capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+    outcome = json.loads(result.stdout.strip().splitlines()[-1])
+    assert outcome['status_code'] == 200, outcome
+    assert outcome['body']['status'] == 'processed'
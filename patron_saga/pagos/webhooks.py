@@ -0,0 +1,254 @@
+"""
+Asynchronous delivery of merchant webhooks.
+
+Payment changes only write WebhookEvent rows (the outbox) in their own
+transaction, so payment latency does not depend on merchant endpoints. The
+dispatcher polls the outbox, claims due events per merchant and delivers
+them in batches from a thread pool sharing one pooled HTTP session. Each
+merchant has at most merchant_concurrency deliveries in flight, and failed
+deliveries are retried with exponential backoff until max_attempts.
+"""
+
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import requests
+from requests.adapters import HTTPAdapter
+from models import db, Merchant, WebhookEvent
+from services import WebhookService
+
+
+class WebhookDispatcher:
+
+    def __init__(self, app, num_workers=4, merchant_concurrency=1,
+                 batch_size=50, poll_interval=1, timeout=5, max_attempts=8,
+                 retry_base=5, retry_max=3600, session=None):
+        self.app = app
+        self.num_workers = num_workers
+        self.merchant_concurrency = merchant_concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=num_workers,
+                                  pool_maxsize=num_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+        self._executor = None
+        # merchant_id -> deliveries in flight; only merchants with deliveries
+        # in flight have an entry, so it stays as small as the worker pool
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._started = False
+
+    def start(self):
+        """Start polling the outbox (idempotent)"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        thread = threading.Thread(
+            target=self._poll, name='webhook-dispatcher', daemon=True)
+        thread.start()
+
+    def shutdown(self, wait=True):
+        self._stop.set()
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+
+    def dispatch_due(self, wait=False):
+        """Claim due events and schedule their delivery, one batch per merchant"""
+        futures = []
+        # Claim no more batches than there are idle workers: a claim waiting
+        # in the executor queue would age towards the stale claim cutoff
+        free_workers = self.num_workers - self._deliveries_in_flight()
+        if free_workers <= 0:
+            return futures
+
+        with self.app.app_context():
+            try:
+                self._release_stale_claims()
+
+                merchant_ids = [row.merchant_id for row in
+                                db.session.query(WebhookEvent.merchant_id)
+                                .filter(WebhookEvent.status == 'pending',
+                                        WebhookEvent.next_attempt_at <= datetime.utcnow())
+                                .distinct()
+                                .limit(free_workers)]
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error polling webhook outbox: {str(e)}")
+                return futures
+
+        for merchant_id in merchant_ids:
+            if not self._acquire_merchant(merchant_id):
+                continue
+
+            try:
+                with self.app.app_context():
+                    claim_token = self._claim(merchant_id)
+            except Exception as e:
+                self._release_merchant(merchant_id)
+                print(f"Error claiming webhooks for {merchant_id}: {str(e)}")
+                continue
+
+            if claim_token is None:
+                self._release_merchant(merchant_id)
+                continue
+
+            futures.append(self._get_executor().submit(
+                self._deliver, merchant_id, claim_token))
+
+        if wait:
+            for future in futures:
+                future.result()
+        return futures
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self.dispatch_due()
+            self._stop.wait(self.poll_interval)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.num_workers, thread_name_prefix='webhook')
+            return self._executor
+
+    def _acquire_merchant(self, merchant_id):
+        """Take one of the merchant's delivery slots, if one is free"""
+        with self._lock:
+            in_flight = self._in_flight.get(merchant_id, 0)
+            if in_flight >= self.merchant_concurrency:
+                return False
+            self._in_flight[merchant_id] = in_flight + 1
+            return True
+
+    def _deliveries_in_flight(self):
+        with self._lock:
+            return sum(self._in_flight.values())
+
+    def _release_merchant(self, merchant_id):
+        with self._lock:
+            in_flight = self._in_flight.pop(merchant_id, 0) - 1
+            if in_flight > 0:
+                self._in_flight[merchant_id] = in_flight
+
+    def _release_stale_claims(self):
+        # Claims are refreshed when their delivery starts, so claims older
+        # than a delivery timeout belong to a dispatcher that died mid-delivery
+        cutoff = datetime.utcnow() - timedelta(seconds=self.timeout * 2)
+        WebhookEvent.query.filter(
+            WebhookEvent.status == 'delivering',
+            WebhookEvent.claimed_at < cutoff
+        ).update({WebhookEvent.status: 'pending', WebhookEvent.claim_token: None},
+                 synchronize_session=False)
+        db.session.commit()
+
+    def _claim(self, merchant_id):
+        """Mark a batch of the merchant's due events as ours"""
+        now = datetime.utcnow()
+        event_ids = [row.id for row in
+                     db.session.query(WebhookEvent.id)
+                     .filter(WebhookEvent.merchant_id == merchant_id,
+                             WebhookEvent.status == 'pending',
+                             WebhookEvent.next_attempt_at <= now)
+                     .order_by(WebhookEvent.created_at)
+                     .limit(self.batch_size)]
+        if not event_ids:
+            return None
+
+        # Conditional update, so events claimed by another dispatcher in the
+        # meantime are left out
+        claim_token = str(uuid.uuid4())
+        claimed = WebhookEvent.query.filter(
+            WebhookEvent.id.in_(event_ids),
+            WebhookEvent.status == 'pending'
+        ).update({
+            WebhookEvent.status: 'delivering',
+            WebhookEvent.claim_token: claim_token,
+            WebhookEvent.claimed_at: now
+        }, synchronize_session=False)
+        db.session.commit()
+
+        return claim_token if claimed else None
+
+    def _deliver(self, merchant_id, claim_token):
+        try:
+            with self.app.app_context():
+                try:
+                    # Restart the stale claim clock; if the sweep already
+                    # released the claim, its events are no longer ours
+                    WebhookEvent.query.filter_by(claim_token=claim_token)\
+                        .update({WebhookEvent.claimed_at: datetime.utcnow()},
+                                synchronize_session=False)
+                    db.session.commit()
+
+                    events = self._claimed_events(claim_token)
+                    if not events:
+                        return
+
+                    merchant = Merchant.query.filter_by(
+                        merchant_id=merchant_id).first()
+
+                    error = None
+                    if not merchant or not merchant.webhook_url:
+                        error = 'Merchant has no webhook URL'
+                    else:
+                        try:
+                            WebhookService.send_webhook(
+                                self.session, merchant.webhook_url, merchant.api_key,
+                                [event.payload for event in events], self.timeout)
+                        except requests.RequestException as e:
+                            error = str(e)
+
+                    self._record_attempt(events, error)
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Error delivering webhooks to {merchant_id}: {str(e)}")
+                    # Count the attempt and release the claim now, instead
+                    # of leaving the events to the stale claim sweep
+                    try:
+                        self._record_attempt(
+                            self._claimed_events(claim_token), str(e))
+                    except Exception as e:
+                        db.session.rollback()
+                        print(f"Error recording webhook attempt for {merchant_id}: {str(e)}")
+        finally:
+            self._release_merchant(merchant_id)
+
+    def _claimed_events(self, claim_token):
+        return WebhookEvent.query.filter_by(claim_token=claim_token)\
+            .order_by(WebhookEvent.created_at)\
+            .all()
+
+    def _record_attempt(self, events, error):
+        now = datetime.utcnow()
+        for event in events:
+            event.attempts += 1
+            event.claim_token = None
+            if error is None:
+                event.status = 'delivered'
+                event.delivered_at = now
+                event.last_error = None
+            elif event.attempts >= self.max_attempts:
+                event.status = 'failed'
+                event.last_error = error
+            else:
+                delay = min(self.retry_base * 2 ** (event.attempts - 1),
+                            self.retry_max)
+                event.status = 'pending'
+                event.next_attempt_at = now + timedelta(seconds=delay)
+                event.last_error = error
+        db.session.commit()
@@ -0,0 +1,228 @@
+"""
+Bounded worker pool for asynchronous payment processing.
+
+Payments are committed as PENDING before they are handed to the pool, so the
+payments table is the durable queue: the in-memory queue only carries
+payment IDs. Anything that never reached a worker (full queue, restart,
+crash mid-processing) is picked up again by recover(), which runs when the
+pool starts and then periodically.
+
+When process returns a Future (an authorization running on the gateway's
+event loop) the worker moves on to the next payment and the result is
+recorded by a completion thread, so a few workers keep many authorizations
+in flight. max_in_flight bounds how many can be outstanding at once.
+"""
+
+import atexit
+import queue
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from models import db, Payment, PaymentStatus
+
+
+class QueueFullError(Exception):
+    """Raised when the pool cannot accept more payments"""
+
+
+class PaymentWorkerPool:
+
+    def __init__(self, app, process, complete=None, num_workers=8,
+                 max_queue_size=1000, max_in_flight=1000,
+                 recovery_interval=60, stale_after=300):
+        self.app = app
+        self.process = process
+        self.complete = complete
+        self.num_workers = num_workers
+        self.max_in_flight = max_in_flight
+        self.max_queue_size = max_queue_size
+        self.recovery_interval = recovery_interval
+        self.stale_after = stale_after
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._queued = set()
+        self._completions = queue.Queue()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._in_flight_count = 0
+        self._idle = threading.Condition()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._completion_threads = []
+        self._started = False
+        self._accepting = True
+
+    def start(self):
+        """Start the workers (idempotent) and recover unfinished payments"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+            for i in range(self.num_workers):
+                thread = threading.Thread(
+                    target=self._work, name=f'payment-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+            for i in range(self.num_workers):
+                thread = threading.Thread(
+                    target=self._complete_work, name=f'payment-completion-{i}',
+                    daemon=True)
+                thread.start()
+                self._completion_threads.append(thread)
+
+            sweeper = threading.Thread(
+                target=self._sweep, name='payment-recovery', daemon=True)
+            sweeper.start()
+
+            atexit.register(self.shutdown)
+
+        self.recover()
+
+    def submit(self, payment_id):
+        """Hand a committed PENDING payment to the workers"""
+        self.start()
+
+        with self._lock:
+            if not self._accepting:
+                raise QueueFullError('Payment workers are shutting down')
+            if payment_id in self._queued:
+                return
+            try:
+                self._queue.put_nowait(payment_id)
+            except queue.Full:
+                raise QueueFullError('Payment queue is full')
+            self._queued.add(payment_id)
+
+    def is_saturated(self):
+        return not self._accepting or self._queue.full()
+
+    def stats(self):
+        return {
+            'workers': self.num_workers,
+            'queued': self._queue.qsize(),
+            'max_queue_size': self.max_queue_size,
+            'in_flight': self._in_flight_count,
+            'max_in_flight': self.max_in_flight,
+            'accepting': self._accepting
+        }
+
+    def recover(self):
+        """Re-enqueue PENDING payments and reset stale PROCESSING ones"""
+        with self.app.app_context():
+            try:
+                # A payment stuck in PROCESSING for longer than the payment
+                # timeout belonged to a worker that died before finishing
+                cutoff = datetime.utcnow() - timedelta(seconds=self.stale_after)
+                Payment.query.filter(
+                    Payment.status == PaymentStatus.PROCESSING,
+                    Payment.updated_at < cutoff
+                ).update({Payment.status: PaymentStatus.PENDING},
+                         synchronize_session=False)
+                db.session.commit()
+
+                pending_ids = [row.id for row in db.session.query(Payment.id)
+                               .filter(Payment.status == PaymentStatus.PENDING)
+                               .order_by(Payment.created_at)
+                               .limit(self.max_queue_size)]
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error recovering pending payments: {str(e)}")
+                return
+
+        for payment_id in pending_ids:
+            try:
+                self.submit(payment_id)
+            except QueueFullError:
+                break
+
+    def shutdown(self, timeout=30):
+        """Stop accepting payments and let the workers drain the queue"""
+        with self._lock:
+            if not self._started or not self._accepting:
+                return
+            self._accepting = False
+
+        self._stop.set()
+        deadline = datetime.utcnow() + timedelta(seconds=timeout)
+
+        # One sentinel per worker, queued behind the pending payments
+        for _ in self._threads:
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            try:
+                self._queue.put(None, timeout=max(remaining, 0.1))
+            except queue.Full:
+                break
+
+        for thread in self._threads:
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            thread.join(max(remaining, 0))
+
+        # Wait for outstanding authorizations to be recorded
+        with self._idle:
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            self._idle.wait_for(
+                lambda: self._in_flight_count == 0, max(remaining, 0))
+
+        for _ in self._completion_threads:
+            self._completions.put(None)
+        for thread in self._completion_threads:
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            thread.join(max(remaining, 0))
+
+    def _work(self):
+        while True:
+            payment_id = self._queue.get()
+            try:
+                if payment_id is None:
+                    return
+
+                with self._lock:
+                    self._queued.discard(payment_id)
+
+                self._in_flight.acquire()
+                self._track(1)
+
+                outcome = None
+                with self.app.app_context():
+                    try:
+                        outcome = self.process(payment_id)
+                    except Exception as e:
+                        print(f"Error processing payment {payment_id}: {str(e)}")
+
+                if isinstance(outcome, Future) and self.complete:
+                    outcome.add_done_callback(
+                        lambda future, pid=payment_id: self._completions.put((pid, future)))
+                else:
+                    self._release()
+            finally:
+                self._queue.task_done()
+
+    def _complete_work(self):
+        while True:
+            item = self._completions.get()
+            if item is None:
+                return
+
+            payment_id, future = item
+            try:
+                with self.app.app_context():
+                    self.complete(payment_id, future)
+            except Exception as e:
+                print(f"Error completing payment {payment_id}: {str(e)}")
+            finally:
+                self._release()
+
+    def _track(self, delta):
+        with self._idle:
+            self._in_flight_count += delta
+            self._idle.notify_all()
+
+    def _release(self):
+        self._track(-1)
+        self._in_flight.release()
+
+    def _sweep(self):
+        while not self._stop.wait(self.recovery_interval):
+            self.recover()
@@ -89,18 +89,24 @@ class ChoreographedSagaCoordinator:
             "coordinator_order_cancelled"
         )
 
-    def initiate_checkout_saga(self, cart_id: str, user_id: str, payment_method: str, billing_address: dict) -> str:
-        """Initiate a new checkout saga"""
-        saga_id = str(uuid.uuid4())
-
-        # Create saga state
-        saga_state.create_saga(saga_id, {
+    def initiate_checkout_saga(self, cart_id: str, user_id: str, payment_method: str, billing_address: dict,
+                               saga_id: str = None, total_amount: float = None) -> str:
+        """Initiate a new checkout saga (a known saga_id is not started again)"""
+        if saga_id and saga_state.get_saga(saga_id):
+            return saga_id
+        saga_id = saga_id or str(uuid.uuid4())
+
+        # Create saga state before any service can answer the saga
+        data = {
             'cart_id': cart_id,
             'user_id': user_id,
             'payment_method': payment_method,
             'billing_address': billing_address,
             'current_step': 'inventory_reservation'
-        })
+        }
+        if total_amount is not None:
+            data['total_amount'] = total_amount
+        saga_state.create_saga(saga_id, data)
 
         # Publish checkout initiated event
         publish_checkout_initiated(
@@ -323,7 +329,9 @@ def initiate_choreographed_checkout():
             cart_id=data['cart_id'],
             user_id=data['user_id'],
             payment_method=data['payment_method'],
-            billing_address=data['billing_address']
+            billing_address=data['billing_address'],
+            saga_id=data.get('saga_id'),
+            total_amount=data.get('total_amount')
         )
 
         return jsonify({
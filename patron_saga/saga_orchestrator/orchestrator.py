@@ -1,5 +1,6 @@
 from flask import Flask, request, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from enum import Enum
 import uuid
 import requests
@@ -91,8 +92,15 @@ class SagaOrchestrator:
             'pagos': os.getenv('PAGOS_SERVICE_URL', 'http://localhost:3002')
         }
 
-    def create_checkout_saga(self, cart_id: str, user_id: str, payment_method: str, billing_address: dict) -> str:
-        """Create a new checkout saga transaction"""
+    def create_checkout_saga(self, cart_id: str, user_id: str, payment_method: str, billing_address: dict, saga_id: str = None) -> str:
+        """
+        Create a new checkout saga transaction. Callers may choose the saga
+        ID; a saga ID that already exists is not started again, so carrito's
+        checkout dispatch can be redelivered safely.
+        """
+        if saga_id and SagaTransaction.query.get(saga_id):
+            return saga_id
+        saga_id = saga_id or str(uuid.uuid4())
 
         # Get cart details
         cart_response = requests.get(
@@ -106,6 +114,7 @@ class SagaOrchestrator:
 
         # Create saga transaction
         saga = SagaTransaction(
+            id=saga_id,
             cart_id=cart_id,
             user_id=user_id,
             total_amount=total_amount,
@@ -179,7 +188,12 @@ class SagaOrchestrator:
             saga.steps.append(step)
 
         db.session.add(saga)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # The same saga ID delivered twice concurrently
+            db.session.rollback()
+            return saga_id
 
         # Start saga execution asynchronously
         threading.Thread(target=self.execute_saga, args=(saga.id,)).start()
@@ -219,9 +233,12 @@ class SagaOrchestrator:
 
         for attempt in range(step.max_retries + 1):
             try:
+                # Same key on every attempt, so a retry of a request that
+                # did reach the service is not applied twice
                 response = requests.post(
                     step.service_url,
                     json=step.request_data,
+                    headers={'Idempotency-Key': f"saga-{step.saga_id}-{step.step_name}"},
                     timeout=30
                 )
 
@@ -317,7 +334,8 @@ def initiate_checkout_saga():
             cart_id=data['cart_id'],
             user_id=data['user_id'],
             payment_method=data['payment_method'],
-            billing_address=data['billing_address']
+            billing_address=data['billing_address'],
+            saga_id=data.get('saga_id')
         )
 
         return jsonify({